@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+'''
+Measures how fast the Dispatcher schedules work items
+
+This feeds the work items of a synthetic quadtree, in the same order and with
+the same dependencies a TileSet gives them, through a Dispatcher whose work
+items do nothing, and prints the number of work items scheduled per second.
+Each leaf of the tree stands in for a render-tile, and every other node for
+a composite-tile that depends on its four children. For example:
+
+    python contrib/benchmarkDispatcher.py --nodes 10000000
+
+To keep many jobs in flight, like a real render has, a job only "finishes"
+once a number of later jobs have been dispatched (see --lag).
+'''
+
+import sys
+import os
+import time
+from collections import deque
+from optparse import OptionParser
+
+# incantation to be able to import overviewer_core
+if not hasattr(sys, "frozen"):
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0], '..')))
+
+from overviewer_core import dispatcher
+
+class QuadtreeWorker(object):
+    """Implements the worker interface (see tileset.py) for a quadtree of the
+    given depth, stopping after the given number of nodes. Work items are
+    (level, index) tuples, with the leaves at level depth."""
+    def __init__(self, depth, nodes):
+        self.depth = depth
+        self.nodes = nodes
+
+    def get_num_phases(self):
+        return 1
+
+    def get_phase_length(self, phase):
+        return self.nodes
+
+    def iterate_work_items(self, phase):
+        # A post-traversal: after the last child of a node, the node itself
+        count = 0
+        depth = self.depth
+        for index in xrange(4 ** depth):
+            level = depth
+            while True:
+                if level == depth:
+                    deps = []
+                else:
+                    deps = [(level + 1, 4 * index + i) for i in xrange(4)]
+                yield (level, index), deps
+                count += 1
+                if count >= self.nodes:
+                    return
+                if level == 0 or index % 4 != 3:
+                    break
+                level -= 1
+                index //= 4
+
+    def do_work(self, workitem):
+        pass
+
+class LaggingDispatcher(dispatcher.Dispatcher):
+    """A Dispatcher whose jobs finish lag dispatches after they were
+    started. When there's nothing new to start, the oldest job finishes."""
+    def __init__(self, lag):
+        super(LaggingDispatcher, self).__init__()
+        self.lag = lag
+        self.running = deque()
+
+    def dispatch(self, tileset, workitem):
+        if tileset is None:
+            if self.running:
+                return [self.running.popleft()]
+            return []
+        tileset.do_work(workitem)
+        self.running.append((tileset, workitem))
+        if len(self.running) > self.lag:
+            return [self.running.popleft()]
+        return []
+
+class NullObserver(object):
+    def start(self, max_value):
+        self.count = 0
+    def add(self, amount):
+        self.count += amount
+    def finish(self):
+        pass
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--nodes", dest="nodes", type="int", default=10000000,
+                      help="number of quadtree nodes to schedule [default: 10000000]")
+    parser.add_option("-l", "--lag", dest="lag", type="int", default=1000,
+                      help="number of jobs kept running at once [default: 1000]")
+
+    (options, args) = parser.parse_args()
+
+    if args:
+        parser.print_help()
+        sys.exit(1)
+
+    # the smallest quadtree with at least that many nodes
+    depth = 0
+    while (4 ** (depth + 1) - 1) // 3 < options.nodes:
+        depth += 1
+
+    worker = QuadtreeWorker(depth, options.nodes)
+    observer = NullObserver()
+    d = LaggingDispatcher(options.lag)
+    start = time.time()
+    d.render_all([worker], observer)
+    seconds = time.time() - start
+    d.close()
+
+    print "%d work items in %.2fs, %.0f work items/sec" % (observer.count,
+            seconds, observer.count / seconds if seconds else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+'''
+Measures render-tile throughput with and without batched rendering
+
+This renders the same set of render-tiles from a world once for each given
+renderbatch value (see the renderbatch option in the docs) into a temporary
+directory, and prints the number of tiles rendered per second. For example:
+
+    python contrib/benchmarkRender.py --batch 0,1,2 ../world.test/
+
+Only render-tiles are rendered, composite-tiles are not touched.
+'''
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import logging
+from collections import defaultdict
+from optparse import OptionParser
+
+# incantation to be able to import overviewer_core
+if not hasattr(sys, "frozen"):
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0], '..')))
+
+from overviewer_core import world, textures, rendermodes, tileset
+
+class BenchmarkAssetManager(object):
+    """Stands in for the AssetManager, as nothing has been rendered before"""
+    def get_tileset_config(self, name):
+        return {'lastrendertime': 0}
+
+def get_tileset(w, tex, options, outputdir):
+    ts = tileset.TileSet(w, w.get_regionset(None), BenchmarkAssetManager(), tex,
+            options, outputdir)
+    ts.do_preprocessing()
+    return ts
+
+def benchmark(w, tex, rendermode, batch, maxtiles):
+    """Renders up to maxtiles render-tiles with the given renderbatch value,
+    and returns (number of tiles, seconds taken)"""
+    outputdir = tempfile.mkdtemp(prefix="overviewer-benchmark")
+    try:
+        options = {
+                'name': 'benchmark',
+                'bgcolor': (26, 26, 26, 0),
+                'imgformat': 'png',
+                'imgquality': 95,
+                'optimizeimg': 0,
+                'rendermode': rendermode,
+                'rerenderprob': 0,
+                'renderchecks': 2,
+                'renderbatch': batch,
+                }
+        ts = get_tileset(w, tex, options, outputdir)
+
+        # The first tiles in quadtree order are close together, and are the
+        # same for every renderbatch value
+        tilepaths = []
+        for tilepath in ts.dirtytree.iterate():
+            if len(tilepaths) >= maxtiles:
+                break
+            tilepaths.append(tilepath)
+
+        if batch > 0:
+            level = max(0, ts.treedepth - batch)
+            groups = defaultdict(list)
+            for tilepath in tilepaths:
+                groups[tilepath[:level]].append(tilepath)
+            workitems = [tileset.RenderBatch(tuple(group), ()) for group in groups.itervalues()]
+        else:
+            workitems = tilepaths
+
+        start = time.time()
+        for workitem in workitems:
+            ts.do_work(workitem)
+        return len(tilepaths), time.time() - start
+    finally:
+        shutil.rmtree(outputdir, True)
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options] <world directory>")
+    parser.add_option("-b", "--batch", dest="batch", default="0,2",
+                      help="comma separated renderbatch values to compare [default: 0,2]")
+    parser.add_option("-n", "--tiles", dest="tiles", type="int", default=64,
+                      help="number of render-tiles to render [default: 64]")
+    parser.add_option("-m", "--rendermode", dest="rendermode", default="normal",
+                      help="the rendermode to use [default: normal]")
+    parser.add_option("-t", "--texturepath", dest="texturepath", default=None,
+                      help="the texture pack or minecraft jar to use")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        batches = [int(b) for b in options.batch.split(",")]
+    except ValueError:
+        parser.error("--batch takes a comma separated list of integers")
+    rendermode = getattr(rendermodes, options.rendermode, None)
+    if not isinstance(rendermode, list):
+        parser.error("unknown rendermode %r" % options.rendermode)
+
+    w = world.World(args[0])
+    tex = textures.Textures(texturepath=options.texturepath)
+    tex.generate()
+
+    # warm up, so the first measurement doesn't pay for loading everything
+    benchmark(w, tex, rendermode, 0, min(options.tiles, 4))
+
+    for batch in batches:
+        tiles, seconds = benchmark(w, tex, rendermode, batch, options.tiles)
+        print "renderbatch %d: %d tiles in %.2fs, %.2f tiles/sec" % (batch,
+                tiles, seconds, tiles / seconds if seconds else 0)
+
+if __name__ == "__main__":
+    main()
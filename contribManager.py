@@ -24,7 +24,9 @@ scripts=dict( # keys are names, values are scripts
         pngit           = "png-it.py",
         gallery         = "gallery.py",
         regionTrimmer   = "regionTrimmer.py",
-        contributors    = "contributors.py"
+        contributors    = "contributors.py",
+        benchmarkRender = "benchmarkRender.py",
+        benchmarkDispatcher = "benchmarkDispatcher.py"
         )
 
 # you can symlink or hardlink contribManager.py to another name to have it
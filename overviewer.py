@@ -104,6 +104,8 @@ def main():
             help="Runs the genPOI script")
     exegroup.add_option("--skip-scan", dest="skipscan", action="store_true",
             help="When running GenPOI, don't scan for entities")
+    exegroup.add_option("--sharded-markers", dest="sharded", action="store_true",
+            help="When running GenPOI, write the markers of each region to a file of their own")
 
     parser.add_option_group(exegroup)
 
@@ -442,10 +444,22 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
     # Set up the cache objects to use
     caches = []
     caches.append(cache.LRUCache(size=100))
+    if config['processes'] != 1 and config['threads'] <= 1 and config['sharedcachesize'] > 0:
+        # lets the worker processes share the chunks they've decoded
+        caches.append(cache.SharedChunkCache(size=config['sharedcachesize']))
     if config.get("memcached_host", False):
         caches.append(cache.Memcached(config['memcached_host']))
     # TODO: optionally more caching layers here
 
+    # the textures are generated with as many processes as the render uses,
+    # see the dispatcher below
+    if config['threads'] > 1:
+        texprocesses = 1
+    elif config['processes'] < 0:
+        texprocesses = multiprocessing.cpu_count()
+    else:
+        texprocesses = config['processes']
+
     renders = config['renders']
     for render_name, render in renders.iteritems():
         logging.debug("Found the following render thing: %r", render)
@@ -461,9 +475,9 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
         texopts = util.dict_subset(render, ["texturepath", "bgcolor", "northdirection"])
         texopts_key = tuple(texopts.items())
         if texopts_key not in texcache:
-            tex = textures.Textures(**texopts)
+            tex = textures.Textures(cachedir=os.path.join(destdir, "texturecache"), **texopts)
             logging.info("Generating textures...")
-            tex.generate()
+            tex.generate(processes=texprocesses)
             logging.debug("Finished generating textures")
             texcache[texopts_key] = tex
         else:
@@ -506,7 +520,7 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
 
         # only pass to the TileSet the options it really cares about
         render['name'] = render_name # perhaps a hack. This is stored here for the asset manager
-        tileSetOpts = util.dict_subset(render, ["name", "imgformat", "renderchecks", "rerenderprob", "bgcolor", "defaultzoom", "imgquality", "optimizeimg", "rendermode", "worldname_orig", "title", "dimension", "changelist", "showspawn", "overlay", "base", "poititle", "maxzoom", "showlocationmarker", "minzoom"])
+        tileSetOpts = util.dict_subset(render, ["name", "imgformat", "renderchecks", "rerenderprob", "renderbatch", "bgcolor", "defaultzoom", "imgquality", "optimizeimg", "rendermode", "worldname_orig", "title", "dimension", "changelist", "showspawn", "overlay", "base", "poititle", "maxzoom", "showlocationmarker", "minzoom"])
         tileSetOpts.update({"spawn": w.find_true_spawn()}) # TODO find a better way to do this
         tset = tileset.TileSet(w, rset, assetMrg, tex, tileSetOpts, tileset_dir)
         tilesets.append(tset)
@@ -520,13 +534,17 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
     assetMrg.initialize(tilesets)
 
     # multiprocessing dispatcher
-    if config['processes'] == 1:
+    if config['threads'] > 1:
+        dispatch = dispatcher.ThreadedDispatcher(config['threads'])
+    elif config['processes'] == 1:
         dispatch = dispatcher.Dispatcher()
     else:
         dispatch = dispatcher.MultiprocessingDispatcher(
             local_procs=config['processes'])
-    dispatch.render_all(tilesets, config['observer'])
-    dispatch.close()
+    try:
+        dispatch.render_all(tilesets, config['observer'])
+    finally:
+        dispatch.close()
 
     assetMrg.finalize(tilesets)
 
@@ -534,7 +552,7 @@ dir but you forgot to put quotes around the directory, since it contains spaces.
         logging.debug("Closing %s (%s)", out, out.fileno())
         out.close()
 
-    if config['processes'] == 1:
+    if config['processes'] == 1 or config['threads'] > 1:
         logging.debug("Final cache stats:")
         for c in caches:
             logging.debug("\t%s: %s hits, %s misses", c.__class__.__name__, c.hits, c.misses)
@@ -22,6 +22,8 @@ import re
 import urllib2
 import Queue
 import multiprocessing
+import errno
+import cPickle
 
 from multiprocessing import Process
 from multiprocessing import Pool
@@ -30,6 +32,7 @@ from optparse import OptionParser
 from overviewer_core import logger
 from overviewer_core import nbt
 from overviewer_core import configParser, world
+from overviewer_core.files import FileReplacer, get_fs_caps
 
 UUID_LOOKUP_URL = 'https://sessionserver.mojang.com/session/minecraft/profile/'
 
@@ -41,33 +44,217 @@ def replaceBads(s):
         x = x.replace(bad,"_")
     return x
 
-# yes there's a double parenthesis here
-# see below for when this is called, and why we do this
-# a smarter way would be functools.partial, but that's broken on python 2.6
-# when used with multiprocessing
-def parseBucketChunks((bucket, rset)):
-    pid = multiprocessing.current_process().pid
-    pois = dict(TileEntities=[], Entities=[]);
-  
-    i = 0
-    cnt = 0
-    l = len(bucket)
-    for b in bucket:
-        try:
-            data = rset.get_chunk(b[0],b[1])
-            pois['TileEntities'] += data['TileEntities']
-            pois['Entities']     += data['Entities']
-        except nbt.CorruptChunkError:
-            logging.warning("Ignoring POIs in corrupt chunk %d,%d", b[0], b[1])
+def getGroupName(filter_name, filter_function, rset):
+    "Returns the unique name of a markerset. It will not be user visible"
+    return replaceBads(filter_name) + hex(hash(filter_function))[-4:] + "_" + hex(hash(rset))[-4:]
+
+def filterPOIs(filter_function, pois, isEntity=False):
+    """Runs a filter function over a list of POIs, and returns the markers
+    for the ones it picked. Entities have their position in Pos, and only
+    take string or tuple results."""
+    raw = []
+    for poi in pois:
+        result = filter_function(poi)
+        if not result:
+            continue
+        if isEntity:
+            x, y, z = poi['Pos'][0], poi['Pos'][1], poi['Pos'][2]
+        else:
+            x, y, z = poi['x'], poi['y'], poi['z']
+        if isinstance(result, basestring):
+            d = dict(x=x, y=y, z=z, text=result, hovertext=result)
+        elif type(result) == tuple:
+            d = dict(x=x, y=y, z=z, text=result[1], hovertext=result[0])
+        # Dict support to allow more flexible things in the future as well as polylines on the map.
+        elif type(result) == dict and not isEntity:
+            d = dict(x=x, y=y, z=z, text=result['text'])
+            # Use custom hovertext if provided...
+            if 'hovertext' in result and isinstance(result['hovertext'], basestring):
+                d['hovertext'] = result['hovertext']
+            else: # ...otherwise default to display text.
+                d['hovertext'] = result['text']
+            if 'polyline' in result and type(result['polyline']) == tuple:  #if type(result.get('polyline', '')) == tuple:
+                d['polyline'] = []
+                for point in result['polyline']:
+                    # This poor man's validation code almost definately needs improving.
+                    if type(point) == dict:
+                        d['polyline'].append(dict(x=point['x'],y=point['y'],z=point['z']))
+                if isinstance(result['color'], basestring):
+                    d['strokeColor'] = result['color']
+        else:
+            continue
+        if "icon" in poi:
+            d.update({"icon": poi['icon']})
+        if "createInfoWindow" in poi:
+            d.update({"createInfoWindow": poi['createInfoWindow']})
+        raw.append(d)
+    return raw
+
+# Bumped whenever the format of the POI cache changes, see
+# loadPOICacheIndex()
+POI_CACHE_VERSION = 2
+
+def getPOICacheName(rset, render):
+    """Returns the name used for a regionset in the POI cache and for its
+    marker shards"""
+    return "%s_%s" % (replaceBads(render['worldname_orig']), rset.get_type() or "overworld")
+
+def getRegionCachePath(cachedir, regionfile):
+    "Returns the path of the file caching the POIs of a region file"
+    return os.path.join(cachedir, os.path.splitext(os.path.basename(regionfile))[0] + ".dat")
+
+def loadPOICacheIndex(cachedir, rset):
+    """Loads the index of the POI cache of a regionset, written by an
+    earlier run. It maps each region file to its key from iterate_regions()
+    when it was last read. The POIs of each region file are kept in a file
+    of their own next to it, see loadRegionPOIs().
+
+    Returns an empty dict if there's no cache yet, or it can't be used.
+
+    """
+    indexpath = os.path.join(cachedir, "index.dat")
+    try:
+        with open(indexpath, "rb") as f:
+            version, rsetkey, index = cPickle.load(f)
+        if version == POI_CACHE_VERSION and rsetkey == repr(rset):
+            return index
+        logging.debug("POI cache %s is out of date", cachedir)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            logging.warning("Could not read the POI cache %s: %s", indexpath, e)
+    except Exception, e:
+        logging.warning("The POI cache %s is corrupt, all regions will be read: %s", indexpath, e)
+    return {}
+
+def savePOICacheIndex(cachedir, rset, index, fs_caps):
+    "Writes out the index of the POI cache of a regionset"
+    indexpath = os.path.join(cachedir, "index.dat")
+    with FileReplacer(indexpath, capabilities=fs_caps) as tmppath:
+        with open(tmppath, "wb") as f:
+            cPickle.dump((POI_CACHE_VERSION, repr(rset), index), f, cPickle.HIGHEST_PROTOCOL)
+
+def loadRegionPOIs(cachepath):
+    """Loads the cached POIs of one region file, as get_region_pois()
+    returned them. Returns None if they can't be loaded."""
+    try:
+        with open(cachepath, "rb") as f:
+            return cPickle.load(f)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            logging.warning("Could not read the POI cache %s: %s", cachepath, e)
+    except Exception, e:
+        logging.warning("The POI cache %s is corrupt: %s", cachepath, e)
+    return None
+
+def saveRegionPOIs(cachepath, chunks, fs_caps):
+    "Writes out the cached POIs of one region file"
+    with FileReplacer(cachepath, capabilities=fs_caps) as tmppath:
+        with open(tmppath, "wb") as f:
+            cPickle.dump(chunks, f, cPickle.HIGHEST_PROTOCOL)
+
+def parseRegion(regionfile, rset, cachepath, fs_caps):
+    """Reads the POIs of one region file. Only the chunks that changed since
+    they were cached are read again, and the cache is updated. Returns a
+    list of (x, z, mtime, tileentities, entities) tuples, like
+    get_region_pois()."""
+    cached = loadRegionPOIs(cachepath)
+    if cached:
+        cached = dict((chunk[:2], chunk) for chunk in cached)
+        known = dict((xz, chunk[2]) for xz, chunk in cached.iteritems())
+    else:
+        known = None
 
-        # Perhaps only on verbose ?
-        i = i + 1
-        if i == 250:
-            i = 0
-            cnt = 250 + cnt
-            logging.info("Found %d entities and %d tile entities in thread %d so far at %d chunks", len(pois['Entities']), len(pois['TileEntities']), pid, cnt);
+    chunks = rset.get_region_pois(regionfile, known)
+    reread = 0
+    for i, (x, z, mtime, tileentities, entities) in enumerate(chunks):
+        if tileentities is None:
+            chunks[i] = cached[x, z]
+        else:
+            reread += 1
+
+    if cached is None or reread or len(chunks) != len(cached):
+        saveRegionPOIs(cachepath, chunks, fs_caps)
+    logging.debug("Read %d of %d chunks of %s", reread, len(chunks), regionfile)
+    return chunks
+
+# The regionset and POI cache of the worker processes. Unpickling a
+# regionset scans its region directory again, so the workers get it once
+# when they start, and their jobs are just region files
+_worker_state = None
+
+def initPOIWorker(rset, cachedir, fs_caps):
+    global _worker_state
+    _worker_state = (rset, cachedir, fs_caps)
+
+def parseRegionJob(regionfile):
+    "Runs parseRegion() in a worker process, see initPOIWorker()"
+    rset, cachedir, fs_caps = _worker_state
+    return parseRegion(regionfile, rset, getRegionCachePath(cachedir, regionfile), fs_caps)
+
+def iterateRegionPOIs(rset, render, config):
+    """Yields (regionfile, chunks) for every region file of a regionset, in
+    order, where chunks is what get_region_pois() returns for it.
+
+    What was read on earlier runs is kept in the POI cache in the output
+    directory. Regions whose key didn't change are taken from it as they
+    are, and only the changed chunks of the other regions are read again.
+    Each region file is read as a whole by one process, so it's only opened
+    once. Only the POIs of the regions being worked on are kept in memory.
+
+    """
+    cachedir = os.path.join(config['outputdir'], "poicache", getPOICacheName(rset, render))
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    fs_caps = get_fs_caps(cachedir)
+
+    oldindex = loadPOICacheIndex(cachedir, rset)
+    regions = sorted(rset.iterate_regions())
+    changed = [regionfile for regionfile, key in regions if oldindex.get(regionfile) != key]
+    logging.info("%d of %d regions changed since the last scan", len(changed), len(regions))
+
+    processes = config['processes'];
+    if processes < 0:
+        processes = multiprocessing.cpu_count()
+
+    if processes == 1 or len(changed) <= 1:
+        results = (parseRegion(regionfile, rset, getRegionCachePath(cachedir, regionfile), fs_caps)
+                for regionfile in changed)
+        pool = None
+    else:
+        # Create a pool of processes and run all the functions
+        pool = Pool(processes=processes, initializer=initPOIWorker,
+                initargs=(rset, cachedir, fs_caps))
+        results = pool.imap(parseRegionJob, changed)
 
-    return pois
+    index = {}
+    done = 0
+    try:
+        for regionfile, key in regions:
+            cachepath = getRegionCachePath(cachedir, regionfile)
+            if oldindex.get(regionfile) == key:
+                chunks = loadRegionPOIs(cachepath)
+                if chunks is None:
+                    chunks = parseRegion(regionfile, rset, cachepath, fs_caps)
+            else:
+                chunks = next(results)
+                done += 1
+                logging.info("Read %d of %d changed regions so far", done, len(changed))
+            index[regionfile] = key
+            yield regionfile, chunks
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+            logging.info("All the threads completed")
+
+    # forget about the regions that went away
+    current = set(os.path.basename(getRegionCachePath(cachedir, regionfile)) for regionfile in index)
+    for name in os.listdir(cachedir):
+        if name.endswith(".dat") and name != "index.dat" and name not in current:
+            os.remove(os.path.join(cachedir, name))
+
+    if index != oldindex:
+        savePOICacheIndex(cachedir, rset, index, fs_caps)
 
 def handleEntities(rset, outputdir, render, rname, config):
 
@@ -80,43 +267,58 @@ def handleEntities(rset, outputdir, render, rname, config):
     filters = render['markers']
     rset._pois = dict(TileEntities=[], Entities=[])
 
-    numbuckets = config['processes'];
-    if numbuckets < 0:
-        numbuckets = multiprocessing.cpu_count()
-
-    if numbuckets == 1:
-        for (x,z,mtime) in rset.iterate_chunks():
-            try:
-                data = rset.get_chunk(x,z) 
-                rset._pois['TileEntities'] += data['TileEntities']
-                rset._pois['Entities']     += data['Entities']
-            except nbt.CorruptChunkError:
-                logging.warning("Ignoring POIs in corrupt chunk %d,%d", x,z)
-  
-    else:
-        buckets = [[] for i in range(numbuckets)];
-  
-        for (x,z,mtime) in rset.iterate_chunks():
-            i = x / 32 + z / 32
-            i = i % numbuckets 
-            buckets[i].append([x,z])
-  
-        for b in buckets:
-            logging.info("Buckets has %d entries", len(b));
-  
-        # Create a pool of processes and run all the functions
-        pool = Pool(processes=numbuckets)
-        results = pool.map(parseBucketChunks, ((buck, rset) for buck in buckets))
-  
-        logging.info("All the threads completed")
-  
-        # Fix up all the quests in the reset
-        for data in results:
-            rset._pois['TileEntities'] += data['TileEntities']
-            rset._pois['Entities']     += data['Entities']
+    for regionfile, chunks in iterateRegionPOIs(rset, render, config):
+        for x, z, mtime, tileentities, entities in chunks:
+            rset._pois['TileEntities'] += tileentities
+            rset._pois['Entities']     += entities
+    logging.info("Found %d entities and %d tile entities",
+            len(rset._pois['Entities']), len(rset._pois['TileEntities']))
 
     logging.info("Done.")
 
+def writeMarkerShards(rset, render, destdir, config, groups):
+    """Reads the entities of a regionset region by region, and writes the
+    markers found in each region to a shard of its own, in
+    markers/<name>/r.<x>.<z>.json in the output directory. A shard maps the
+    name of each markerset in groups, a list of (name, filter function)
+    tuples, to its markers in that region.
+
+    Returns (name, index), where index maps "<x>.<z>" to the number of
+    markers in each shard. Regions without markers have no shard.
+
+    """
+    name = getPOICacheName(rset, render)
+    sharddir = os.path.join(destdir, "markers", name)
+    if not os.path.isdir(sharddir):
+        os.makedirs(sharddir)
+
+    logging.info("Looking for entities in %r", rset)
+    index = dict()
+    for regionfile, chunks in iterateRegionPOIs(rset, render, config):
+        shard = dict()
+        for groupname, filter_function in groups:
+            raw = []
+            for x, z, mtime, tileentities, entities in chunks:
+                raw += filterPOIs(filter_function, entities, True)
+                raw += filterPOIs(filter_function, tileentities)
+            if raw:
+                shard[groupname] = raw
+        if not shard:
+            continue
+        p = os.path.basename(regionfile).split(".")
+        shardname = "%s.%s" % (p[1], p[2])
+        with open(os.path.join(sharddir, "r.%s.json" % shardname), "w") as output:
+            json.dump(shard, output)
+        index[shardname] = sum(len(raw) for raw in shard.itervalues())
+
+    # remove the shards of regions that no longer have any markers
+    for shardfile in os.listdir(sharddir):
+        if shardfile.endswith(".json") and shardfile[2:-5] not in index:
+            os.remove(os.path.join(sharddir, shardfile))
+
+    logging.info("Wrote %d markers to %d shards", sum(index.itervalues()), len(index))
+    return name, index
+
 def handlePlayers(rset, render, worldpath):
     if not hasattr(rset, "_pois"):
         rset._pois = dict(TileEntities=[], Entities=[])
@@ -199,10 +401,10 @@ def main():
 
     if os.path.basename(sys.argv[0]) == """genPOI.py""":
         helptext = """genPOI.py
-            %prog --config=<config file> [--quiet]"""
+            %prog --config=<config file> [--quiet] [--sharded-markers]"""
     else:
         helptext = """genPOI
-            %prog --genpoi --config=<config file> [--quiet]"""
+            %prog --genpoi --config=<config file> [--quiet] [--sharded-markers]"""
 
     logger.configure()
 
@@ -210,6 +412,7 @@ def main():
     parser.add_option("-c", "--config", dest="config", action="store", help="Specify the config file to use.")
     parser.add_option("--quiet", dest="quiet", action="count", help="Reduce logging output")
     parser.add_option("--skip-scan", dest="skipscan", action="store_true", help="Skip scanning for entities when using GenPOI")
+    parser.add_option("--sharded-markers", dest="sharded", action="store_true", help="Write the markers found in each region to a file of their own, which the web page loads as needed")
 
     options, args = parser.parse_args()
     if not options.config:
@@ -234,6 +437,9 @@ def main():
 
     markersets = set()
     markers = dict()
+    # the regionsets whose markers are sharded, and the name of their shards
+    shardrsets = []
+    shardnames = dict()
 
     for rname, render in config['renders'].iteritems():
         try:
@@ -259,7 +465,7 @@ def main():
       
         for f in render['markers']:
             markersets.add(((f['name'], f['filterFunction']), rset))
-            name = replaceBads(f['name']) + hex(hash(f['filterFunction']))[-4:] + "_" + hex(hash(rset))[-4:]
+            name = getGroupName(f['name'], f['filterFunction'], rset)
             to_append = dict(groupName=name, 
                     displayName = f['name'], 
                     icon=f.get('icon', 'signpost_icon.png'), 
@@ -271,12 +477,27 @@ def main():
             except KeyError:
                 markers[rname] = [to_append]
         
-        if not options.skipscan:
+        if options.skipscan:
+            pass
+        elif options.sharded:
+            # the entities are read after all the markersets are known, and
+            # go straight into the shards
+            if not hasattr(rset, "_pois"):
+                rset._pois = dict(TileEntities=[], Entities=[])
+                shardrsets.append((rset, render))
+        else:
             handleEntities(rset, os.path.join(destdir, rname), render, rname, config)
 
         handlePlayers(rset, render, worldpath)
         handleManual(rset, render['manualpois'])
 
+    markerShards = dict()
+    for rset, render in shardrsets:
+        groups = [(getGroupName(flter[0], flter[1], r), flter[1]) for (flter, r) in markersets if r is rset]
+        name, index = writeMarkerShards(rset, render, destdir, config, groups)
+        markerShards[name] = index
+        shardnames[rset] = name
+
     logging.info("Done handling POIs")
     logging.info("Writing out javascript files")
     markerSetDict = dict()
@@ -285,110 +506,24 @@ def main():
         filter_name =     flter[0]
         filter_function = flter[1]
 
-        name = replaceBads(filter_name) + hex(hash(filter_function))[-4:] + "_" + hex(hash(rset))[-4:]
+        name = getGroupName(filter_name, filter_function, rset)
         markerSetDict[name] = dict(created=False, raw=[], name=filter_name)
-        for poi in rset._pois['Entities']:
-            result = filter_function(poi)
-            if result:
-                if isinstance(result, basestring):
-                    d = dict(x=poi['Pos'][0], y=poi['Pos'][1], z=poi['Pos'][2], text=result, hovertext=result)
-                elif type(result) == tuple:
-                    d = dict(x=poi['Pos'][0], y=poi['Pos'][1], z=poi['Pos'][2], text=result[1], hovertext=result[0])
-                if "icon" in poi:
-                    d.update({"icon": poi['icon']})
-                if "createInfoWindow" in poi:
-                    d.update({"createInfoWindow": poi['createInfoWindow']})
-                markerSetDict[name]['raw'].append(d)
-        for poi in rset._pois['TileEntities']:
-            result = filter_function(poi)
-            if result:
-                if isinstance(result, basestring):
-                    d = dict(x=poi['x'], y=poi['y'], z=poi['z'], text=result, hovertext=result)
-                elif type(result) == tuple:
-                    d = dict(x=poi['x'], y=poi['y'], z=poi['z'], text=result[1], hovertext=result[0])
-                # Dict support to allow more flexible things in the future as well as polylines on the map.
-                elif type(result) == dict:
-                    d = dict(x=poi['x'], y=poi['y'], z=poi['z'], text=result['text'])
-                    # Use custom hovertext if provided...
-                    if 'hovertext' in result and isinstance(result['hovertext'], basestring):
-                        d['hovertext'] = result['hovertext']
-                    else: # ...otherwise default to display text.
-                        d['hovertext'] = result['text']
-                    if 'polyline' in result and type(result['polyline']) == tuple:  #if type(result.get('polyline', '')) == tuple:
-                        d['polyline'] = []
-                        for point in result['polyline']:
-                            # This poor man's validation code almost definately needs improving.
-                            if type(point) == dict:
-                                d['polyline'].append(dict(x=point['x'],y=point['y'],z=point['z']))
-                        if isinstance(result['color'], basestring):
-                            d['strokeColor'] = result['color']
-                if "icon" in poi:
-                    d.update({"icon": poi['icon']})
-                if "createInfoWindow" in poi:
-                    d.update({"createInfoWindow": poi['createInfoWindow']})
-                markerSetDict[name]['raw'].append(d)
-        for poi in rset._pois['Players']:
-            result = filter_function(poi)
-            if result:
-                if isinstance(result, basestring):
-                    d = dict(x=poi['x'], y=poi['y'], z=poi['z'], text=result, hovertext=result)
-                elif type(result) == tuple:
-                    d = dict(x=poi['x'], y=poi['y'], z=poi['z'], text=result[1], hovertext=result[0])
-                # Dict support to allow more flexible things in the future as well as polylines on the map.
-                elif type(result) == dict:
-                    d = dict(x=poi['x'], y=poi['y'], z=poi['z'], text=result['text'])
-                    # Use custom hovertext if provided...
-                    if 'hovertext' in result and isinstance(result['hovertext'], basestring):
-                        d['hovertext'] = result['hovertext']
-                    else: # ...otherwise default to display text.
-                        d['hovertext'] = result['text']
-                    if 'polyline' in result and type(result['polyline']) == tuple:  #if type(result.get('polyline', '')) == tuple:
-                        d['polyline'] = []
-                        for point in result['polyline']:
-                            # This poor man's validation code almost definately needs improving.
-                            if type(point) == dict:
-                                d['polyline'].append(dict(x=point['x'],y=point['y'],z=point['z']))
-                        if isinstance(result['color'], basestring):
-                            d['strokeColor'] = result['color']
-                if "icon" in poi:
-                    d.update({"icon": poi['icon']})
-                if "createInfoWindow" in poi:
-                    d.update({"createInfoWindow": poi['createInfoWindow']})
-                markerSetDict[name]['raw'].append(d)
-        for poi in rset._pois['Manual']:
-            result = filter_function(poi)
-            if result:
-                if isinstance(result, basestring):
-                    d = dict(x=poi['x'], y=poi['y'], z=poi['z'], text=result, hovertext=result)
-                elif type(result) == tuple:
-                    d = dict(x=poi['x'], y=poi['y'], z=poi['z'], text=result[1], hovertext=result[0])
-                # Dict support to allow more flexible things in the future as well as polylines on the map.
-                elif type(result) == dict:
-                    d = dict(x=poi['x'], y=poi['y'], z=poi['z'], text=result['text'])
-                    # Use custom hovertext if provided...
-                    if 'hovertext' in result and isinstance(result['hovertext'], basestring):
-                        d['hovertext'] = result['hovertext']
-                    else: # ...otherwise default to display text.
-                        d['hovertext'] = result['text']
-                    if 'polyline' in result and type(result['polyline']) == tuple:  #if type(result.get('polyline', '')) == tuple:
-                        d['polyline'] = []
-                        for point in result['polyline']:
-                            # This poor man's validation code almost definately needs improving.
-                            if type(point) == dict:
-                                d['polyline'].append(dict(x=point['x'],y=point['y'],z=point['z']))
-                        if isinstance(result['color'], basestring):
-                            d['strokeColor'] = result['color']
-                if "icon" in poi:
-                    d.update({"icon": poi['icon']})
-                if "createInfoWindow" in poi:
-                    d.update({"createInfoWindow": poi['createInfoWindow']})
-                markerSetDict[name]['raw'].append(d)
+        if rset in shardnames:
+            markerSetDict[name]['shards'] = shardnames[rset]
+        markerSetDict[name]['raw'] += filterPOIs(filter_function, rset._pois['Entities'], True)
+        markerSetDict[name]['raw'] += filterPOIs(filter_function, rset._pois['TileEntities'])
+        markerSetDict[name]['raw'] += filterPOIs(filter_function, rset._pois['Players'])
+        markerSetDict[name]['raw'] += filterPOIs(filter_function, rset._pois['Manual'])
     #print markerSetDict
 
     with open(os.path.join(destdir, "markersDB.js"), "w") as output:
         output.write("var markersDB=")
         json.dump(markerSetDict, output, indent=2)
         output.write(";\n");
+        if markerShards:
+            output.write("var markerShards=")
+            json.dump(markerShards, output, indent=2)
+            output.write(";\n");
     with open(os.path.join(destdir, "markers.js"), "w") as output:
         output.write("var markers=")
         json.dump(markers, output, indent=2)
@@ -23,6 +23,20 @@ attribute.
 import functools
 import logging
 import cPickle
+import hashlib
+import struct
+import os
+import os.path
+import mmap
+import atexit
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 class LRUCache(object):
     """A simple, generic, in-memory LRU cache that implements the standard
@@ -40,6 +54,9 @@ class LRUCache(object):
     first item of the list is evicted. All operations have constant time
     complexity (dict lookups are worst case O(n) time)
 
+    The cache can be shared between the threads of a ThreadedDispatcher; a
+    lock keeps the linked list consistent.
+
     """
     class _LinkNode(object):
         __slots__ = ['left', 'right', 'key', 'value']
@@ -73,6 +90,8 @@ class LRUCache(object):
 
         self.destructor = destructor
 
+        self._lock = threading.Lock()
+
     # Initialize an empty cache of the same size for worker processes
     def __getstate__(self):
         return self.size
@@ -80,63 +99,281 @@ class LRUCache(object):
         self.__init__(size)
 
     def __getitem__(self, key):
-        try:
-            link = self.cache[key]
-        except KeyError:
-            self.misses += 1
-            raise
+        with self._lock:
+            try:
+                link = self.cache[key]
+            except KeyError:
+                self.misses += 1
+                raise
 
-        # Disconnect the link from where it is
-        link.left.right = link.right
-        link.right.left = link.left
+            # Disconnect the link from where it is
+            link.left.right = link.right
+            link.right.left = link.left
 
-        # Insert the link at the end of the list
-        tail = self.listtail
-        link.left = tail.left
-        link.right = tail
-        tail.left.right = link
-        tail.left = link
+            # Insert the link at the end of the list
+            tail = self.listtail
+            link.left = tail.left
+            link.right = tail
+            tail.left.right = link
+            tail.left = link
 
-        self.hits += 1
-        return link.value
+            self.hits += 1
+            return link.value
 
     def __setitem__(self, key, value):
-        cache = self.cache
-        if key in cache:
-            # Shortcut this case
-            cache[key].value = value
-            return
-        if len(cache) >= self.size:
-            # Evict a node
-            link = self.listhead.right
-            del cache[link.key]
+        with self._lock:
+            cache = self.cache
+            if key in cache:
+                # Shortcut this case
+                cache[key].value = value
+                return
+            if len(cache) >= self.size:
+                # Evict a node
+                link = self.listhead.right
+                del cache[link.key]
+                link.left.right = link.right
+                link.right.left = link.left
+                d = self.destructor
+                if d:
+                    d(link.value)
+                del link
+
+            # The node doesn't exist already, and we have room for it. Let's do this.
+            tail = self.listtail
+            link = LRUCache._LinkNode(tail.left, tail,key,value)
+            tail.left.right = link
+            tail.left = link
+
+            cache[key] = link
+
+    def __delitem__(self, key):
+        # Used to flush the cache of this key
+        with self._lock:
+            cache = self.cache
+            link = cache[key]
+            del cache[key]
             link.left.right = link.right
             link.right.left = link.left
+            
+            # Call the destructor
             d = self.destructor
             if d:
                 d(link.value)
-            del link
 
-        # The node doesn't exist already, and we have room for it. Let's do this.
-        tail = self.listtail
-        link = LRUCache._LinkNode(tail.left, tail,key,value)
-        tail.left.right = link
-        tail.left = link
+# Arenas this process has created or attached to, by path. Worker processes
+# forked after a SharedChunkCache is created inherit this, and so reuse the
+# mapping instead of opening the file again.
+_shared_arenas = {}
 
-        cache[key] = link
+def _free_space(path):
+    """Returns the free space in bytes on the filesystem holding path, or
+    None if it can't be found out"""
+    try:
+        st = os.statvfs(path)
+    except (AttributeError, OSError):
+        return None
+    return st.f_bavail * st.f_frsize
 
-    def __delitem__(self, key):
-        # Used to flush the cache of this key
-        cache = self.cache
-        link = cache[key]
-        del cache[key]
-        link.left.right = link.right
-        link.right.left = link.left
-        
-        # Call the destructor
-        d = self.destructor
-        if d:
-            d(link.value)
+class SharedChunkCache(object):
+    """A cache that is shared between all the worker processes of a render,
+    so a chunk that one worker has decoded doesn't have to be decoded again
+    by the others.
+
+    Values are pickled (the section arrays stay packed, see
+    world.ChunkSection) into a memory mapped file, preferably on a tmpfs like
+    /dev/shm, if it has room for the whole file. The file is split into fixed-size slots, arranged into sets of
+    a few "ways" each like a CPU cache: a key can only live in one set, picked
+    by its hash, and when a set is full its least recently used entry is
+    replaced. Lookups and evictions therefore only touch a single set, which
+    is also the unit of locking between processes.
+
+    Values that don't fit in a slot are silently not cached.
+
+    Pickling this object (which is how the worker processes get their copy)
+    only pickles the location of the arena. If the arena can't be attached
+    to on unpickling, say in a worker on another machine, the cache is simply
+    always empty.
+
+    """
+    MAGIC = "OVCACHE1"
+    _header = struct.Struct("<8sIII")
+    # key digest, value length, padding, last use stamp
+    _entry = struct.Struct("<16sIIQ")
+
+    def __init__(self, size=256, slotsize=384*1024, ways=8):
+        """Create a new arena of about size megabytes, split into slots of
+        slotsize bytes in sets of the given number of ways.
+
+        """
+        sets = max(1, (size * 1024 * 1024) // (slotsize * ways))
+        self.hits = 0
+        self.misses = 0
+
+        self._init_layout(None, sets, ways, slotsize)
+        # the file is sparse, but touching a page a full tmpfs has no room
+        # for kills the process with SIGBUS, so /dev/shm is only used if
+        # the whole file fits
+        shmdir = None
+        if os.path.isdir("/dev/shm"):
+            free = _free_space("/dev/shm")
+            if free is not None and free >= self._length:
+                shmdir = "/dev/shm"
+            else:
+                logging.debug("Not enough room in /dev/shm for the shared chunk cache, using the temporary directory")
+        fd, path = tempfile.mkstemp(prefix="overviewer-chunkcache-", dir=shmdir)
+        os.close(fd)
+        self.path = path
+
+        f = open(path, "r+b")
+        # this leaves a sparse file, the memory is only used when a slot is
+        # first written
+        f.truncate(self._length)
+        m = mmap.mmap(f.fileno(), self._length)
+        m[0:self._header.size] = self._header.pack(self.MAGIC, sets, ways, slotsize)
+        _shared_arenas[path] = (f, m)
+        self._file = f
+        self._mmap = m
+
+        self._owner = os.getpid()
+        atexit.register(self.close)
+        logging.debug("Created a shared chunk cache of %d slots in %s", sets * ways, path)
+
+    def _init_layout(self, path, sets, ways, slotsize):
+        self.path = path
+        self.sets = sets
+        self.ways = ways
+        self.slotsize = slotsize
+        self._setstruct = struct.Struct("<" + "16sIIQ" * ways)
+        self._indexoffset = 64
+        self._dataoffset = self._indexoffset + sets * ways * self._entry.size
+        # start the slots on a page boundary
+        self._dataoffset += -self._dataoffset % mmap.PAGESIZE
+        self._length = self._dataoffset + sets * ways * slotsize
+
+    def __getstate__(self):
+        return (self.path, self.sets, self.ways, self.slotsize)
+    def __setstate__(self, state):
+        self._init_layout(*state)
+        self.hits = 0
+        self.misses = 0
+        self._owner = None
+        try:
+            f, m = _shared_arenas[self.path]
+        except KeyError:
+            try:
+                f = open(self.path, "r+b")
+                m = mmap.mmap(f.fileno(), self._length)
+            except (IOError, OSError, ValueError, mmap.error):
+                logging.debug("Could not attach to the shared chunk cache at %s, not using it", self.path)
+                f = m = None
+            else:
+                if m[0:self._header.size] != self._header.pack(self.MAGIC, self.sets, self.ways, self.slotsize):
+                    logging.debug("%s is not the expected shared chunk cache, not using it", self.path)
+                    m.close()
+                    f.close()
+                    f = m = None
+                else:
+                    _shared_arenas[self.path] = (f, m)
+        self._file = f
+        self._mmap = m
+
+    def close(self):
+        """Unmaps the arena, and removes it if this is the process that
+        created it. The cache can't be used after this."""
+        if self._mmap is None:
+            return
+        if _shared_arenas.get(self.path) == (self._file, self._mmap):
+            del _shared_arenas[self.path]
+        self._mmap.close()
+        self._file.close()
+        self._mmap = self._file = None
+        if self._owner == os.getpid():
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _lock(self, s):
+        # The locks are taken on bytes past the end of the mapped data, one
+        # per set. Windows locks are mandatory, and so can't overlap anything
+        # that is actually read.
+        if fcntl:
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_EX, 1, self._length + s)
+        else:
+            os.lseek(self._file.fileno(), self._length + s, 0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+    def _unlock(self, s):
+        if fcntl:
+            fcntl.lockf(self._file.fileno(), fcntl.LOCK_UN, 1, self._length + s)
+        else:
+            os.lseek(self._file.fileno(), self._length + s, 0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _find(self, digest):
+        """Returns the set the given key digest belongs in, and the offset of
+        that set's index entries"""
+        s = struct.unpack_from("<I", digest)[0] % self.sets
+        return s, self._indexoffset + s * self.ways * self._entry.size
+
+    def __getitem__(self, key):
+        m = self._mmap
+        if m is None:
+            self.misses += 1
+            raise KeyError(key)
+        digest = hashlib.md5(key).digest()
+        s, indexoffset = self._find(digest)
+        data = None
+        self._lock(s)
+        try:
+            entries = self._setstruct.unpack_from(m, indexoffset)
+            stamps = entries[3::4]
+            for way in xrange(self.ways):
+                if entries[way*4] == digest and entries[way*4+1]:
+                    slot = self._dataoffset + (s * self.ways + way) * self.slotsize
+                    data = m[slot:slot + entries[way*4+1]]
+                    self._entry.pack_into(m, indexoffset + way * self._entry.size,
+                            digest, entries[way*4+1], 0, max(stamps) + 1)
+                    break
+        finally:
+            self._unlock(s)
+
+        if data is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return cPickle.loads(data)
+
+    def __setitem__(self, key, value):
+        m = self._mmap
+        if m is None:
+            return
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slotsize:
+            return
+        digest = hashlib.md5(key).digest()
+        s, indexoffset = self._find(digest)
+        self._lock(s)
+        try:
+            entries = self._setstruct.unpack_from(m, indexoffset)
+            stamps = entries[3::4]
+            # replace this key if it's already here, otherwise use an empty
+            # slot, otherwise evict the least recently used one
+            for way in xrange(self.ways):
+                if entries[way*4] == digest:
+                    break
+            else:
+                for way in xrange(self.ways):
+                    if not entries[way*4+1]:
+                        break
+                else:
+                    way = stamps.index(min(stamps))
+
+            slot = self._dataoffset + (s * self.ways + way) * self.slotsize
+            m[slot:slot + len(data)] = data
+            self._entry.pack_into(m, indexoffset + way * self._entry.size,
+                    digest, len(data), 0, max(stamps) + 1)
+        finally:
+            self._unlock(s)
 
 # memcached is an option, but unless your IO costs are really high, it just
 # ends up adding overhead and isn't worth it.
@@ -151,6 +388,8 @@ else:
         def __init__(self, conn='127.0.0.1:11211'):
             self.conn = conn
             self.mc = memcache.Client([conn], debug=0, pickler=cPickle.Pickler, unpickler=cPickle.Unpickler)
+            self.hits = 0
+            self.misses = 0
 
         def __getstate__(self):
             return self.conn
@@ -160,7 +399,9 @@ else:
         def __getitem__(self, key):
             v = self.mc.get(key)
             if not v:
+                self.misses += 1
                 raise KeyError()
+            self.hits += 1
             return v
 
         def __setitem__(self, key, value):
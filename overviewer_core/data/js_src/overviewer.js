@@ -38,6 +38,11 @@ overviewer.collections = {
          */
         'markerInfo': {},
 
+        /**
+         * The requests for the marker shards that were fetched, by URL
+         */
+        'markerShards': {},
+
         /**
          * holds a reference to the spawn marker. 
          */
@@ -179,6 +179,23 @@ overviewer.util = {
         var s = document.getElementsByTagName('script')[0]; s.parentNode.appendChild(m);
     },
 
+    /**
+     * Fetches a marker shard written by genPOI --sharded-markers, and calls
+     * callback with it. Each shard is only fetched once, however many
+     * markerSets ask for it.
+     *
+     * @param string shards the name of the set of shards, from markersDB
+     * @param string name the region of the shard, as "x.z"
+     * @param function callback
+     */
+    'getMarkerShard': function(shards, name, callback) {
+        var url = 'markers/' + shards + '/r.' + name + '.json';
+        if (!overviewer.collections.markerShards[url]) {
+            overviewer.collections.markerShards[url] = jQuery.getJSON(url);
+        }
+        overviewer.collections.markerShards[url].done(callback);
+    },
+
     'initializeMarkers': function() {
         return;
 
@@ -414,6 +414,11 @@ overviewer.views.SignControlView = Backbone.View.extend({
 
         });
 
+        // load the marker shards that came into view
+        google.maps.event.addListener(overviewer.map, 'idle', function(event) {
+            me.loadShards();
+        });
+
     },
     /**
      * SignControlView::render
@@ -457,47 +462,9 @@ overviewer.views.SignControlView = Backbone.View.extend({
             var groupName = dataRoot[i].groupName;
             if (!dataRoot[i].created) {
                 dataRoot[i].markerObjs = [];
-                for (j in markersDB[groupName].raw) {
-                    var entity = markersDB[groupName].raw[j];
-                    if (entity['icon']) {
-                        iconURL = entity['icon'];
-                    } else {
-                        iconURL = dataRoot[i].icon;
-                    }
-                    var marker = new google.maps.Marker({
-                            'position': overviewer.util.fromWorldToLatLng(entity.x,
-                                entity.y, entity.z, overviewer.mapView.options.currentTileSet),
-                            'map':      overviewer.map,
-                            'title':    jQuery.trim(entity.hovertext), 
-                            'content':  jQuery.trim(entity.text),
-                            'icon':     iconURL,
-                            'visible':  false
-                    }); 
-                    if(entity['createInfoWindow'] == true) {
-                        overviewer.util.createMarkerInfoWindow(marker);
-                    } else {
-                        if(dataRoot[i].createInfoWindow == true) {
-                            overviewer.util.createMarkerInfoWindow(marker);
-                        }
-                    }
-                    dataRoot[i].markerObjs.push(marker);
-                    // Polyline stuff added by FreakusGeekus. Probably needs work.
-                    if (typeof entity['polyline'] != 'undefined') {
-						var polypath = new Array();
-                        for (point in entity.polyline) {
-                            polypath.push(overviewer.util.fromWorldToLatLng(entity.polyline[point].x, entity.polyline[point].y, entity.polyline[point].z, overviewer.mapView.options.currentTileSet));
-                        }
-                        
-                        var polyline = new google.maps.Polyline({
-								'path': polypath,
-                                'clickable': false,
-                                'map': overviewer.map,
-                                'visible': false,
-								'strokeColor': entity['strokeColor']
-                        });
-						dataRoot[i].markerObjs.push(polyline);
-                    }
-                }
+                dataRoot[i].loadedShards = {};
+                this.createMarkers(dataRoot[i], markersDB[groupName].raw,
+                    overviewer.mapView.options.currentTileSet);
                 dataRoot[i].created = true;
             }
         }
@@ -518,7 +485,110 @@ overviewer.views.SignControlView = Backbone.View.extend({
             }
         }
 
+        this.loadShards();
+
+    },
+    /**
+     * SignControlView::createMarkers
+     *
+     * Creates the markers for a list of entities of a markerSet, positioned
+     * for the given tileset. They start out visible if the markerSet is
+     * checked and the tileset is still the current one.
+     */
+    createMarkers: function(group, entities, tileSet) {
+        var visible = group.checked && group.created &&
+            tileSet == overviewer.mapView.options.currentTileSet;
+        for (j in entities) {
+            var entity = entities[j];
+            if (entity['icon']) {
+                iconURL = entity['icon'];
+            } else {
+                iconURL = group.icon;
+            }
+            var marker = new google.maps.Marker({
+                    'position': overviewer.util.fromWorldToLatLng(entity.x,
+                        entity.y, entity.z, tileSet),
+                    'map':      overviewer.map,
+                    'title':    jQuery.trim(entity.hovertext), 
+                    'content':  jQuery.trim(entity.text),
+                    'icon':     iconURL,
+                    'visible':  visible
+            }); 
+            if(entity['createInfoWindow'] == true) {
+                overviewer.util.createMarkerInfoWindow(marker);
+            } else {
+                if(group.createInfoWindow == true) {
+                    overviewer.util.createMarkerInfoWindow(marker);
+                }
+            }
+            group.markerObjs.push(marker);
+            // Polyline stuff added by FreakusGeekus. Probably needs work.
+            if (typeof entity['polyline'] != 'undefined') {
+                var polypath = new Array();
+                for (point in entity.polyline) {
+                    polypath.push(overviewer.util.fromWorldToLatLng(entity.polyline[point].x, entity.polyline[point].y, entity.polyline[point].z, tileSet));
+                }
+                
+                var polyline = new google.maps.Polyline({
+                        'path': polypath,
+                        'clickable': false,
+                        'map': overviewer.map,
+                        'visible': visible,
+                        'strokeColor': entity['strokeColor']
+                });
+                group.markerObjs.push(polyline);
+            }
+        }
+    },
+    /**
+     * SignControlView::loadShards
+     *
+     * When genPOI was run with --sharded-markers, the markers found in each
+     * region are in a shard of their own. This loads the shards of the
+     * regions in view that haven't been loaded yet, for the markerSets of
+     * the current tileset.
+     */
+    loadShards: function() {
+        if (typeof markerShards == "undefined") { return; }
+
+        var tileSet = overviewer.mapView.options.currentTileSet;
+        var dataRoot = markers[tileSet.get("path")];
+        var bounds = overviewer.map.getBounds();
+        if (!dataRoot || !bounds) { return; }
+
+        // find the regions under the corners of the viewport. That assumes
+        // Y=64, so take one more region on each side for markers higher up
+        // or further down
+        var ne = bounds.getNorthEast();
+        var sw = bounds.getSouthWest();
+        var corners = [[ne.lat(), ne.lng()], [ne.lat(), sw.lng()],
+                       [sw.lat(), ne.lng()], [sw.lat(), sw.lng()]];
+        var minx = Infinity, maxx = -Infinity, minz = Infinity, maxz = -Infinity;
+        for (c in corners) {
+            var point = overviewer.util.fromLatLngToWorld(corners[c][0], corners[c][1], tileSet);
+            minx = Math.min(minx, Math.floor(point.x / 512));
+            maxx = Math.max(maxx, Math.floor(point.x / 512));
+            minz = Math.min(minz, Math.floor(point.z / 512));
+            maxz = Math.max(maxz, Math.floor(point.z / 512));
+        }
 
+        var me = this;
+        jQuery.each(dataRoot, function(i, group) {
+            var shards = markersDB[group.groupName].shards;
+            if (!group.created || !shards || !markerShards[shards]) { return; }
+            for (var x = minx - 1; x <= maxx + 1; x++) {
+                for (var z = minz - 1; z <= maxz + 1; z++) {
+                    var name = x + "." + z;
+                    if (!markerShards[shards][name] || group.loadedShards[name]) { continue; }
+                    group.loadedShards[name] = true;
+                    overviewer.util.getMarkerShard(shards, name, function(data) {
+                        if (data[group.groupName]) {
+                            me.createMarkers(group, data[group.groupName], tileSet);
+                        }
+                    });
+                }
+            }
+        });
     },
     addItem: function(item) {
         var itemDiv = document.createElement('div');
@@ -14,11 +14,15 @@
 #    with the Overviewer.  If not, see <http://www.gnu.org/licenses/>.
 
 import util
+import sys
 import multiprocessing
 import multiprocessing.managers
 import cPickle as pickle
 import Queue
 import time
+import threading
+import logging
+from collections import deque
 from signals import Signal
 
 class Dispatcher(object):
@@ -31,12 +35,18 @@ class Dispatcher(object):
     def __init__(self):
         super(Dispatcher, self).__init__()
 
-        # list of (tileset, workitem) tuples
-        # keeps track of dispatched but unfinished jobs
-        self._running_jobs = []
-        # list of (tileset, workitem, dependencies) tuples
-        # keeps track of jobs waiting to run after dependencies finish
-        self._pending_jobs = []
+        # The jobs are kept as a dependency graph. Jobs are identified by
+        # (tileset, workitem) tuples.
+        #
+        # maps every job that hasn't finished yet, whether it's waiting, ready
+        # or running, to the list of jobs that are waiting for it
+        self._dependents = {}
+        # maps each job waiting for other jobs to the number of them that
+        # haven't finished yet
+        self._waiting_jobs = {}
+        # jobs whose dependencies have all finished, in the order they became
+        # ready, waiting to be dispatched
+        self._ready_jobs = deque()
 
     def render_all(self, tilesetlist, observer):
         """Render all of the tilesets in the given
@@ -76,47 +86,56 @@ class Dispatcher(object):
             observer.start(total_jobs)
             # go through these iterators round-robin style
             for tileset, (workitem, deps) in util.roundrobin(work_iterators):
-                self._pending_jobs.append((tileset, workitem, deps))
+                self._add_job(tileset, workitem, deps)
                 observer.add(self._dispatch_jobs())
 
             # after each phase, wait for the work to finish
-            while len(self._pending_jobs) > 0 or len(self._running_jobs) > 0:
-                observer.add(self._dispatch_jobs())
+            while self._dependents:
+                observer.add(self._dispatch_jobs(wait=True))
 
             observer.finish()
 
-    def _dispatch_jobs(self):
-        # helper function to dispatch pending jobs when their
-        # dependencies are met, and to manage self._running_jobs
-        dispatched_jobs = []
+    def _add_job(self, tileset, workitem, deps):
+        # helper function to add a job to the dependency graph. Only the
+        # dependencies that haven't finished yet count, and as dependencies
+        # are always added before the jobs that depend on them, those are
+        # exactly the ones in self._dependents.
+        job = (tileset, workitem)
+        unfinished = 0
+        for dep in deps:
+            dependents = self._dependents.get((tileset, dep))
+            if dependents is not None:
+                dependents.append(job)
+                unfinished += 1
+        self._dependents[job] = []
+        if unfinished:
+            self._waiting_jobs[job] = unfinished
+        else:
+            self._ready_jobs.append(job)
+
+    def _dispatch_jobs(self, wait=False):
+        # helper function to dispatch the jobs whose dependencies are met,
+        # and to update the dependency graph with the jobs that finished.
+        # wait is True once there are no more jobs to add in this phase.
         finished_jobs = []
-
-        pending_jobs_nodeps = [(j[0], j[1]) for j in self._pending_jobs]
-
-        for pending_job in self._pending_jobs:
-            tileset, workitem, deps = pending_job
-
-            # see if any of the deps are in _running_jobs or _pending_jobs
-            for dep in deps:
-                if (tileset, dep) in self._running_jobs or (tileset, dep) in pending_jobs_nodeps:
-                    # it is! don't dispatch this item yet
-                    break
-            else:
-                # it isn't! all dependencies are finished
+        ready_jobs = self._ready_jobs
+        if ready_jobs:
+            while ready_jobs:
+                tileset, workitem = ready_jobs.popleft()
                 finished_jobs += self.dispatch(tileset, workitem)
-                self._running_jobs.append((tileset, workitem))
-                dispatched_jobs.append(pending_job)
-
-        # make sure to at least get finished jobs, even if we don't
-        # submit any new ones...
-        if len(dispatched_jobs) == 0:
+        elif wait:
+            finished_jobs += self.wait_for_jobs()
+        else:
+            # make sure to at least get finished jobs, even if we don't
+            # submit any new ones...
             finished_jobs += self.dispatch(None, None)
 
-        # clean out the appropriate lists
         for job in finished_jobs:
-            self._running_jobs.remove(job)
-        for job in dispatched_jobs:
-            self._pending_jobs.remove(job)
+            for dependent in self._dependents.pop(job):
+                self._waiting_jobs[dependent] -= 1
+                if not self._waiting_jobs[dependent]:
+                    del self._waiting_jobs[dependent]
+                    ready_jobs.append(dependent)
 
         return len(finished_jobs)
 
@@ -145,10 +164,109 @@ class Dispatcher(object):
             return [(tileset, workitem),]
         return []
 
+    def wait_for_jobs(self):
+        """Like dispatch(None, None), but called when there is nothing
+        more to dispatch until some of the running jobs finish, so it
+        may block until at least one has.
+        """
+        return self.dispatch(None, None)
+
+class ThreadedDispatcher(Dispatcher):
+    """A subclass of Dispatcher that runs the jobs on a pool of threads
+    in this process. The threads all use the same tilesets, and so
+    share their textures, caches and region files, instead of each
+    worker process having a copy of its own.
+
+    Only one thread runs Python code at a time, but drawing the blocks,
+    the image compositing and resizing in the C extension, zlib and
+    PIL's image encoders let the other threads run meanwhile.
+    """
+    def __init__(self, threads):
+        """Creates the dispatcher, and starts the given number of
+        worker threads."""
+        super(ThreadedDispatcher, self).__init__()
+
+        self.outstanding_jobs = 0
+        self.job_queue = Queue.Queue()
+        self.result_queue = Queue.Queue()
+
+        self.pool = []
+        for i in xrange(threads):
+            thread = threading.Thread(target=self._work, name="worker %d" % i)
+            thread.daemon = True
+            thread.start()
+            self.pool.append(thread)
+
+    def _work(self):
+        # the work loop of each thread. Exceptions are passed on to the main
+        # thread along with the job, so they're raised from render_all()
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                # this is a end-of-jobs sentinel
+                return
+
+            tileset, workitem = job
+            try:
+                tileset.do_work(workitem)
+            except Exception:
+                self.result_queue.put((job, sys.exc_info()))
+            else:
+                self.result_queue.put((job, None))
+
+    def close(self):
+        while self.outstanding_jobs > 0:
+            self._handle_results(block=True)
+
+        # send of the end-of-jobs sentinels
+        for thread in self.pool:
+            self.job_queue.put(None)
+        for thread in self.pool:
+            thread.join()
+        self.pool = None
+
+    def dispatch(self, tileset, workitem):
+        # handle the no-new-work case
+        if tileset is None:
+            # only wait if every thread has a job
+            return self._handle_results(block=self.outstanding_jobs >= len(self.pool))
+
+        self.job_queue.put((tileset, workitem))
+        self.outstanding_jobs += 1
+
+        # make sure the queue doesn't fill up too much
+        finished_jobs = self._handle_results()
+        while self.outstanding_jobs > len(self.pool) * 10:
+            finished_jobs += self._handle_results(block=True)
+        return finished_jobs
+
+    def wait_for_jobs(self):
+        return self._handle_results(block=True)
+
+    def _handle_results(self, block=False):
+        # work function: takes results out of the result queue and keeps
+        # track of how many outstanding jobs remain. If block is True, waits
+        # until at least one job has finished.
+        finished_jobs = []
+        while True:
+            try:
+                job, exc_info = self.result_queue.get(block and not finished_jobs)
+            except Queue.Empty:
+                return finished_jobs
+            self.outstanding_jobs -= 1
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            finished_jobs.append(job)
+
 class MultiprocessingDispatcherManager(multiprocessing.managers.BaseManager):
     """This multiprocessing manager is responsible for giving worker
     processes access to the communication Queues, and also gives
     workers access to the current tileset list.
+
+    The worker processes started by the MultiprocessingDispatcher itself
+    only use it for the tileset list; their jobs and results go over pipes
+    instead. The queues are used by processes started with
+    start_manual_process().
     """
     def _get_job_queue(self):
         return self.job_queue
@@ -200,73 +318,161 @@ class MultiprocessingDispatcherProcess(multiprocessing.Process):
     automatically by MultiprocessingDispatcher, but it can even be
     used manually to spawn processes on different machines on the same
     network.
+
+    The local worker processes receive lists of jobs on a pipe of their
+    own, and send lists of results and intercepted signals back on a
+    queue shared with the other local workers. Manual processes take
+    their jobs one at a time from the manager's job queue instead.
     """
-    def __init__(self, manager):
+    # while it has more jobs to do, a local worker sends its results at
+    # least this often, in seconds
+    flush_interval = 0.05
+
+    def __init__(self, manager, worker_id=None, job_conn=None, result_queue=None):
         """Creates the process object. manager should be an instance
         of MultiprocessingDispatcherManager connected to the one
-        created in MultiprocessingDispatcher.
+        created in MultiprocessingDispatcher. For the local worker
+        processes, worker_id is the index of this process, job_conn
+        the receiving end of its job pipe, and result_queue the queue
+        to send results on.
         """
         super(MultiprocessingDispatcherProcess, self).__init__()
-        self.job_queue = manager.get_job_queue()
-        self.result_queue = manager.get_result_queue()
-        self.signal_queue = manager.get_signal_queue()
         self.tileset_proxy = manager.get_tileset_data()
 
+        self.worker_id = worker_id
+        self.job_conn = job_conn
+        if job_conn is None:
+            self.job_queue = manager.get_job_queue()
+            self.result_queue = manager.get_result_queue()
+            self.signal_queue = manager.get_signal_queue()
+        else:
+            self.name = "worker %d" % worker_id
+            self.result_queue = result_queue
+
+        # results and signals not yet sent to the dispatcher
+        self.outbox = []
+
     def update_tilesets(self):
         """A convenience function to update our local tilesets to the
         current version in use by the MultiprocessingDispatcher.
         """
         self.tilesets, self.tileset_version = self.tileset_proxy._getvalue()
 
+        # the caches are usually shared between the tilesets
+        self.caches = []
+        for tileset in self.tilesets:
+            for c in getattr(tileset, "get_caches", list)():
+                if not any(c is other for other in self.caches):
+                    self.caches.append(c)
+
+    def get_cache_stats(self):
+        """Returns a list of (cache name, hits, misses) tuples for the
+        caches used by this process' tilesets. Caches that don't count
+        their hits and misses show up with 0 for both."""
+        return [(c.__class__.__name__, getattr(c, "hits", 0), getattr(c, "misses", 0))
+                for c in self.caches]
+
+    def do_job(self, job):
+        """Unpacks the given job and does it, updating the tilesets
+        first if they changed."""
+        tv, ti, workitem = job
+
+        if tv != self.tileset_version:
+            # our tilesets changed!
+            self.update_tilesets()
+            assert tv == self.tileset_version
+
+        self.tilesets[ti].do_work(workitem)
+        return ti, workitem
+
+    def flush(self):
+        """Sends the results and signals collected so far to the
+        dispatcher."""
+        self.result_queue.put((self.worker_id, self.outbox, self.get_cache_stats()))
+        self.outbox = []
+
     def run(self):
-        """The main work loop. Jobs are pulled from the job queue and
-        executed, then the result is pushed onto the result
-        queue. Updates to the tilesetlist are recognized and handled
-        automatically. This is the method that actually runs in the
-        new worker process.
+        """The main work loop. Jobs are pulled from the job pipe (or
+        the job queue) and executed, then the result is pushed onto
+        the result queue. Updates to the tilesetlist are recognized and
+        handled automatically. This is the method that actually runs
+        in the new worker process.
         """
-        # per-process job get() timeout
-        timeout = 1.0
-
         # update our tilesets
         self.update_tilesets()
 
         # register for all available signals
         def register_signal(name, sig):
-            def handler(*args, **kwargs):
-                self.signal_queue.put((name, args, kwargs), False)
+            if self.job_conn is None:
+                def handler(*args, **kwargs):
+                    self.signal_queue.put((name, args, kwargs), False)
+            else:
+                def handler(*args, **kwargs):
+                    self.outbox.append(("signal", name, args, kwargs))
             sig.set_interceptor(handler)
         for name, sig in Signal.signals.iteritems():
             register_signal(name, sig)
 
+        if self.job_conn is None:
+            self._run_manual()
+        else:
+            self._run_local()
+
+    def _run_local(self):
+        # notify that we're starting up
+        self.result_queue.put((self.worker_id, None, None))
+
+        last_flush = time.time()
+        while True:
+            jobs = self.job_conn.recv()
+            if jobs is None:
+                # this is a end-of-jobs sentinel
+                return
+
+            for job in jobs:
+                ti, workitem = self.do_job(job)
+                self.outbox.append(("result", ti, workitem))
+                now = time.time()
+                if now - last_flush >= self.flush_interval:
+                    self.flush()
+                    last_flush = now
+
+            # The results are sent before waiting for more jobs. If more are
+            # already waiting, they can go along with those.
+            if self.outbox and not self.job_conn.poll():
+                self.flush()
+                last_flush = time.time()
+
+    def _run_manual(self):
         # notify that we're starting up
         self.result_queue.put(None, False)
         while True:
-            try:
-                job = self.job_queue.get(True, timeout)
-                if job == None:
-                    # this is a end-of-jobs sentinel
-                    return
-
-                # unpack job
-                tv, ti, workitem = job
-
-                if tv != self.tileset_version:
-                    # our tilesets changed!
-                    self.update_tilesets()
-                    assert tv == self.tileset_version
-
-                # do job
-                ret = self.tilesets[ti].do_work(workitem)
-                result = (ti, workitem, ret,)
-                self.result_queue.put(result, False)
-            except Queue.Empty:
-                pass
+            job = self.job_queue.get()
+            if job == None:
+                # this is a end-of-jobs sentinel
+                return
+
+            ti, workitem = self.do_job(job)
+            result = (ti, workitem, self.name, self.get_cache_stats())
+            self.result_queue.put(result, False)
 
 class MultiprocessingDispatcher(Dispatcher):
     """A subclass of Dispatcher that spawns worker processes and
     distributes jobs to them to speed up processing.
+
+    Jobs are spread over the local workers by their locality key (see
+    get_work_item_locality() in tileset.py), and wait in a queue kept
+    here for each worker. They're sent to the workers a few at a time,
+    keeping each a couple of batches ahead. A worker whose own queue
+    is empty takes jobs from the back of the longest other queue.
+    Processes started with start_manual_process() are kept supplied
+    the same way, through the manager's job queue.
     """
+    # number of jobs sent to a local worker at once
+    batch_size = 4
+    # number of batches a local worker is kept ahead
+    batches_ahead = 2
+
     def __init__(self, local_procs=-1, address=None, authkey=None):
         """Creates the dispatcher. local_procs should be the number of
         worker processes to spawn. If it's omitted (or negative)
@@ -287,25 +493,76 @@ class MultiprocessingDispatcher(Dispatcher):
         self.result_queue = self.manager.get_result_queue()
         self.signal_queue = self.manager.get_signal_queue()
 
+        # results from the local workers
+        self.local_result_queue = multiprocessing.Queue()
+
+        # Each locality key sticks to the worker that had the fewest jobs
+        # when it was first seen. Without local workers, all jobs go in the
+        # one queue the manual processes are supplied from.
+        self.locality_workers = {}
+        self.queued_jobs = [deque() for i in xrange(max(1, self.local_procs))]
+        # number of jobs sent to each local worker that haven't finished
+        self.sent_jobs = [0] * self.local_procs
+        # local workers that could take more jobs than they have
+        self.hungry_workers = set(xrange(self.local_procs))
+
+        # manual processes, and the jobs given to them that haven't finished
+        self.manual_workers = 0
+        self.manual_jobs = 0
+        self.last_manual_check = 0
+
+        # the latest cache statistics reported by each worker process
+        self.cache_stats = {}
+
+        # set once a local worker died, see _check_workers()
+        self.broken = False
+
         # create and fill the pool
         self.pool = []
+        self.job_conns = []
         for i in xrange(self.local_procs):
-            proc = MultiprocessingDispatcherProcess(self.manager)
+            reader, writer = multiprocessing.Pipe(False)
+            proc = MultiprocessingDispatcherProcess(self.manager, i, reader, self.local_result_queue)
             proc.start()
+            reader.close()
             self.pool.append(proc)
+            self.job_conns.append(writer)
 
     def close(self):
-        # empty the queue
-        self._handle_messages(timeout=0.0)
+        if self.broken:
+            # the jobs of a worker that died will never finish, so don't
+            # wait for them or the other workers
+            for proc in self.pool:
+                proc.terminate()
+                proc.join()
+            self.manager.shutdown()
+            self.manager = None
+            self.pool = None
+            return
+
         while self.outstanding_jobs > 0:
-            self._handle_messages()
+            self._handle_messages(block=True)
 
-        # send of the end-of-jobs sentinel
-        for p in xrange(self.num_workers):
+        # send of the end-of-jobs sentinels
+        for conn in self.job_conns:
+            conn.send(None)
+            conn.close()
+        for p in xrange(self.manual_workers):
             self.job_queue.put(None, False)
 
-        # TODO better way to be sure worker processes get the message
-        time.sleep(1)
+        for proc in self.pool:
+            proc.join()
+
+        # the manual processes still need the manager to get their sentinels
+        if self.manual_workers:
+            deadline = time.time() + 1.0
+            while not self.job_queue.empty() and time.time() < deadline:
+                time.sleep(0.01)
+
+        for name in sorted(self.cache_stats):
+            for cachename, hits, misses in self.cache_stats[name]:
+                logging.debug("%s: %s: %s hits, %s misses (%.1f%% hits)", name,
+                        cachename, hits, misses, 100.0 * hits / max(1, hits + misses))
 
         # and close the manager
         self.manager.shutdown()
@@ -314,60 +571,176 @@ class MultiprocessingDispatcher(Dispatcher):
 
     def setup_tilesets(self, tilesets):
         self.manager.set_tilesets(tilesets)
+        self.locality_workers = {}
 
     def dispatch(self, tileset, workitem):
         # handle the no-new-work case
         if tileset is None:
-            return self._handle_messages()
+            # only wait if no worker could take more jobs
+            return self._handle_messages(block=not self.hungry_workers)
 
-        # create and submit the job
+        # create and queue the job
         tileset_index = self.manager.tilesets.index(tileset)
-        self.job_queue.put((self.manager.tileset_version, tileset_index, workitem), False)
+        job = (self.manager.tileset_version, tileset_index, workitem)
+        worker = self._get_worker(tileset, tileset_index, workitem)
+        self.queued_jobs[worker].append(job)
         self.outstanding_jobs += 1
+        self._send_jobs([worker] if self.local_procs else [])
 
         # make sure the queue doesn't fill up too much
-        finished_jobs = self._handle_messages(timeout=0.0)
+        finished_jobs = self._handle_messages()
         while self.outstanding_jobs > self.num_workers * 10:
-            finished_jobs += self._handle_messages()
+            finished_jobs += self._handle_messages(block=True)
         return finished_jobs
 
-    def _handle_messages(self, timeout=0.01):
-        # work function: takes results out of the result queue and
-        # keeps track of how many outstanding jobs remain
+    def wait_for_jobs(self):
+        return self._handle_messages(block=True)
+
+    def _get_worker(self, tileset, tileset_index, workitem):
+        # Returns the index of the queue this job should go on
+        if self.local_procs < 2 or not hasattr(tileset, "get_work_item_locality"):
+            return 0
+        key = (tileset_index, tileset.get_work_item_locality(workitem))
+        worker = self.locality_workers.get(key)
+        if worker is None:
+            loads = [len(q) + n for q, n in zip(self.queued_jobs, self.sent_jobs)]
+            worker = loads.index(min(loads))
+            self.locality_workers[key] = worker
+        return worker
+
+    def _take_jobs(self, worker, count):
+        # Takes up to count jobs from the front of the given worker's queue,
+        # or if that is empty, from the back of the longest queue
+        queue = self.queued_jobs[worker] if worker is not None else None
+        if queue:
+            take = queue.popleft
+        else:
+            queue = max(self.queued_jobs, key=len)
+            take = queue.pop
+        jobs = []
+        while queue and len(jobs) < count:
+            jobs.append(take())
+        return jobs
+
+    def _send_jobs(self, workers):
+        # Sends jobs to the given local workers, and to any that ran out of
+        # them, until they are batches_ahead batches ahead. The manual
+        # processes are kept two jobs ahead.
+        limit = self.batch_size * (self.batches_ahead - 1)
+        for worker in self.hungry_workers.union(workers):
+            while self.sent_jobs[worker] <= limit:
+                jobs = self._take_jobs(worker, self.batch_size)
+                if not jobs:
+                    self.hungry_workers.add(worker)
+                    break
+                self.hungry_workers.discard(worker)
+                self.job_conns[worker].send(jobs)
+                self.sent_jobs[worker] += len(jobs)
+
+        while self.manual_jobs < self.manual_workers * 2:
+            jobs = self._take_jobs(None, 1)
+            if not jobs:
+                break
+            self.job_queue.put(jobs[0], False)
+            self.manual_jobs += 1
+
+    def _handle_messages(self, block=False):
+        # work function: takes results out of the result queues and
+        # keeps track of how many outstanding jobs remain. If block is
+        # True, waits until at least one job has finished.
         finished_jobs = []
+        workers = set()
+        while True:
+            self._handle_local_messages(finished_jobs, workers, block and not finished_jobs)
+            # the manager's queues are only checked every second until the
+            # first manual process shows up
+            now = time.time()
+            if self.manual_workers or now - self.last_manual_check >= 1.0:
+                self.last_manual_check = now
+                self._handle_manual_messages(finished_jobs)
+
+            if workers or self.hungry_workers or self.manual_workers:
+                self._send_jobs(workers)
+                workers.clear()
+            if finished_jobs or not block:
+                break
+        return finished_jobs
 
-        result_empty = False
-        signal_empty = False
-        while not (result_empty and signal_empty):
-            if not result_empty:
-                try:
-                    result = self.result_queue.get(False)
-
-                    if result != None:
-                        # completed job
-                        ti, workitem, ret = result
-                        finished_jobs.append((self.manager.tilesets[ti], workitem))
-                        self.outstanding_jobs -= 1
-                    else:
-                        # new worker
-                        self.num_workers += 1
-                except Queue.Empty:
-                    result_empty = True
-            if not signal_empty:
-                try:
-                    if timeout > 0.0:
-                        name, args, kwargs = self.signal_queue.get(True, timeout)
-                    else:
-                        name, args, kwargs = self.signal_queue.get(False)
-                    # timeout should only apply once
-                    timeout = 0.0
-
+    def _handle_local_messages(self, finished_jobs, workers, block):
+        # Takes the messages from the local workers off their result queue,
+        # adding the finished jobs to finished_jobs and the workers they came
+        # from to workers. If block is True, waits for one message, checking
+        # the manual processes' results every now and then.
+        timeout = None
+        if block:
+            timeout = 0.01 if self.manual_workers else 1.0
+        while True:
+            try:
+                if timeout is not None:
+                    message = self.local_result_queue.get(True, timeout)
+                    timeout = None
+                else:
+                    message = self.local_result_queue.get(False)
+            except Queue.Empty:
+                if block and timeout is not None:
+                    self._check_workers()
+                return
+
+            worker, messages, cache_stats = message
+            if messages is None:
+                # new worker
+                self.num_workers += 1
+                continue
+
+            self.cache_stats[self.pool[worker].name] = cache_stats
+            workers.add(worker)
+            for message in messages:
+                if message[0] == "result":
+                    kind, ti, workitem = message
+                    finished_jobs.append((self.manager.tilesets[ti], workitem))
+                    self.outstanding_jobs -= 1
+                    self.sent_jobs[worker] -= 1
+                else:
+                    kind, name, args, kwargs = message
                     sig = Signal.signals[name]
                     sig.emit_intercepted(*args, **kwargs)
-                except Queue.Empty:
-                    signal_empty = True
 
-        return finished_jobs
+    def _check_workers(self):
+        # the local workers should never exit before close(), and if one
+        # has, its jobs will never finish
+        for proc in self.pool:
+            if not proc.is_alive():
+                self.broken = True
+                raise RuntimeError("%s exited unexpectedly (exit code %s)" % (proc.name, proc.exitcode))
+
+    def _handle_manual_messages(self, finished_jobs):
+        # Takes the results and signals from the manual processes out of the
+        # manager's queues
+        while True:
+            try:
+                result = self.result_queue.get(False)
+            except Queue.Empty:
+                break
+
+            if result != None:
+                # completed job
+                ti, workitem, name, cache_stats = result
+                finished_jobs.append((self.manager.tilesets[ti], workitem))
+                self.outstanding_jobs -= 1
+                self.manual_jobs -= 1
+                self.cache_stats[name] = cache_stats
+            else:
+                # new worker
+                self.num_workers += 1
+                self.manual_workers += 1
+
+        while True:
+            try:
+                name, args, kwargs = self.signal_queue.get(False)
+            except Queue.Empty:
+                break
+            sig = Signal.signals[name]
+            sig.emit_intercepted(*args, **kwargs)
 
     @classmethod
     def start_manual_process(cls, address, authkey):
@@ -17,16 +17,23 @@ import gzip, zlib
 import struct
 import StringIO
 import functools
+import mmap
+
+# the compiled NBT decoder, if the c extension is built (and new enough)
+try:
+    from c_overviewer import nbt_load as _c_nbt_load
+except ImportError:
+    _c_nbt_load = None
 
 # decorator that turns the first argument from a string into an open file
 # handle
 def _file_loader(func):
     @functools.wraps(func)
-    def wrapper(fileobj, *args):
+    def wrapper(fileobj, *args, **kwargs):
         if isinstance(fileobj, basestring):
             # Is actually a filename
             fileobj = open(fileobj, 'rb', 4096)
-        return func(fileobj, *args)
+        return func(fileobj, *args, **kwargs)
     return wrapper
 
 @_file_loader
@@ -37,10 +44,11 @@ def load(fileobj):
     return NBTFileReader(fileobj).read_all()
 
 @_file_loader
-def load_region(fileobj):
+def load_region(fileobj, use_mmap=False):
     """Reads in the given file as a MCR region, and returns an object
-    for accessing the chunks inside."""
-    return MCRFileReader(fileobj)
+    for accessing the chunks inside. If use_mmap is True, the region
+    file is memory-mapped instead of read through the file handle."""
+    return MCRFileReader(fileobj, use_mmap=use_mmap)
 
 
 class CorruptionError(Exception):
@@ -69,11 +77,19 @@ class NBTFileReader(object):
     _long   = struct.Struct(">q")
     _float  = struct.Struct(">f")
     _double = struct.Struct(">d") 
+
+    # the payload sizes of the tag types that always have the same size
+    _fixed_sizes = {0: 0, 1: 1, 2: 2, 3: 4, 4: 8, 5: 4, 6: 8}
  
-    def __init__(self, fileobj, is_gzip=True):
+    def __init__(self, fileobj, is_gzip=True, skip=()):
         """Create a NBT parsing object with the given file-like
         object. Setting is_gzip to False parses the file as a zlib
-        stream instead."""
+        stream instead.
+
+        skip is a collection of tag names to leave out of every compound:
+        these tags are read past without decoding them at all.
+        """
+        self._skip = skip
         if is_gzip:
             self._file = gzip.GzipFile(fileobj=fileobj, mode='rb')
         else:
@@ -165,10 +181,48 @@ class NBTFileReader(object):
                 break
 
             name = self._read_tag_string()
+            if name in self._skip:
+                self._skip_tag(tagtype)
+                continue
             payload = self._read_tagmap[tagtype]()
             tags[name] = payload
 
         return tags
+
+    def _skip_bytes(self, length):
+        if length < 0 or len(self._file.read(length)) != length:
+            raise ValueError("unexpected end of nbt data")
+
+    def _skip_tag(self, tagtype):
+        # Reads past the payload of a tag of the given type, going by the
+        # lengths in it rather than building anything
+        if tagtype in self._fixed_sizes:
+            self._skip_bytes(self._fixed_sizes[tagtype])
+        elif tagtype == 7:
+            self._skip_bytes(self._read_tag_int())
+        elif tagtype == 8:
+            self._skip_bytes(self._read_tag_short())
+        elif tagtype == 9:
+            itemtype = self._read_tag_byte()
+            length = self._read_tag_int()
+            if length <= 0:
+                return
+            if itemtype in self._fixed_sizes:
+                self._skip_bytes(length * self._fixed_sizes[itemtype])
+            else:
+                for _ in xrange(length):
+                    self._skip_tag(itemtype)
+        elif tagtype == 10:
+            while True:
+                itemtype = ord(self._file.read(1))
+                if itemtype == 0:
+                    break
+                self._skip_bytes(self._read_tag_short())
+                self._skip_tag(itemtype)
+        elif tagtype == 11:
+            self._skip_bytes(self._read_tag_int() * 4)
+        else:
+            raise ValueError("unknown nbt tag type: %i" % tagtype)
     
     def read_all(self):
         """Reads the entire file and returns (name, payload)
@@ -190,6 +244,27 @@ class NBTFileReader(object):
         except (struct.error, ValueError), e:
             raise CorruptNBTError("could not parse nbt: %s" % (str(e),))
 
+def _load_compressed(data, is_gzip=True, skip=()):
+    """Decompresses and parses the given string (or buffer) of NBT data,
+    and returns the result as a (name, data) tuple. This uses the
+    compiled decoder when it's available, and NBTFileReader otherwise.
+    Tags named in skip are left out, see NBTFileReader.
+    """
+    if _c_nbt_load is None:
+        # data may be a buffer, which StringIO won't take
+        return NBTFileReader(StringIO.StringIO(str(data)), is_gzip=is_gzip, skip=skip).read_all()
+
+    if is_gzip:
+        # 16 + MAX_WBITS tells zlib to expect a gzip header
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    else:
+        data = zlib.decompress(data)
+
+    try:
+        return _c_nbt_load(data, skip)
+    except ValueError, e:
+        raise CorruptNBTError("could not parse nbt: %s" % (str(e),))
+
 # For reference, the MCR format is outlined at
 # <http://www.minecraftwiki.net/wiki/Beta_Level_Format>
 class MCRFileReader(object):
@@ -203,10 +278,35 @@ class MCRFileReader(object):
     _timestamp_table_format = struct.Struct(">1024i")
     _chunk_header_format = struct.Struct(">I B")
     
-    def __init__(self, fileobj):
+    def __init__(self, fileobj, use_mmap=False):
         """This creates a region object from the given file-like
-        object. Chances are you want to use load_region instead."""
+        object. Chances are you want to use load_region instead.
+
+        If use_mmap is True and fileobj is a real file, the file is
+        memory-mapped and closed, and the tables and chunks are read
+        straight out of the map. Otherwise (or if mapping fails, as it
+        does for empty files) it is read with seek() and read().
+        """
         self._file = fileobj
+        self._map = None
+        
+        if use_mmap:
+            try:
+                self._map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            except (AttributeError, ValueError, EnvironmentError):
+                self._map = None
+        
+        if self._map is not None:
+            # the map stays valid without the file handle
+            self._file.close()
+            self._file = None
+            
+            if len(self._map) < 8192:
+                self.close()
+                raise CorruptRegionError("invalid location table")
+            self._locations = self._location_table_format.unpack_from(self._map, 0)
+            self._timestamps = self._timestamp_table_format.unpack_from(self._map, 4096)
+            return
         
         # read in the location table
         location_data = self._file.read(4096)
@@ -227,8 +327,12 @@ class MCRFileReader(object):
         results in undefined behaviour.
         """
         
-        self._file.close()
-        self._file = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        else:
+            self._file.close()
+            self._file = None
 
     def get_chunks(self):    
         """Return an iterator of all chunks contained in this region
@@ -240,6 +344,12 @@ class MCRFileReader(object):
                 if self._locations[x + z * 32] >> 8 != 0:
                     yield (x,z)
         
+    def get_chunk_table(self):
+        """Return the location and timestamp tables of this region file,
+        as two sequences of 1024 integers indexed by x + z * 32. A chunk
+        exists if its location is 256 or more (see chunk_exists())."""
+        return self._locations, self._timestamps
+
     def get_chunk_timestamp(self, x, z):
         """Return the given chunk's modification time. If the given
         chunk doesn't exist, this number may be nonsense. Like
@@ -255,13 +365,16 @@ class MCRFileReader(object):
         z = z % 32
         return self._locations[x + z * 32] >> 8 != 0
 
-    def load_chunk(self, x, z):
+    def load_chunk(self, x, z, skip=()):
         """Return a (name, data) tuple for the given chunk, or
         None if the given chunk doesn't exist in this region file. If
         you provide an x or z not between 0 and 31, it will be
         modulo'd into this range (x % 32, etc.) This is so you can
         provide chunk coordinates in global coordinates, and still
-        have the chunks load out of regions properly."""
+        have the chunks load out of regions properly.
+
+        Tags named in skip are left out of the result without being
+        decoded, see NBTFileReader."""
         x = x % 32
         z = z % 32
         location = self._locations[x + z * 32]
@@ -271,14 +384,19 @@ class MCRFileReader(object):
         if offset == 0:
             return None
         
-        # seek to the data
-        self._file.seek(offset)
-        
-        # read in the chunk data header
-        header = self._file.read(5)
-        if len(header) != 5:
-            raise CorruptChunkError("chunk header is invalid")
-        data_length, compression =  self._chunk_header_format.unpack(header)
+        if self._map is not None:
+            if offset + 5 > len(self._map):
+                raise CorruptChunkError("chunk header is invalid")
+            data_length, compression = self._chunk_header_format.unpack_from(self._map, offset)
+        else:
+            # seek to the data
+            self._file.seek(offset)
+            
+            # read in the chunk data header
+            header = self._file.read(5)
+            if len(header) != 5:
+                raise CorruptChunkError("chunk header is invalid")
+            data_length, compression =  self._chunk_header_format.unpack(header)
         
         # figure out the compression
         is_gzip = True
@@ -292,15 +410,20 @@ class MCRFileReader(object):
             # unsupported!
             raise CorruptRegionError("unsupported chunk compression type: %i (should be 1 or 2)" % (compression,))
         
-        # turn the rest of the data into a StringIO object
+        # read in the rest of the data
         # (using data_length - 1, as we already read 1 byte for compression)
-        data = self._file.read(data_length - 1)
-        if len(data) != data_length - 1:
-            raise CorruptRegionError("chunk length is invalid")
-        data = StringIO.StringIO(data)
+        if self._map is not None:
+            # a buffer into the map, so zlib reads it without a copy
+            if data_length < 1 or offset + 4 + data_length > len(self._map):
+                raise CorruptRegionError("chunk length is invalid")
+            data = buffer(self._map, offset + 5, data_length - 1)
+        else:
+            data = self._file.read(data_length - 1)
+            if len(data) != data_length - 1:
+                raise CorruptRegionError("chunk length is invalid")
         
         try:
-            return NBTFileReader(data, is_gzip=is_gzip).read_all()
+            return _load_compressed(data, is_gzip=is_gzip, skip=skip)
         except CorruptionError:
             raise
         except Exception, e:
@@ -77,6 +77,7 @@ renders = Setting(required=True, default=util.OrderedDict(),
             "texturepath": Setting(required=False, validator=validateTexturePath, default=None),
             "renderchecks": Setting(required=False, validator=validateInt, default=None),
             "rerenderprob": Setting(required=True, validator=validateRerenderprob, default=0),
+            "renderbatch": Setting(required=False, validator=validateRenderBatch, default=0),
             "crop": Setting(required=False, validator=validateCrop, default=None),
             "changelist": Setting(required=False, validator=validateStr, default=None),
             "markers": Setting(required=False, validator=validateMarkers, default=[]),
@@ -102,6 +103,12 @@ outputdir = Setting(required=True, validator=validateOutputDir, default=None)
 
 processes = Setting(required=True, validator=int, default=-1)
 
+# render with this many threads in one process instead of worker processes
+threads = Setting(required=True, validator=int, default=1)
+
+# size in megabytes of the chunk cache shared between worker processes
+sharedcachesize = Setting(required=True, validator=int, default=256)
+
 # memcached is an option, but unless your IO costs are really high, it just
 # ends up adding overhead and isn't worth it.
 memcached_host = Setting(required=False, validator=str, default=None)
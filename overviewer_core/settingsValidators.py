@@ -121,6 +121,15 @@ def validateRerenderprob(s):
         raise ValidationException("%r is not a valid rerender probability value.  Should be between 0.0 and 1.0." % s)
     return val
 
+def validateRenderBatch(batch):
+    try:
+        batch = int(batch)
+    except (ValueError, TypeError):
+        raise ValidationException("%r is not a valid renderbatch value. Should be an integer between 0 and 3." % batch)
+    if batch < 0 or batch > 3:
+        raise ValidationException("%r is not a valid renderbatch value. Should be an integer between 0 and 3." % batch)
+    return batch
+
 def validateImgFormat(fmt):
     if fmt not in ("png", "jpg", "jpeg"):
         raise ValidationException("%r is not a valid image format" % fmt)
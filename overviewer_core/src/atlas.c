@@ -0,0 +1,200 @@
+/*
+ * This file is part of the Minecraft Overviewer.
+ *
+ * Minecraft Overviewer is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License as published
+ * by the Free Software Foundation, either version 3 of the License, or (at
+ * your option) any later version.
+ *
+ * Minecraft Overviewer is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License along
+ * with the Overviewer.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * The block atlas is Textures.blockmap worked out once into a C array, so
+ * chunk_render can find the image for a block without any python calls,
+ * and draw_sprite can draw it without checking the image every time.
+ *
+ * It's built the first time a Textures object is rendered with, and kept
+ * in its blockatlas attribute until the blockmap is replaced.
+ */
+
+#include "overviewer.h"
+
+static void
+free_block_atlas(BlockAtlas *atlas) {
+    unsigned int i;
+
+    if (atlas->sprites) {
+        for (i = 0; i < atlas->num_sprites; i++) {
+            Py_XDECREF(atlas->sprites[i].tex);
+        }
+        free(atlas->sprites);
+    }
+    if (atlas->spans)
+        free(atlas->spans);
+    Py_XDECREF(atlas->blockmap);
+    free(atlas);
+}
+
+static void
+block_atlas_destructor(PyObject *capsule) {
+    free_block_atlas(BLOCK_ATLAS(capsule));
+}
+
+/* works out the spans of each row of a sprite, see BlockSprite */
+static void
+find_spans(BlockSprite *sprite) {
+    Imaging src = sprite->imsrc;
+    int x, y;
+
+    for (y = 0; y < src->ysize; y++) {
+        UINT8 *in = (UINT8 *)src->image[y];
+        unsigned short *span = sprite->spans + 3 * y;
+        int first = -1, last = -1, opaque = 1;
+
+        for (x = 0; x < src->xsize; x++) {
+            if (in[x * 4 + 3] != 0) {
+                if (first < 0)
+                    first = x;
+                last = x;
+            }
+        }
+        if (first < 0) {
+            span[0] = span[1] = span[2] = 0;
+            continue;
+        }
+
+        for (x = first; x <= last; x++) {
+            if (in[x * 4 + 3] != 255) {
+                opaque = 0;
+                break;
+            }
+        }
+        span[0] = first;
+        span[1] = last + 1;
+        span[2] = opaque;
+    }
+}
+
+static BlockAtlas *
+build_block_atlas(PyObject *blockmap) {
+    BlockAtlas *atlas;
+    Py_ssize_t count, rows = 0;
+    unsigned short *spans;
+    Py_ssize_t i;
+
+    count = PyList_GET_SIZE(blockmap);
+    atlas = calloc(1, sizeof(BlockAtlas));
+    if (atlas == NULL)
+        return (BlockAtlas *)PyErr_NoMemory();
+    Py_INCREF(blockmap);
+    atlas->blockmap = blockmap;
+    atlas->num_sprites = count;
+    atlas->sprites = calloc(count ? count : 1, sizeof(BlockSprite));
+    if (atlas->sprites == NULL) {
+        free_block_atlas(atlas);
+        return (BlockAtlas *)PyErr_NoMemory();
+    }
+
+    for (i = 0; i < count; i++) {
+        BlockSprite *sprite = &(atlas->sprites[i]);
+        PyObject *tex = PyList_GET_ITEM(blockmap, i);
+        Imaging src;
+
+        if (!PyTuple_Check(tex) || PyTuple_GET_SIZE(tex) < 2)
+            continue;
+
+        Py_INCREF(tex);
+        sprite->tex = tex;
+        sprite->src = PyTuple_GET_ITEM(tex, 0);
+        sprite->mask_light = PyTuple_GET_ITEM(tex, 1);
+
+        /* anything that isn't a plain RGBA image is left to alpha_over */
+        src = imaging_python_to_c(sprite->src);
+        if (src == NULL) {
+            PyErr_Clear();
+            continue;
+        }
+        if (strcmp(src->mode, "RGBA") != 0 || src->xsize > 0xffff)
+            continue;
+        sprite->imsrc = src;
+        rows += src->ysize;
+    }
+
+    atlas->spans = spans = malloc((rows ? rows : 1) * 3 * sizeof(unsigned short));
+    if (spans == NULL) {
+        free_block_atlas(atlas);
+        return (BlockAtlas *)PyErr_NoMemory();
+    }
+    for (i = 0; i < count; i++) {
+        BlockSprite *sprite = &(atlas->sprites[i]);
+        if (sprite->imsrc) {
+            sprite->spans = spans;
+            find_spans(sprite);
+            spans += sprite->imsrc->ysize * 3;
+        }
+    }
+
+    /* blocks without an image for their data are drawn with the image
+       for data 0, so look that up now */
+    if (max_data > 0) {
+        for (i = 0; i < count; i++) {
+            BlockSprite *sprite = &(atlas->sprites[i]);
+            Py_ssize_t fallback = i - i % max_data;
+            if (sprite->tex == NULL && fallback != i && atlas->sprites[fallback].tex != NULL) {
+                *sprite = atlas->sprites[fallback];
+                Py_INCREF(sprite->tex);
+            }
+        }
+    }
+
+    return atlas;
+}
+
+/* returns a new reference to the capsule holding the atlas for the given
+ * Textures object, building it if needed. NULL on error */
+PyObject *
+get_block_atlas(PyObject *textures) {
+    PyObject *blockmap, *capsule;
+    BlockAtlas *atlas;
+
+    blockmap = PyObject_GetAttrString(textures, "blockmap");
+    if (blockmap == NULL)
+        return NULL;
+    if (!PyList_Check(blockmap)) {
+        Py_DECREF(blockmap);
+        PyErr_SetString(PyExc_RuntimeError, "you must call Textures.generate()");
+        return NULL;
+    }
+
+    capsule = PyObject_GetAttrString(textures, "blockatlas");
+    if (capsule == NULL) {
+        PyErr_Clear();
+    } else if (PyCapsule_CheckExact(capsule) && BLOCK_ATLAS(capsule)->blockmap == blockmap) {
+        Py_DECREF(blockmap);
+        return capsule;
+    } else {
+        Py_DECREF(capsule);
+    }
+
+    atlas = build_block_atlas(blockmap);
+    Py_DECREF(blockmap);
+    if (atlas == NULL)
+        return NULL;
+    capsule = PyCapsule_New(atlas, NULL, block_atlas_destructor);
+    if (capsule == NULL) {
+        free_block_atlas(atlas);
+        return NULL;
+    }
+    if (PyObject_SetAttrString(textures, "blockatlas", capsule) < 0) {
+        Py_DECREF(capsule);
+        return NULL;
+    }
+    return capsule;
+}
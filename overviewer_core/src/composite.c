@@ -98,6 +98,40 @@ inline PyObject* alpha_over(PyObject *dest, PyObject *src, PyObject *mask,
     return alpha_over_full(dest, src, mask, 1.0f, dx, dy, xsize, ysize);
 }
 
+/* blends the RGB pixel at in over the RGBA pixel at out, with in_alpha as
+ * the source alpha */
+static inline void
+blend_pixel(UINT8 *out, UINT8 *in, UINT8 in_alpha) {
+    int i, tmp1, tmp2, tmp3;
+
+    /* special cases */
+    if (in_alpha == 255 || (out[3] == 0 && in_alpha > 0)) {
+        out[0] = in[0];
+        out[1] = in[1];
+        out[2] = in[2];
+        out[3] = in_alpha;
+    } else if (in_alpha == 0) {
+        /* do nothing -- source is fully transparent */
+    } else {
+        /* general case */
+        int alpha = in_alpha + MULDIV255(out[3], 255 - in_alpha, tmp1);
+        for (i = 0; i < 3; i++) {
+            out[i] = MULDIV255(in[i], in_alpha, tmp1) +
+                MULDIV255(MULDIV255(out[i], out[3], tmp2), 255 - in_alpha, tmp3);
+            
+            out[i] = (out[i] * 255) / alpha;
+        }
+
+        out[3] = alpha;
+    }
+}
+
+/* alpha_over releases the GIL while blending areas at least this big, so
+ * other threads can run meanwhile. Smaller areas, like the block sprites
+ * drawn by render_loop, aren't worth the switch.
+ */
+#define ALPHA_OVER_NOGIL_AREA (64 * 64)
+
 /* the full alpha_over function, in a form that can be called from C
  * overall_alpha is multiplied with the whole mask, useful for lighting...
  * if xsize, ysize are negative, they are instead set to the size of the image in src
@@ -113,11 +147,13 @@ alpha_over_full(PyObject *dest, PyObject *src, PyObject *mask, float overall_alp
     /* source position */
     int sx, sy;
     /* iteration variables */
-    unsigned int x, y, i;
+    unsigned int x, y;
     /* temporary calculation variables */
-    int tmp1, tmp2, tmp3;
+    int tmp1;
     /* integer [0, 255] version of overall_alpha */
     UINT8 overall_alpha_int = 255 * overall_alpha;
+    /* saved thread state, if the GIL was released */
+    PyThreadState *save = NULL;
     
     /* short-circuit this whole thing if overall_alpha is zero */
     if (overall_alpha_int == 0)
@@ -172,6 +208,10 @@ alpha_over_full(PyObject *dest, PyObject *src, PyObject *mask, float overall_alp
         return dest;
     }
 
+    /* from here on, only the pixels are touched */
+    if (xsize * ysize >= ALPHA_OVER_NOGIL_AREA)
+        save = PyEval_SaveThread();
+
     for (y = 0; y < ysize; y++) {
         UINT8 *out = (UINT8 *)imDest->image[dy + y] + dx * 4;
         UINT8 *outmask = (UINT8 *)imDest->image[dy + y] + dx * 4 + 3;
@@ -188,46 +228,52 @@ alpha_over_full(PyObject *dest, PyObject *src, PyObject *mask, float overall_alp
                 in_alpha = *inmask;
             }
             
-            /* special cases */
-            if (in_alpha == 255 || (*outmask == 0 && in_alpha > 0)) {
-                *outmask = in_alpha;
-
-                *out = *in;
-                out++, in++;
-                *out = *in;
-                out++, in++;
-                *out = *in;
-                out++, in++;
-            } else if (in_alpha == 0) {
-                /* do nothing -- source is fully transparent */
-                out += 3;
-                in += 3;
-            } else {
-                /* general case */
-                int alpha = in_alpha + MULDIV255(*outmask, 255 - in_alpha, tmp1);
-                for (i = 0; i < 3; i++) {
-                    /* general case */
-                    *out = MULDIV255(*in, in_alpha, tmp1) +
-                        MULDIV255(MULDIV255(*out, *outmask, tmp2), 255 - in_alpha, tmp3);
-                    
-                    *out = (*out * 255) / alpha;
-                    out++, in++;
-                }
-
-                *outmask = alpha;
-            }
+            blend_pixel(out, in, in_alpha);
 
-            out++;
-            if (src_has_alpha)
-                in++;
+            out += 4;
+            in += src_has_alpha ? 4 : 3;
             outmask += 4;
             inmask += mask_stride;
         }
     }
 
+    if (save)
+        PyEval_RestoreThread(save);
+
     return dest;
 }
 
+/* draws a sprite from the block atlas at dx, dy, like alpha_over with the
+ * sprite as its own mask. Rows are only blended where the sprite isn't
+ * transparent, and copied straight over where it's opaque.
+ */
+void
+draw_sprite(Imaging dest, BlockSprite *sprite, int dx, int dy) {
+    Imaging src = sprite->imsrc;
+    int x, y, ymin, ymax;
+
+    ymin = MAX(0, -dy);
+    ymax = MIN(src->ysize, dest->ysize - dy);
+    for (y = ymin; y < ymax; y++) {
+        unsigned short *span = sprite->spans + 3 * y;
+        int first = MAX(span[0], -dx);
+        int last = MIN(span[1], dest->xsize - dx);
+        UINT8 *out, *in;
+
+        if (first >= last)
+            continue;
+
+        out = (UINT8 *)dest->image[dy + y] + (dx + first) * 4;
+        in = (UINT8 *)src->image[y] + first * 4;
+        if (span[2]) {
+            memcpy(out, in, (last - first) * 4);
+        } else {
+            for (x = first; x < last; x++, out += 4, in += 4)
+                blend_pixel(out, in, in[3]);
+        }
+    }
+}
+
 /* wraps alpha_over so it can be called directly from python */
 /* properly refs the return value when needed: you DO need to decref the return */
 PyObject *
@@ -550,6 +596,9 @@ resize_half(PyObject *dest, PyObject *src) {
     if(!src_has_alpha)
         a = 0xFF << 2;
     
+    /* only the pixels are touched from here on, so let other threads run */
+    Py_BEGIN_ALLOW_THREADS
+    
     for (y = 0; y < dest_height; y++) {
         
         UINT8 *out = (UINT8 *)imDest->image[y];
@@ -618,6 +667,8 @@ resize_half(PyObject *dest, PyObject *src) {
         }
     }
     
+    Py_END_ALLOW_THREADS
+    
     return dest;
 }
 
@@ -30,6 +30,16 @@ static PyObject *fluid_blocks = NULL;
 static PyObject *nospawn_blocks = NULL;
 static PyObject *nodata_blocks = NULL;
 
+/* tall grass is moved by random offsets, taken from the numbers rand()
+ * gives after srand(1) so it's in the same place no matter what mode is
+ * used. Other threads can render at the same time as chunk_render, and
+ * their srand() would shift the sequence, so it's generated once here;
+ * that's two numbers for every block of a section. */
+#define RAND_TABLE_SIZE (2 * 16 * 16 * 16)
+static int rand_table[RAND_TABLE_SIZE];
+
+static void init_tile_sections(void);
+
 PyObject *init_chunk_render(void) {
    
     PyObject *tmp = NULL;
@@ -99,51 +109,100 @@ PyObject *init_chunk_render(void) {
         Py_DECREF(block);
     }
     
+    srand(1);
+    for (i = 0; i < RAND_TABLE_SIZE; i++) {
+        rand_table[i] = rand();
+    }
+    
+    init_tile_sections();
+    
     Py_RETURN_NONE;
 }
 
-/* helper for load_chunk, loads a section into a chunk */
+/* helper for load_chunk, loads a section into a chunk
+ * the arrays themselves are left for load_section_array, so sections
+ * that are never looked at are never expanded */
 static inline void load_chunk_section(ChunkData *dest, int i, PyObject *section) {
-    dest->sections[i].blocks = PyDict_GetItemString(section, "Blocks");
-    dest->sections[i].data = PyDict_GetItemString(section, "Data");
-    dest->sections[i].skylight = PyDict_GetItemString(section, "SkyLight");
-    dest->sections[i].blocklight = PyDict_GetItemString(section, "BlockLight");
-    Py_INCREF(dest->sections[i].blocks);
-    Py_INCREF(dest->sections[i].data);
-    Py_INCREF(dest->sections[i].skylight);
-    Py_INCREF(dest->sections[i].blocklight);
+    Py_XDECREF(dest->sections[i].section);
+    dest->sections[i].section = section;
+    Py_INCREF(section);
 }
 
-/* loads the given chunk into the chunks[] array in the state
- * returns true on error
+/* fetches one of the arrays of a loaded section and stores it in the
+ * section's slot, returning a borrowed reference to it (or Py_None if
+ * the section doesn't have that array)
  *
- * if required is true, failure to load the chunk will raise a python
- * exception and return true.
+ * this goes through PyObject_GetItem so that the section can expand the
+ * array on demand
  */
-int load_chunk(RenderState* state, int x, int z, unsigned char required) {
+PyObject *load_section_array(ChunkData *chunk, int section, int type) {
+    PyObject **slot;
+    const char *key;
+    PyObject *array;
+    PyGILState_STATE gil;
+    
+    switch (type) {
+    case BLOCKS:
+        slot = &(chunk->sections[section].blocks);
+        key = "Blocks";
+        break;
+    case DATA:
+        slot = &(chunk->sections[section].data);
+        key = "Data";
+        break;
+    case BLOCKLIGHT:
+        slot = &(chunk->sections[section].blocklight);
+        key = "BlockLight";
+        break;
+    case SKYLIGHT:
+        slot = &(chunk->sections[section].skylight);
+        key = "SkyLight";
+        break;
+    default:
+        return NULL;
+    }
+    
+    /* render_section may be drawing without the GIL */
+    gil = PyGILState_Ensure();
+    array = PyMapping_GetItemString(chunk->sections[section].section, (char *)key);
+    if (array == NULL) {
+        /* treat a missing (or broken) array as not there at all */
+        PyErr_Clear();
+        array = Py_None;
+        Py_INCREF(array);
+    }
+    PyGILState_Release(gil);
+    
+    *slot = array;
+    return array;
+}
+
+/* does the work of load_chunk, with the GIL held */
+static int load_chunk_gil(RenderState* state, int x, int z, unsigned char required) {
     ChunkData *dest = &(state->chunks[1 + x][1 + z]);
     int i;
     PyObject *chunk = NULL;
     PyObject *sections = NULL;
     
-    if (dest->loaded)
-        return 0;
-    
     /* set up reasonable defaults */
     dest->biomes = NULL;
     for (i = 0; i < SECTIONS_PER_CHUNK; i++)
     {
+        dest->sections[i].section = NULL;
         dest->sections[i].blocks = NULL;
         dest->sections[i].data = NULL;
         dest->sections[i].skylight = NULL;
         dest->sections[i].blocklight = NULL;
+        dest->sections[i].summary_known = 0;
+        dest->sections[i].summary = 0;
     }
     dest->loaded = 1;
     
     x += state->chunkx;
     z += state->chunkz;
 
-    chunk = PyObject_CallMethod(state->regionset, "get_chunk", "ii", x, z);
+    /* the render profile only decodes what's used here */
+    chunk = PyObject_CallMethod(state->regionset, "get_chunk", "iis", x, z, "render");
     if (chunk == NULL) {
         // An exception is already set. RegionSet.get_chunk sets
         // ChunkDoesntExist
@@ -187,24 +246,24 @@ int load_chunk(RenderState* state, int x, int z, unsigned char required) {
     return 0;
 }
 
-/* helper to unload all loaded chunks */
-static void
-unload_all_chunks(RenderState *state) {
-    unsigned int i, j, k;
-    for (i = 0; i < 3; i++) {
-        for (j = 0; j < 3; j++) {
-            if (state->chunks[i][j].loaded) {
-                Py_XDECREF(state->chunks[i][j].biomes);
-                for (k = 0; k < SECTIONS_PER_CHUNK; k++) {
-                    Py_XDECREF(state->chunks[i][j].sections[k].blocks);
-                    Py_XDECREF(state->chunks[i][j].sections[k].data);
-                    Py_XDECREF(state->chunks[i][j].sections[k].skylight);
-                    Py_XDECREF(state->chunks[i][j].sections[k].blocklight);
-                }
-                state->chunks[i][j].loaded = 0;
-            }
-        }
-    }
+/* loads the given chunk into the chunks[] array in the state
+ * returns true on error
+ *
+ * if required is true, failure to load the chunk will raise a python
+ * exception and return true. This can be called without holding the
+ * GIL, it's taken while the chunk is fetched.
+ */
+int load_chunk(RenderState* state, int x, int z, unsigned char required) {
+    PyGILState_STATE gil;
+    int error;
+    
+    if (state->chunks[1 + x][1 + z].loaded)
+        return 0;
+    
+    gil = PyGILState_Ensure();
+    error = load_chunk_gil(state, x, z, required);
+    PyGILState_Release(gil);
+    return error;
 }
 
 unsigned short
@@ -486,11 +545,7 @@ generate_pseudo_data(RenderState *state, unsigned short ancilData) {
         unsigned char repair_rot[] = { 0, 1, 2, 3,  2, 3, 1, 0,  1, 0, 3, 2,  3, 2, 0, 1 };
 
         /* need to get northdirection of the render */
-        /* TODO: get this just once? store in state? */
-        PyObject *texrot;
-        int northdir;
-        texrot = PyObject_GetAttrString(state->textures, "rotation");
-        northdir = PyInt_AsLong(texrot);
+        int northdir = state->northdir;
 
         /* fix the rotation value for different northdirections */
         #define FIX_ROT(x) (((x) & ~0x3) | repair_rot[((x) & 0x3) | (northdir << 2)])
@@ -567,206 +622,532 @@ generate_pseudo_data(RenderState *state, unsigned short ancilData) {
 }
 
 
-/* TODO triple check this to make sure reference counting is correct */
-PyObject*
-chunk_render(PyObject *self, PyObject *args) {
-    RenderState state;
-    PyObject *modeobj;
-    PyObject *blockmap;
-
-    int xoff, yoff;
-    
-    PyObject *imgsize, *imgsize0_py, *imgsize1_py;
-    int imgsize0, imgsize1;
-    
-    PyObject *blocks_py;
-    PyObject *left_blocks_py;
-    PyObject *right_blocks_py;
-    PyObject *up_left_blocks_py;
-    PyObject *up_right_blocks_py;
+/* helper to unload a loaded chunk */
+static void
+unload_chunk(ChunkData *chunk) {
+    unsigned int k;
+    if (chunk->loaded) {
+        Py_XDECREF(chunk->biomes);
+        for (k = 0; k < SECTIONS_PER_CHUNK; k++) {
+            Py_XDECREF(chunk->sections[k].section);
+            Py_XDECREF(chunk->sections[k].blocks);
+            Py_XDECREF(chunk->sections[k].data);
+            Py_XDECREF(chunk->sections[k].skylight);
+            Py_XDECREF(chunk->sections[k].blocklight);
+        }
+        chunk->loaded = 0;
+    }
+}
 
-    RenderMode *rendermode;
+/* returns true if the given section of a loaded chunk is known to be
+ * what (one of the SECTION_* flags), working it out from its blocks the
+ * first time it's asked. Sections that don't exist are none of them. */
+static int
+section_is(ChunkData *chunk, int section, unsigned char what) {
+    PyObject *blocks;
+    int x, y, z;
     
-    int i, j;
-
-    PyObject *t = NULL;
+    if (!chunk->loaded || section < 0 || section >= SECTIONS_PER_CHUNK)
+        return 0;
+    if (chunk->sections[section].summary_known & what)
+        return (chunk->sections[section].summary & what) != 0;
     
-    if (!PyArg_ParseTuple(args, "OOiiiOiiOO",  &state.world, &state.regionset, &state.chunkx, &state.chunky, &state.chunkz, &state.img, &xoff, &yoff, &modeobj, &state.textures))
-        return NULL;
+    blocks = get_section_array(chunk, section, BLOCKS);
+    if (blocks == NULL)
+        return 0;
     
-    /* set up the render mode */
-    state.rendermode = rendermode = render_mode_create(modeobj, &state);
-    if (rendermode == NULL) {
-        return NULL; // note that render_mode_create will
-                     // set PyErr.  No need to set it here
-    }
-
-    /* get the blockmap from the textures object */
-    blockmap = PyObject_GetAttrString(state.textures, "blockmap");
-    if (blockmap == NULL) {
-        render_mode_destroy(rendermode);
-        return NULL;
-    }
-    if (blockmap == Py_None) {
-        render_mode_destroy(rendermode);
-        PyErr_SetString(PyExc_RuntimeError, "you must call Textures.generate()");
-        return NULL;
+    if (what == SECTION_EMPTY || what == SECTION_OPAQUE) {
+        /* one look through the blocks does for both, stopping as soon as
+           it's clear the section is neither */
+        int empty = 1, opaque = 1;
+        for (y = 0; y < 16 && (empty || opaque); y++) {
+            for (z = 0; z < 16; z++) {
+                for (x = 0; x < 16; x++) {
+                    unsigned short block = getArrayShort3D(blocks, x, y, z);
+                    if (block != 0)
+                        empty = 0;
+                    if (is_transparent(block))
+                        opaque = 0;
+                }
+            }
+        }
+        chunk->sections[section].summary_known |= SECTION_EMPTY | SECTION_OPAQUE;
+        if (empty)
+            chunk->sections[section].summary |= SECTION_EMPTY;
+        if (opaque) {
+            /* and so are all its faces */
+            chunk->sections[section].summary_known |= SECTION_OPAQUE_X15 |
+                SECTION_OPAQUE_Z0 | SECTION_OPAQUE_Y0;
+            chunk->sections[section].summary |= SECTION_OPAQUE |
+                SECTION_OPAQUE_X15 | SECTION_OPAQUE_Z0 | SECTION_OPAQUE_Y0;
+        }
+    } else {
+        /* one face, 16 by 16 blocks */
+        int opaque = 1, i, j;
+        for (i = 0; i < 16 && opaque; i++) {
+            for (j = 0; j < 16; j++) {
+                unsigned short block;
+                if (what == SECTION_OPAQUE_X15)
+                    block = getArrayShort3D(blocks, 15, i, j);
+                else if (what == SECTION_OPAQUE_Z0)
+                    block = getArrayShort3D(blocks, i, j, 0);
+                else
+                    block = getArrayShort3D(blocks, i, 0, j);
+                if (is_transparent(block)) {
+                    opaque = 0;
+                    break;
+                }
+            }
+        }
+        chunk->sections[section].summary_known |= what;
+        if (opaque)
+            chunk->sections[section].summary |= what;
     }
     
-    /* get the image size */
-    imgsize = PyObject_GetAttrString(state.img, "size");
+    return (chunk->sections[section].summary & what) != 0;
+}
 
-    imgsize0_py = PySequence_GetItem(imgsize, 0);
-    imgsize1_py = PySequence_GetItem(imgsize, 1);
-    Py_DECREF(imgsize);
+/* occlusion culling
+ *
+ * base_occluded() leaves out every block with non-transparent blocks in
+ * front of it, behind and on top of it, but it only looks inside the
+ * section, so a section made of nothing but non-transparent blocks still
+ * has its three front faces drawn, only for them to be drawn over by the
+ * sections in front of it. If those sections are non-transparent on the
+ * faces they share with it, this leaves out the faces too, and with them
+ * very often the whole section.
+ *
+ * returns the faces of state's section that are covered this way, as
+ * CULL_* flags. Only ever non-zero for rendermodes with
+ * occlusion_culling set. */
+#define CULL_X0  (1 << 0)
+#define CULL_Z15 (1 << 1)
+#define CULL_Y15 (1 << 2)
+#define CULL_ALL (CULL_X0 | CULL_Z15 | CULL_Y15)
+static int
+section_cover(RenderState *state) {
+    int cover = 0;
+    
+    if (!state->rendermode->occlusion_culling)
+        return 0;
+    if (!section_is(&(state->chunks[1][1]), state->chunky, SECTION_OPAQUE))
+        return 0;
+    
+    load_chunk(state, -1, 0, 0);
+    load_chunk(state, 0, 1, 0);
+    if (section_is(&(state->chunks[0][1]), state->chunky, SECTION_OPAQUE_X15))
+        cover |= CULL_X0;
+    if (section_is(&(state->chunks[1][2]), state->chunky, SECTION_OPAQUE_Z0))
+        cover |= CULL_Z15;
+    if (section_is(&(state->chunks[1][1]), state->chunky + 1, SECTION_OPAQUE_Y0))
+        cover |= CULL_Y15;
+    return cover;
+}
 
-    imgsize0 = PyInt_AsLong(imgsize0_py);
-    imgsize1 = PyInt_AsLong(imgsize1_py);
-    Py_DECREF(imgsize0_py);
-    Py_DECREF(imgsize1_py);
+/* draws the section at state->chunkx, chunky, chunkz at xoff, yoff, loading
+ * its chunk (and the neighboring ones, as needed) into state->chunks
+ * culled is set to whether the section was left out whole, because it's
+ * empty or hidden (see section_cover)
+ * returns true on error */
+static int
+render_section(RenderState *state, BlockAtlas *atlas, int xoff, int yoff, int *culled) {
+    int imgsize0 = state->imdest->xsize;
+    int imgsize1 = state->imdest->ysize;
+    /* position in rand_table */
+    unsigned int rand_index = 0;
+    /* whether only the blocks on the section's front faces can be seen,
+       and which of those faces are covered anyway */
+    int faces_only, cover;
     
-    /* set all block data to unloaded */
-    for (i = 0; i < 3; i++) {
-        for (j = 0; j < 3; j++) {
-            state.chunks[i][j].loaded = 0;
-        }
-    }
+    *culled = 0;
     
     /* get the block data for the center column, erroring out if needed */
-    if (load_chunk(&state, 0, 0, 1)) {
-        render_mode_destroy(rendermode);
-        Py_DECREF(blockmap);
-        return NULL;
-    }
-    if (state.chunks[1][1].sections[state.chunky].blocks == NULL) {
+    if (load_chunk(state, 0, 0, 1))
+        return 1;
+    /* set state->blocks and state->blockdatas as convenience */
+    state->blocks = get_section_array(&(state->chunks[1][1]), state->chunky, BLOCKS);
+    state->blockdatas = get_section_array(&(state->chunks[1][1]), state->chunky, DATA);
+    if (state->blocks == NULL || state->blockdatas == NULL) {
         /* this section doesn't exist, let's skeddadle */
-        render_mode_destroy(rendermode);
-        Py_DECREF(blockmap);
-        unload_all_chunks(&state);
-        Py_RETURN_NONE;
+        return 0;
     }
     
-    /* set blocks_py, state.blocks, and state.blockdatas as convenience */
-    blocks_py = state.blocks = state.chunks[1][1].sections[state.chunky].blocks;
-    state.blockdatas = state.chunks[1][1].sections[state.chunky].data;
-
-    /* set up the random number generator again for each chunk
-       so tallgrass is in the same place, no matter what mode is used */
-    srand(1);
+    if (section_is(&(state->chunks[1][1]), state->chunky, SECTION_EMPTY)) {
+        *culled = 1;
+        return 0;
+    }
     
-    for (state.x = 15; state.x > -1; state.x--) {
-        for (state.z = 0; state.z < 16; state.z++) {
+    cover = section_cover(state);
+    if (cover == CULL_ALL) {
+        *culled = 1;
+        return 0;
+    }
+    faces_only = state->rendermode->occlusion_culling &&
+        section_is(&(state->chunks[1][1]), state->chunky, SECTION_OPAQUE);
+
+    /* the blocks are drawn without the GIL, so other threads can render
+       at the same time. Whatever needs python in here takes it back for
+       as long as it needs it: load_chunk, load_section_array, and
+       render_mode_draw for the primitives that draw with python */
+    Py_BEGIN_ALLOW_THREADS
+    for (state->x = 15; state->x > -1; state->x--) {
+        for (state->z = 0; state->z < 16; state->z++) {
 
             /* set up the render coordinates */
-            state.imgx = xoff + state.x*12 + state.z*12;
+            state->imgx = xoff + state->x*12 + state->z*12;
             /* 16*12 -- offset for y direction, 15*6 -- offset for x */
-            state.imgy = yoff - state.x*6 + state.z*6 + 16*12 + 15*6;
+            state->imgy = yoff - state->x*6 + state->z*6 + 16*12 + 15*6;
             
-            for (state.y = 0; state.y < 16; state.y++) {
+            for (state->y = 0; state->y < 16; state->y++) {
                 unsigned short ancilData;
                 
-                state.imgy -= 12;
+                state->imgy -= 12;
+                
+                /* in a section of non-transparent blocks, only the ones on
+                   the front faces that aren't covered can be seen */
+                if (faces_only &&
+                    !(state->x == 0 && !(cover & CULL_X0)) &&
+                    !(state->z == 15 && !(cover & CULL_Z15)) &&
+                    !(state->y == 15 && !(cover & CULL_Y15))) {
+                    continue;
+                }
 		
                 /* get blockid */
-                state.block = getArrayShort3D(blocks_py, state.x, state.y, state.z);
-                if (state.block == 0 || render_mode_hidden(rendermode, state.x, state.y, state.z)) {
+                state->block = getArrayShort3D(state->blocks, state->x, state->y, state->z);
+                if (state->block == 0 || render_mode_hidden(state->rendermode, state->x, state->y, state->z)) {
                     continue;
                 }
                 
                 /* make sure we're rendering inside the image boundaries */
-                if ((state.imgx >= imgsize0 + 24) || (state.imgx <= -24)) {
+                if ((state->imgx >= imgsize0 + 24) || (state->imgx <= -24)) {
                     continue;
                 }
-                if ((state.imgy >= imgsize1 + 24) || (state.imgy <= -24)) {
+                if ((state->imgy >= imgsize1 + 24) || (state->imgy <= -24)) {
                     continue;
                 }
                 
                 /* check for occlusion */
-                if (render_mode_occluded(rendermode, state.x, state.y, state.z)) {
+                if (render_mode_occluded(state->rendermode, state->x, state->y, state->z)) {
                     continue;
                 }
                 
                 /* everything stored here will be a borrowed ref */
                 
-                if (block_has_property(state.block, NODATA)) {
+                if (block_has_property(state->block, NODATA)) {
                     /* block shouldn't have data associated with it, set it to 0 */
                     ancilData = 0;
-                    state.block_data = 0;
-                    state.block_pdata = 0;
+                    state->block_data = 0;
+                    state->block_pdata = 0;
                 } else {
                     /* block has associated data, use it */
-                    ancilData = getArrayByte3D(state.blockdatas, state.x, state.y, state.z);
-                    state.block_data = ancilData;
+                    ancilData = getArrayByte3D(state->blockdatas, state->x, state->y, state->z);
+                    state->block_data = ancilData;
                     /* block that need pseudo ancildata:
                      * grass, water, glass, chest, restone wire,
                      * ice, fence, portal, iron bars, glass panes,
                      * trapped chests, stairs */
-                    if ((state.block ==  2) || (state.block ==  9) ||
-                        (state.block == 20) || (state.block == 54) ||
-                        (state.block == 55) || (state.block == 64) ||
-                        (state.block == 71) || (state.block == 79) ||
-                        (state.block == 85) || (state.block == 90) ||
-                        (state.block == 101) || (state.block == 102) ||
-                        (state.block == 111) || (state.block == 113) ||
-                        (state.block == 139) || (state.block == 175) || 
-                        (state.block == 160) || (state.block == 95) ||
-                        (state.block == 146) ||
-                        is_stairs(state.block)) {
-                        ancilData = generate_pseudo_data(&state, ancilData);
-                        state.block_pdata = ancilData;
+                    if ((state->block ==  2) || (state->block ==  9) ||
+                        (state->block == 20) || (state->block == 54) ||
+                        (state->block == 55) || (state->block == 64) ||
+                        (state->block == 71) || (state->block == 79) ||
+                        (state->block == 85) || (state->block == 90) ||
+                        (state->block == 101) || (state->block == 102) ||
+                        (state->block == 111) || (state->block == 113) ||
+                        (state->block == 139) || (state->block == 175) || 
+                        (state->block == 160) || (state->block == 95) ||
+                        (state->block == 146) ||
+                        is_stairs(state->block)) {
+                        ancilData = generate_pseudo_data(state, ancilData);
+                        state->block_pdata = ancilData;
                     } else {
-                        state.block_pdata = 0;
+                        state->block_pdata = 0;
                     }
                 }
                 
                 /* make sure our block info is in-bounds */
-                if (state.block >= max_blockid || ancilData >= max_data)
+                if (state->block >= max_blockid || ancilData >= max_data ||
+                    max_data * state->block + ancilData >= atlas->num_sprites)
                     continue;
                 
-                /* get the texture */
-                t = PyList_GET_ITEM(blockmap, max_data * state.block + ancilData);
-                /* if we don't get a texture, try it again with 0 data */
-                if ((t == NULL || t == Py_None) && ancilData != 0)
-                    t = PyList_GET_ITEM(blockmap, max_data * state.block);
+                /* get the texture, the atlas already falls back to the one
+                   for data 0 if there's none for this data */
+                state->sprite = &(atlas->sprites[max_data * state->block + ancilData]);
                 
                 /* if we found a proper texture, render it! */
-                if (t != NULL && t != Py_None)
+                if (state->sprite->src != NULL)
                 {
-                    PyObject *src, *mask, *mask_light;
-                    int do_rand = (state.block == 31 /*|| state.block == 38 || state.block == 175*/);
+                    int do_rand = (state->block == 31 /*|| state->block == 38 || state->block == 175*/);
                     int randx = 0, randy = 0;
-                    src = PyTuple_GetItem(t, 0);
-                    mask = PyTuple_GetItem(t, 0);
-                    mask_light = PyTuple_GetItem(t, 1);
-
-                    if (mask == Py_None)
-                        mask = src;
 
                     if (do_rand) {
                         /* add a random offset to the postion of the tall grass to make it more wild */
-                        randx = rand() % 6 + 1 - 3;
-                        randy = rand() % 6 + 1 - 3;
-                        state.imgx += randx;
-                        state.imgy += randy;
+                        randx = rand_table[rand_index++] % 6 + 1 - 3;
+                        randy = rand_table[rand_index++] % 6 + 1 - 3;
+                        state->imgx += randx;
+                        state->imgy += randy;
                     }
                     
-                    render_mode_draw(rendermode, src, mask, mask_light);
+                    render_mode_draw(state->rendermode, state->sprite->src, state->sprite->src, state->sprite->mask_light);
                     
                     if (do_rand) {
                         /* undo the random offsets */
-                        state.imgx -= randx;
-                        state.imgy -= randy;
+                        state->imgx -= randx;
+                        state->imgy -= randy;
                     }
                 }               
             }
         }
     }
+    Py_END_ALLOW_THREADS
+
+    return 0;
+}
 
+/* gets everything but the position and the chunks ready to render with in
+ * state, and returns a new reference to the block atlas. The rendermode is
+ * only created if modeobj isn't compiled already. NULL on error */
+static PyObject *
+start_render(RenderState *state, PyObject *modeobj, RenderMode *compiled_mode) {
+    PyObject *atlas_py;
+    PyObject *texrot;
+    
+    state->imdest = imaging_python_to_c(state->img);
+    if (state->imdest == NULL)
+        return NULL;
+    if (strcmp(state->imdest->mode, "RGBA") != 0) {
+        PyErr_SetString(PyExc_ValueError,
+                        "given destination image does not have mode \"RGBA\"");
+        return NULL;
+    }
+    
+    /* generate_pseudo_data runs without the GIL, so it can't look this
+       up itself */
+    texrot = PyObject_GetAttrString(state->textures, "rotation");
+    if (texrot == NULL)
+        return NULL;
+    state->northdir = PyInt_AsLong(texrot);
+    Py_DECREF(texrot);
+    if (PyErr_Occurred())
+        return NULL;
+    
+    state->sprite = NULL;
+    state->lightcache = NULL;
+    state->nethercache = NULL;
+    
+    /* set up the render mode, unless it was compiled already */
+    if (render_mode_use_compiled(modeobj, compiled_mode, state)) {
+        state->rendermode = compiled_mode;
+    } else {
+        state->rendermode = render_mode_create(modeobj, state);
+        if (state->rendermode == NULL) {
+            return NULL; // note that render_mode_create will
+                         // set PyErr.  No need to set it here
+        }
+    }
+
+    /* get the block images from the textures object */
+    atlas_py = get_block_atlas(state->textures);
+    if (atlas_py == NULL) {
+        render_mode_destroy(state->rendermode);
+        return NULL;
+    }
+    return atlas_py;
+}
+
+/* renders a single chunk section, the python render_loop */
+PyObject*
+chunk_render(PyObject *self, PyObject *args) {
+    RenderState state;
+    PyObject *modeobj;
+    PyObject *atlas_py;
+    /* where a compiled rendermode is set up for this call */
+    RenderMode compiled_mode;
+    int xoff, yoff;
+    int i, j, error, culled;
+    
+    if (!PyArg_ParseTuple(args, "OOiiiOiiOO",  &state.world, &state.regionset, &state.chunkx, &state.chunky, &state.chunkz, &state.img, &xoff, &yoff, &modeobj, &state.textures))
+        return NULL;
+    
+    atlas_py = start_render(&state, modeobj, &compiled_mode);
+    if (atlas_py == NULL)
+        return NULL;
+    
+    /* set all block data to unloaded */
+    for (i = 0; i < 3; i++) {
+        for (j = 0; j < 3; j++) {
+            state.chunks[i][j].loaded = 0;
+        }
+    }
+    
+    error = render_section(&state, BLOCK_ATLAS(atlas_py), xoff, yoff, &culled);
+    
     /* free up the rendermode info */
-    render_mode_destroy(rendermode);
+    render_mode_destroy(state.rendermode);
+    free(state.lightcache);
+    free(state.nethercache);
     
-    Py_DECREF(blockmap);
-    unload_all_chunks(&state);
+    Py_DECREF(atlas_py);
+    for (i = 0; i < 3; i++) {
+        for (j = 0; j < 3; j++) {
+            unload_chunk(&(state.chunks[i][j]));
+        }
+    }
 
+    if (error)
+        return NULL;
     Py_RETURN_NONE;
 }
+
+/* The chunk sections a render-tile is drawn from, back to front, as offsets
+ * from the tile's column and row. This is the order get_chunks_by_tile() in
+ * tileset.py gives: even columns have four sections in each row of a
+ * level, odd columns three, so going round the even, even, odd ... even,
+ * even columns like it does takes the same turns all the way through. */
+#define TILE_SECTIONS (16 * 11)
+static struct {
+    signed char dcol, drow, y;
+} tile_sections[TILE_SECTIONS];
+
+static void
+init_tile_sections(void) {
+    static const char turns[] = "eeoeeoeeoee";
+    int even = 0, odd = 0, i;
+    
+    /* the even and odd columns' sections, front to back like the lists in
+       get_chunks_by_tile() are after they're reversed */
+    for (i = 0; i < TILE_SECTIONS; i++) {
+        int level, n;
+        if (turns[i % 11] == 'e') {
+            /* eight to a level: two columns, rows 4 - 2*level down to
+               -2 - 2*level, starting from the end */
+            n = 16 * 8 - 1 - even++;
+            level = n / 8;
+            tile_sections[i].dcol = (n % 2) ? 0 : 2;
+            tile_sections[i].drow = 4 - 2 * level - 2 * ((n % 8) / 2);
+        } else {
+            /* three to a level, in the middle column, rows 3 - 2*level
+               down to -1 - 2*level */
+            n = 16 * 3 - 1 - odd++;
+            level = n / 3;
+            tile_sections[i].dcol = 1;
+            tile_sections[i].drow = 3 - 2 * level - 2 * (n % 3);
+        }
+        tile_sections[i].y = 15 - level;
+    }
+}
+
+/* the chunks around a render-tile, relative to the chunk at its column and
+ * row. The sections it's drawn from are at x offsets -2 to 17 and z offsets
+ * -16 to 3, and they look one chunk further out. */
+#define TILE_CHUNKS_MINX (-3)
+#define TILE_CHUNKS_MINZ (-17)
+#define TILE_CHUNKS_SIZE 22
+typedef struct {
+    ChunkData chunks[TILE_CHUNKS_SIZE][TILE_CHUNKS_SIZE];
+    /* the mtime of each chunk the tile is drawn from, 0 if it doesn't
+       exist, -1 if it hasn't been looked up */
+    long mtimes[TILE_CHUNKS_SIZE][TILE_CHUNKS_SIZE];
+} TileChunks;
+
+/* renders a whole render-tile into img, the python render_tile. Each chunk
+ * is only fetched from the regionset once, no matter how many of the
+ * tile's sections need it. Returns the highest mtime of the chunks drawn,
+ * or None if there were none, and the number of sections culled whole */
+PyObject*
+tile_render(PyObject *self, PyObject *args) {
+    RenderState state;
+    PyObject *modeobj;
+    PyObject *atlas_py;
+    RenderMode compiled_mode;
+    TileChunks *tile;
+    int tilecol, tilerow, chunkx, chunkz;
+    int i, j, k, culled, error = 0;
+    int num_culled = 0;
+    long max_mtime = 0;
+    
+    if (!PyArg_ParseTuple(args, "OOiiOOO", &state.world, &state.regionset, &tilecol, &tilerow, &state.img, &modeobj, &state.textures))
+        return NULL;
+    
+    tile = calloc(1, sizeof(TileChunks));
+    if (tile == NULL)
+        return PyErr_NoMemory();
+    for (i = 0; i < TILE_CHUNKS_SIZE; i++) {
+        for (j = 0; j < TILE_CHUNKS_SIZE; j++) {
+            tile->mtimes[i][j] = -1;
+        }
+    }
+    
+    atlas_py = start_render(&state, modeobj, &compiled_mode);
+    if (atlas_py == NULL) {
+        free(tile);
+        return NULL;
+    }
+    
+    /* see unconvert_coords() in tileset.py */
+    chunkx = (tilecol - tilerow) / 2;
+    chunkz = (tilecol + tilerow) / 2;
+    
+    for (k = 0; k < TILE_SECTIONS; k++) {
+        int dcol = tile_sections[k].dcol, drow = tile_sections[k].drow;
+        int tx = (dcol - drow) / 2 - TILE_CHUNKS_MINX;
+        int tz = (dcol + drow) / 2 - TILE_CHUNKS_MINZ;
+        
+        state.chunkx = chunkx + tx + TILE_CHUNKS_MINX;
+        state.chunky = tile_sections[k].y;
+        state.chunkz = chunkz + tz + TILE_CHUNKS_MINZ;
+        
+        if (tile->mtimes[tx][tz] < 0) {
+            PyObject *mtime = PyObject_CallMethod(state.regionset, "get_chunk_mtime", "ii", state.chunkx, state.chunkz);
+            if (mtime == NULL) {
+                error = 1;
+                break;
+            }
+            tile->mtimes[tx][tz] = PyObject_IsTrue(mtime) ? PyInt_AsLong(mtime) : 0;
+            Py_DECREF(mtime);
+            if (PyErr_Occurred()) {
+                error = 1;
+                break;
+            }
+        }
+        if (!tile->mtimes[tx][tz])
+            continue;
+        if (tile->mtimes[tx][tz] > max_mtime)
+            max_mtime = tile->mtimes[tx][tz];
+        
+        /* lend the section the chunks it might need, and take them back
+           with whatever it loaded in the meantime */
+        for (i = 0; i < 3; i++) {
+            for (j = 0; j < 3; j++) {
+                state.chunks[i][j] = tile->chunks[tx - 1 + i][tz - 1 + j];
+            }
+        }
+        error = render_section(&state, BLOCK_ATLAS(atlas_py),
+                               -192 + dcol * 192, -96 + drow * 96 + (16 - 1 - state.chunky) * 192,
+                               &culled);
+        num_culled += culled;
+        for (i = 0; i < 3; i++) {
+            for (j = 0; j < 3; j++) {
+                tile->chunks[tx - 1 + i][tz - 1 + j] = state.chunks[i][j];
+            }
+        }
+        if (error)
+            break;
+    }
+    
+    render_mode_destroy(state.rendermode);
+    free(state.lightcache);
+    free(state.nethercache);
+    Py_DECREF(atlas_py);
+    for (i = 0; i < TILE_CHUNKS_SIZE; i++) {
+        for (j = 0; j < TILE_CHUNKS_SIZE; j++) {
+            unload_chunk(&(tile->chunks[i][j]));
+        }
+    }
+    free(tile);
+    
+    if (error)
+        return NULL;
+    if (max_mtime == 0)
+        return Py_BuildValue("Oi", Py_None, num_culled);
+    return Py_BuildValue("li", max_mtime, num_culled);
+}
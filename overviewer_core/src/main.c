@@ -32,6 +32,15 @@ static PyMethodDef COverviewerMethods[] = {
     {"render_loop", chunk_render, METH_VARARGS,
      "Renders stuffs"},
     
+    {"render_tile", tile_render, METH_VARARGS,
+     "renders all the chunk sections of a render-tile"},
+    
+    {"compile_rendermode", render_mode_compile, METH_VARARGS,
+     "start the primitives of a rendermode, for use with render_loop"},
+    
+    {"nbt_load", nbt_load, METH_VARARGS,
+     "decode an uncompressed NBT string into a (name, payload) tuple, leaving out the tags named in the optional skip"},
+    
     {"extension_version", get_extension_version, METH_VARARGS, 
         "Returns the extension version"},
     
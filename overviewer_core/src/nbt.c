@@ -0,0 +1,416 @@
+/*
+ * This file is part of the Minecraft Overviewer.
+ *
+ * Minecraft Overviewer is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License as published
+ * by the Free Software Foundation, either version 3 of the License, or (at
+ * your option) any later version.
+ *
+ * Minecraft Overviewer is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+ * Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License along
+ * with the Overviewer.  If not, see <http://www.gnu.org/licenses/>.
+ */
+
+/*
+ * A compiled NBT decoder. This produces exactly the same structure as
+ * nbt.NBTFileReader.read_all() in python: compounds become dicts, lists
+ * become lists, byte arrays become strings (which numpy.frombuffer can use
+ * without a copy), int arrays become tuples and strings become unicode.
+ *
+ * The input must already be decompressed.
+ *
+ * Tags can be left out by name (see nbt_load), these are read past by
+ * their lengths without building anything.
+ */
+
+#include "overviewer.h"
+
+/* NBT tag types */
+enum {
+    TAG_END = 0,
+    TAG_BYTE,
+    TAG_SHORT,
+    TAG_INT,
+    TAG_LONG,
+    TAG_FLOAT,
+    TAG_DOUBLE,
+    TAG_BYTE_ARRAY,
+    TAG_STRING,
+    TAG_LIST,
+    TAG_COMPOUND,
+    TAG_INT_ARRAY,
+};
+
+/* deeper nesting than this is surely a corrupt file */
+#define NBT_MAX_DEPTH 512
+
+/* the payload sizes of the tag types that always have the same size, -1
+   for the others */
+static const int nbt_fixed_sizes[] = {0, 1, 2, 4, 8, 4, 8, -1, -1, -1, -1, -1};
+
+typedef struct {
+    const unsigned char *data;
+    Py_ssize_t length;
+    Py_ssize_t pos;
+    /* the names of the tags to leave out of compounds, or NULL */
+    PyObject *skip;
+} NBTBuffer;
+
+static PyObject *nbt_read_payload(NBTBuffer *buf, int tagtype, int depth);
+static int nbt_skip_payload(NBTBuffer *buf, int tagtype, int depth);
+
+/* makes sure there are count bytes left to read, and sets an
+   exception if not */
+static inline int
+nbt_has_bytes(NBTBuffer *buf, Py_ssize_t count) {
+    if (count < 0 || buf->length - buf->pos < count) {
+        PyErr_SetString(PyExc_ValueError, "unexpected end of nbt data");
+        return 0;
+    }
+    return 1;
+}
+
+/* big-endian readers, these assume nbt_has_bytes has been checked */
+static inline unsigned short
+nbt_get_u16(NBTBuffer *buf) {
+    const unsigned char *p = buf->data + buf->pos;
+    buf->pos += 2;
+    return (p[0] << 8) | p[1];
+}
+
+static inline unsigned int
+nbt_get_u32(NBTBuffer *buf) {
+    const unsigned char *p = buf->data + buf->pos;
+    buf->pos += 4;
+    return ((unsigned int)p[0] << 24) | ((unsigned int)p[1] << 16) |
+        ((unsigned int)p[2] << 8) | (unsigned int)p[3];
+}
+
+static inline unsigned PY_LONG_LONG
+nbt_get_u64(NBTBuffer *buf) {
+    unsigned PY_LONG_LONG hi = nbt_get_u32(buf);
+    unsigned PY_LONG_LONG lo = nbt_get_u32(buf);
+    return (hi << 32) | lo;
+}
+
+/* reads a tag string (used for both names and TAG_String payloads) */
+static PyObject *
+nbt_read_string(NBTBuffer *buf) {
+    unsigned short length;
+    PyObject *ret;
+
+    if (!nbt_has_bytes(buf, 2))
+        return NULL;
+    length = nbt_get_u16(buf);
+    if (!nbt_has_bytes(buf, length))
+        return NULL;
+
+    ret = PyUnicode_DecodeUTF8((const char *)(buf->data + buf->pos), length, NULL);
+    buf->pos += length;
+    return ret;
+}
+
+static PyObject *
+nbt_read_list(NBTBuffer *buf, int depth) {
+    int tagtype;
+    int length, i;
+    PyObject *list;
+
+    if (!nbt_has_bytes(buf, 5))
+        return NULL;
+    tagtype = buf->data[buf->pos++];
+    length = (int)nbt_get_u32(buf);
+
+    /* every item but TAG_End takes at least one byte, so a corrupt length
+       is caught here rather than by allocating a huge list */
+    if (tagtype != TAG_END && length > 0 && !nbt_has_bytes(buf, length))
+        return NULL;
+
+    /* the python reader happily reads a negative length as empty */
+    list = PyList_New(length > 0 ? length : 0);
+    if (list == NULL)
+        return NULL;
+
+    for (i = 0; i < length; i++) {
+        PyObject *item = nbt_read_payload(buf, tagtype, depth + 1);
+        if (item == NULL) {
+            Py_DECREF(list);
+            return NULL;
+        }
+        /* steals the reference */
+        PyList_SET_ITEM(list, i, item);
+    }
+
+    return list;
+}
+
+static PyObject *
+nbt_read_compound(NBTBuffer *buf, int depth) {
+    PyObject *tags = PyDict_New();
+    if (tags == NULL)
+        return NULL;
+
+    while (1) {
+        int tagtype;
+        PyObject *name, *payload;
+        int err;
+
+        if (!nbt_has_bytes(buf, 1))
+            goto fail;
+        tagtype = buf->data[buf->pos++];
+        if (tagtype == TAG_END)
+            break;
+
+        name = nbt_read_string(buf);
+        if (name == NULL)
+            goto fail;
+        if (buf->skip) {
+            err = PySequence_Contains(buf->skip, name);
+            if (err != 0) {
+                Py_DECREF(name);
+                if (err < 0 || !nbt_skip_payload(buf, tagtype, depth + 1))
+                    goto fail;
+                continue;
+            }
+        }
+        payload = nbt_read_payload(buf, tagtype, depth + 1);
+        if (payload == NULL) {
+            Py_DECREF(name);
+            goto fail;
+        }
+
+        err = PyDict_SetItem(tags, name, payload);
+        Py_DECREF(name);
+        Py_DECREF(payload);
+        if (err < 0)
+            goto fail;
+    }
+
+    return tags;
+
+fail:
+    Py_DECREF(tags);
+    return NULL;
+}
+
+/* reads the payload of a tag with the given type */
+static PyObject *
+nbt_read_payload(NBTBuffer *buf, int tagtype, int depth) {
+    if (depth > NBT_MAX_DEPTH) {
+        PyErr_SetString(PyExc_ValueError, "nbt data is nested too deeply");
+        return NULL;
+    }
+
+    switch (tagtype) {
+    case TAG_END:
+        /* nothing to read */
+        return PyInt_FromLong(0);
+    case TAG_BYTE:
+        if (!nbt_has_bytes(buf, 1))
+            return NULL;
+        return PyInt_FromLong((signed char)buf->data[buf->pos++]);
+    case TAG_SHORT:
+        if (!nbt_has_bytes(buf, 2))
+            return NULL;
+        return PyInt_FromLong((short)nbt_get_u16(buf));
+    case TAG_INT:
+        if (!nbt_has_bytes(buf, 4))
+            return NULL;
+        return PyInt_FromLong((int)nbt_get_u32(buf));
+    case TAG_LONG: {
+        PY_LONG_LONG value;
+        if (!nbt_has_bytes(buf, 8))
+            return NULL;
+        value = (PY_LONG_LONG)nbt_get_u64(buf);
+        /* match struct.unpack, which gives an int when it fits */
+        if (value >= LONG_MIN && value <= LONG_MAX)
+            return PyInt_FromLong((long)value);
+        return PyLong_FromLongLong(value);
+    }
+    case TAG_FLOAT: {
+        union { unsigned int i; float f; } value;
+        if (!nbt_has_bytes(buf, 4))
+            return NULL;
+        value.i = nbt_get_u32(buf);
+        return PyFloat_FromDouble(value.f);
+    }
+    case TAG_DOUBLE: {
+        union { unsigned PY_LONG_LONG i; double d; } value;
+        if (!nbt_has_bytes(buf, 8))
+            return NULL;
+        value.i = nbt_get_u64(buf);
+        return PyFloat_FromDouble(value.d);
+    }
+    case TAG_BYTE_ARRAY: {
+        int length;
+        PyObject *ret;
+        if (!nbt_has_bytes(buf, 4))
+            return NULL;
+        length = (int)nbt_get_u32(buf);
+        if (!nbt_has_bytes(buf, length))
+            return NULL;
+        ret = PyString_FromStringAndSize((const char *)(buf->data + buf->pos), length);
+        buf->pos += length;
+        return ret;
+    }
+    case TAG_STRING:
+        return nbt_read_string(buf);
+    case TAG_LIST:
+        return nbt_read_list(buf, depth);
+    case TAG_COMPOUND:
+        return nbt_read_compound(buf, depth);
+    case TAG_INT_ARRAY: {
+        int length, i;
+        PyObject *ret;
+        if (!nbt_has_bytes(buf, 4))
+            return NULL;
+        length = (int)nbt_get_u32(buf);
+        if (!nbt_has_bytes(buf, (Py_ssize_t)length * 4))
+            return NULL;
+        ret = PyTuple_New(length);
+        if (ret == NULL)
+            return NULL;
+        for (i = 0; i < length; i++) {
+            PyObject *item = PyInt_FromLong((int)nbt_get_u32(buf));
+            if (item == NULL) {
+                Py_DECREF(ret);
+                return NULL;
+            }
+            PyTuple_SET_ITEM(ret, i, item);
+        }
+        return ret;
+    }
+    default:
+        PyErr_Format(PyExc_ValueError, "unknown nbt tag type: %i", tagtype);
+        return NULL;
+    }
+}
+
+/* reads past count bytes */
+static inline int
+nbt_skip_bytes(NBTBuffer *buf, Py_ssize_t count) {
+    if (!nbt_has_bytes(buf, count))
+        return 0;
+    buf->pos += count;
+    return 1;
+}
+
+/* reads past the payload of a tag with the given type, without building
+   anything. Returns false (with an exception set) on bad data */
+static int
+nbt_skip_payload(NBTBuffer *buf, int tagtype, int depth) {
+    int itemtype, length, i;
+
+    if (depth > NBT_MAX_DEPTH) {
+        PyErr_SetString(PyExc_ValueError, "nbt data is nested too deeply");
+        return 0;
+    }
+    if (tagtype >= 0 && tagtype <= TAG_INT_ARRAY && nbt_fixed_sizes[tagtype] >= 0)
+        return nbt_skip_bytes(buf, nbt_fixed_sizes[tagtype]);
+
+    switch (tagtype) {
+    case TAG_BYTE_ARRAY:
+        if (!nbt_has_bytes(buf, 4))
+            return 0;
+        length = (int)nbt_get_u32(buf);
+        return nbt_skip_bytes(buf, length);
+    case TAG_STRING:
+        if (!nbt_has_bytes(buf, 2))
+            return 0;
+        length = nbt_get_u16(buf);
+        return nbt_skip_bytes(buf, length);
+    case TAG_LIST:
+        if (!nbt_has_bytes(buf, 5))
+            return 0;
+        itemtype = buf->data[buf->pos++];
+        length = (int)nbt_get_u32(buf);
+        /* like nbt_read_list, a negative length is an empty list */
+        if (length <= 0)
+            return 1;
+        if (itemtype >= 0 && itemtype <= TAG_INT_ARRAY && nbt_fixed_sizes[itemtype] >= 0)
+            return nbt_skip_bytes(buf, (Py_ssize_t)length * nbt_fixed_sizes[itemtype]);
+        for (i = 0; i < length; i++) {
+            if (!nbt_skip_payload(buf, itemtype, depth + 1))
+                return 0;
+        }
+        return 1;
+    case TAG_COMPOUND:
+        while (1) {
+            if (!nbt_has_bytes(buf, 1))
+                return 0;
+            itemtype = buf->data[buf->pos++];
+            if (itemtype == TAG_END)
+                return 1;
+            if (!nbt_has_bytes(buf, 2))
+                return 0;
+            length = nbt_get_u16(buf);
+            if (!nbt_skip_bytes(buf, length) ||
+                !nbt_skip_payload(buf, itemtype, depth + 1))
+                return 0;
+        }
+    case TAG_INT_ARRAY:
+        if (!nbt_has_bytes(buf, 4))
+            return 0;
+        length = (int)nbt_get_u32(buf);
+        return nbt_skip_bytes(buf, (Py_ssize_t)length * 4);
+    default:
+        PyErr_Format(PyExc_ValueError, "unknown nbt tag type: %i", tagtype);
+        return 0;
+    }
+}
+
+/* python-facing decoder, takes an uncompressed NBT string (or any
+   read-only buffer) and returns a (name, payload) tuple, like
+   NBTFileReader.read_all(). Raises ValueError on bad data.
+
+   The optional second argument is a collection of tag names to leave out
+   of every compound. */
+PyObject *
+nbt_load(PyObject *self, PyObject *args) {
+    const char *data;
+    /* without PY_SSIZE_T_CLEAN, s# fills in an int */
+    int length;
+    NBTBuffer buf;
+    PyObject *skip = NULL;
+    PyObject *name, *payload, *ret;
+
+    if (!PyArg_ParseTuple(args, "s#|O", &data, &length, &skip))
+        return NULL;
+
+    buf.data = (const unsigned char *)data;
+    buf.length = length;
+    buf.pos = 0;
+    buf.skip = NULL;
+    if (skip != NULL && skip != Py_None) {
+        Py_ssize_t count = PyObject_Size(skip);
+        if (count < 0)
+            return NULL;
+        if (count > 0)
+            buf.skip = skip;
+    }
+
+    if (!nbt_has_bytes(&buf, 1))
+        return NULL;
+    if (buf.data[buf.pos++] != TAG_COMPOUND) {
+        PyErr_SetString(PyExc_ValueError, "Expected a tag compound");
+        return NULL;
+    }
+
+    name = nbt_read_string(&buf);
+    if (name == NULL)
+        return NULL;
+    payload = nbt_read_compound(&buf, 0);
+    if (payload == NULL) {
+        Py_DECREF(name);
+        return NULL;
+    }
+
+    ret = PyTuple_Pack(2, name, payload);
+    Py_DECREF(name);
+    Py_DECREF(payload);
+    return ret;
+}
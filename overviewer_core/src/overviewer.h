@@ -26,7 +26,7 @@
 
 // increment this value if you've made a change to the c extesion
 // and want to force users to rebuild
-#define OVERVIEWER_EXTENSION_VERSION 46
+#define OVERVIEWER_EXTENSION_VERSION 57
 
 /* Python PIL, and numpy headers */
 #include <Python.h>
@@ -72,11 +72,49 @@ PyObject *draw_triangle(PyObject *dest, int inclusive,
 PyObject *resize_half(PyObject *dest, PyObject *src);
 PyObject *resize_half_wrap(PyObject *self, PyObject *args);
 
+/* in atlas.c */
+/* one entry of Textures.blockmap */
+typedef struct {
+    /* the (image, light mask) tuple, owned, and its items. NULL if this
+       block has no image */
+    PyObject *tex, *src, *mask_light;
+    /* the image, if it can be drawn with draw_sprite */
+    Imaging imsrc;
+    /* for each row of imsrc: the first column that isn't fully
+       transparent, one past the last one, and whether everything in
+       between is fully opaque */
+    unsigned short *spans;
+} BlockSprite;
+typedef struct {
+    /* the blockmap this was built from, owned */
+    PyObject *blockmap;
+    /* indexed like the blockmap, with empty entries filled in with the
+       entry for data 0 */
+    BlockSprite *sprites;
+    unsigned int num_sprites;
+    /* the spans of all the sprites */
+    unsigned short *spans;
+} BlockAtlas;
+#define BLOCK_ATLAS(capsule) ((BlockAtlas *)PyCapsule_GetPointer((capsule), NULL))
+PyObject *get_block_atlas(PyObject *textures);
+/* in composite.c, alpha_over for a sprite with itself as the mask */
+void draw_sprite(Imaging dest, BlockSprite *sprite, int dx, int dy);
+
 /* forward declaration of RenderMode object */
 typedef struct _RenderMode RenderMode;
+/* and of the light tables the lighting primitives keep, see lighting.h */
+typedef struct _LightCache LightCache;
+/* and of the nether primitive's roof table, see nether.h */
+typedef struct _NetherCache NetherCache;
 
 /* in iterate.c */
 #define SECTIONS_PER_CHUNK 16
+/* section summaries */
+#define SECTION_EMPTY      (1 << 0) /* nothing but air */
+#define SECTION_OPAQUE     (1 << 1) /* no transparent blocks at all */
+#define SECTION_OPAQUE_X15 (1 << 2) /* ... on its x = 15 face */
+#define SECTION_OPAQUE_Z0  (1 << 3) /* ... on its z = 0 face */
+#define SECTION_OPAQUE_Y0  (1 << 4) /* ... on its y = 0 face */
 typedef struct {
     /* whether this chunk is loaded: use load_chunk to load */
     int loaded;
@@ -84,8 +122,17 @@ typedef struct {
     PyObject *biomes;
     /* all the sections in a given chunk */
     struct {
-        /* all there is to know about each section */
+        /* the section mapping itself, NULL if the section doesn't exist */
+        PyObject *section;
+        /* all there is to know about each section. These are fetched
+           from the section the first time they're needed, use
+           get_section_array to get at them. Py_None means the section
+           has no such array. */
         PyObject *blocks, *data, *skylight, *blocklight;
+        /* what's known about the blocks of the section, SECTION_* flags
+           set in summary_known once they've been worked out. See
+           section_is() in iterate.c */
+        unsigned char summary_known, summary;
     } sections[SECTIONS_PER_CHUNK];
 } ChunkData;
 typedef struct {
@@ -96,19 +143,23 @@ typedef struct {
     
     /* the tile image and destination */
     PyObject *img;
+    Imaging imdest;
     int imgx, imgy;
     
     /* the current render mode in use */
     RenderMode *rendermode;
     
-    /* the Texture object */
+    /* the Texture object, and the north direction it was made for */
     PyObject *textures;
+    int northdir;
     
     /* the block position and type, and the block array */
     int x, y, z;
     unsigned short block;
     unsigned char block_data;
     unsigned short block_pdata;
+    /* the image being drawn for it */
+    BlockSprite *sprite;
 
     /* useful information about this, and neighboring, chunks */
     PyObject *blockdatas;
@@ -116,11 +167,21 @@ typedef struct {
     
     /* 3x3 array of this and neighboring chunk columns */
     ChunkData chunks[3][3];    
+    
+    /* the lighting primitives' light tables for the section being drawn,
+       NULL until they're first needed. Freed with free() once the
+       render is done */
+    LightCache *lightcache;
+    /* the same for the nether primitive's table */
+    NetherCache *nethercache;
 } RenderState;
 PyObject *init_chunk_render(void);
 /* returns true on error, x,z relative */
 int load_chunk(RenderState* state, int x, int z, unsigned char required);
+/* fetches a section array into its slot, use get_section_array instead */
+PyObject *load_section_array(ChunkData *chunk, int section, int type);
 PyObject *chunk_render(PyObject *self, PyObject *args);
+PyObject *tile_render(PyObject *self, PyObject *args);
 typedef enum
 {
     KNOWN,
@@ -158,6 +219,40 @@ typedef enum
     SKYLIGHT,
     BIOMES,
 } DataType;
+/* returns a borrowed reference to one of the arrays (not BIOMES) of a
+   loaded chunk section, or NULL if there isn't one. The section expands
+   it on first access, see world.ChunkSection. */
+static inline PyObject *get_section_array(ChunkData *chunk, int section, DataType type)
+{
+    PyObject *array = NULL;
+    switch (type)
+    {
+    case BLOCKS:
+        array = chunk->sections[section].blocks;
+        break;
+    case DATA:
+        array = chunk->sections[section].data;
+        break;
+    case BLOCKLIGHT:
+        array = chunk->sections[section].blocklight;
+        break;
+    case SKYLIGHT:
+        array = chunk->sections[section].skylight;
+        break;
+    default:
+        return NULL;
+    };
+    
+    if (array == NULL) {
+        if (chunk->sections[section].section == NULL)
+            return NULL;
+        array = load_section_array(chunk, section, type);
+    }
+    if (array == Py_None)
+        return NULL;
+    return array;
+}
+
 static inline unsigned int get_data(RenderState *state, DataType type, int x, int y, int z)
 {
     int chunkx = 1, chunky = state->chunky, chunkz = 1;
@@ -198,23 +293,10 @@ static inline unsigned int get_data(RenderState *state, DataType type, int x, in
             return def;
     }
     
-    switch (type)
-    {
-    case BLOCKS:
-        data_array = state->chunks[chunkx][chunkz].sections[chunky].blocks;
-        break;
-    case DATA:
-        data_array = state->chunks[chunkx][chunkz].sections[chunky].data;
-        break;
-    case BLOCKLIGHT:
-        data_array = state->chunks[chunkx][chunkz].sections[chunky].blocklight;
-        break;
-    case SKYLIGHT:
-        data_array = state->chunks[chunkx][chunkz].sections[chunky].skylight;
-        break;
-    case BIOMES:
+    if (type == BIOMES)
         data_array = state->chunks[chunkx][chunkz].biomes;
-    };
+    else
+        data_array = get_section_array(&(state->chunks[chunkx][chunkz]), chunky, type);
     
     if (data_array == NULL)
         return def;
@@ -234,4 +316,7 @@ void init_endian(void);
 unsigned short big_endian_ushort(unsigned short in);
 unsigned int big_endian_uint(unsigned int in);
 
+/* in nbt.c */
+PyObject *nbt_load(PyObject *self, PyObject *args);
+
 #endif /* __OVERVIEWER_H_INCLUDED__ */
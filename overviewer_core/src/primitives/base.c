@@ -78,8 +78,15 @@ base_draw(void *data, RenderState *state, PyObject *src, PyObject *mask, PyObjec
     unsigned char below_block = get_data(state, BLOCKS, state->x, state->y-1, state->z);
     unsigned char below_data = get_data(state, DATA, state->x, state->y-1, state->z);
 
-    /* draw the block! */
-    alpha_over(state->img, src, mask, state->imgx, state->imgy, 0, 0);
+    /* draw the block! This is called without the GIL, which only
+       draw_sprite can do without */
+    if (state->sprite && state->sprite->imsrc && src == state->sprite->src && mask == src) {
+        draw_sprite(state->imdest, state->sprite, state->imgx, state->imgy);
+    } else {
+        PyGILState_STATE gil = PyGILState_Ensure();
+        alpha_over(state->img, src, mask, state->imgx, state->imgy, 0, 0);
+        PyGILState_Release(gil);
+    }
     
     /* check for biome-compatible blocks
      *
@@ -117,6 +124,7 @@ base_draw(void *data, RenderState *state, PyObject *src, PyObject *mask, PyObjec
         unsigned char r = 255, g = 255, b = 255;
         PyObject *color_table = NULL;
         unsigned char flip_xy = 0;
+        PyGILState_STATE gil = PyGILState_Ensure();
         
         if (state->block == 2) {
             /* grass needs a special facemask */
@@ -247,6 +255,7 @@ base_draw(void *data, RenderState *state, PyObject *src, PyObject *mask, PyObjec
         
         /* final coloration */
         tint_with_mask(state->img, r, g, b, 255, facemask, state->imgx, state->imgy, 0, 0);
+        PyGILState_Release(gil);
     }
 }
 
@@ -257,4 +266,5 @@ RenderPrimitiveInterface primitive_base = {
     base_occluded,
     NULL,
     base_draw,
+    1,
 };
@@ -18,6 +18,7 @@
 #include "../overviewer.h"
 #include "lighting.h"
 #include <math.h>
+#include <string.h>
 
 /* figures out the color from a given skylight and blocklight,
    used in lighting calculations */
@@ -145,10 +146,52 @@ estimate_blocklevel(RenderPrimitiveLighting *self, RenderState *state,
     return blocklevel;
 }
 
-inline void
-get_lighting_color(RenderPrimitiveLighting *self, RenderState *state,
-                   int x, int y, int z,
-                   unsigned char *r, unsigned char *g, unsigned char *b) {
+/* returns the slot for (x, y, z) in one of the light tables of the
+ * section being drawn, or NULL if it's outside of them. Its color is only
+ * valid if its generation matches the cache's, otherwise the caller works
+ * it out, stores it and sets the generation.
+ *
+ * owner is the primitive filling in the tables, their contents depend on
+ * its options */
+LightColor *
+get_light_table_slot(void *owner, RenderState *state, int table, int x, int y, int z) {
+    LightCache *cache = state->lightcache;
+    
+    x -= LIGHT_TABLE_MIN;
+    y -= LIGHT_TABLE_MIN;
+    z -= LIGHT_TABLE_MIN;
+    if (x < 0 || x >= LIGHT_TABLE_SIZE || y < 0 || y >= LIGHT_TABLE_SIZE ||
+        z < 0 || z >= LIGHT_TABLE_SIZE)
+        return NULL;
+    
+    if (cache == NULL) {
+        cache = calloc(1, sizeof(LightCache));
+        if (cache == NULL)
+            return NULL;
+        state->lightcache = cache;
+    }
+    if (cache->generation == 0 || cache->owner != owner ||
+        cache->chunkx != state->chunkx || cache->chunky != state->chunky ||
+        cache->chunkz != state->chunkz) {
+        cache->owner = owner;
+        cache->chunkx = state->chunkx;
+        cache->chunky = state->chunky;
+        cache->chunkz = state->chunkz;
+        cache->generation++;
+        if (cache->generation == 0) {
+            /* wrapped around, so old entries could look valid */
+            memset(cache->tables, 0, sizeof(cache->tables));
+            cache->generation = 1;
+        }
+    }
+    
+    return &(cache->tables[table][(x * LIGHT_TABLE_SIZE + y) * LIGHT_TABLE_SIZE + z]);
+}
+
+static void
+calculate_lighting_color(RenderPrimitiveLighting *self, RenderState *state,
+                         int x, int y, int z,
+                         unsigned char *r, unsigned char *g, unsigned char *b) {
 
     /* placeholders for later data arrays, coordinates */
     unsigned char block, skylevel, blocklevel;
@@ -195,6 +238,30 @@ get_lighting_color(RenderPrimitiveLighting *self, RenderState *state,
     self->calculate_light_color(self, MIN(skylevel, 15), MIN(blocklevel, 15), r, g, b);
 }
 
+/* the light color at the given (possibly non-local) coordinates, looked
+ * up in the light tables if it was worked out before */
+inline void
+get_lighting_color(RenderPrimitiveLighting *self, RenderState *state,
+                   int x, int y, int z,
+                   unsigned char *r, unsigned char *g, unsigned char *b) {
+    LightColor *slot = get_light_table_slot(self, state, LIGHT_TABLE_BLOCKS, x, y, z);
+    
+    if (slot && slot->generation == state->lightcache->generation) {
+        *r = slot->r;
+        *g = slot->g;
+        *b = slot->b;
+        return;
+    }
+    
+    calculate_lighting_color(self, state, x, y, z, r, g, b);
+    if (slot) {
+        slot->r = *r;
+        slot->g = *g;
+        slot->b = *b;
+        slot->generation = state->lightcache->generation;
+    }
+}
+
 /* does per-face occlusion checking for do_shading_with_mask */
 inline int
 lighting_is_face_occluded(RenderState *state, int skip_sides, int x, int y, int z) {
@@ -38,8 +38,51 @@ typedef struct {
     int night;
 } RenderPrimitiveLighting;
 
+/* light tables
+ *
+ * The light color of a block takes a handful of get_data calls to work
+ * out, more for stairs and slabs, and every block drawn needs those of
+ * up to three of its neighbors, smooth-lighting even those of four
+ * blocks for each corner of each face. Most of these are shared between
+ * neighboring blocks, so they're kept in tables for the section being
+ * drawn, covering it and two blocks around it, and only worked out the
+ * first time they're needed.
+ *
+ * The tables live in RenderState.lightcache rather than the primitive,
+ * as a compiled rendermode's primitives are shared by every section and
+ * thread drawing with it. */
+#define LIGHT_TABLE_MIN (-2)
+#define LIGHT_TABLE_SIZE (16 + 2 * 2)
+enum
+{
+    /* the color of each block, see get_lighting_color */
+    LIGHT_TABLE_BLOCKS,
+    /* smooth-lighting's average of the four blocks around each corner,
+       one table for each direction a face can point in. The corner of
+       four blocks is filed under the one with the lowest coordinates */
+    LIGHT_TABLE_CORNERS_Y,
+    LIGHT_TABLE_CORNERS_X,
+    LIGHT_TABLE_CORNERS_Z,
+    NUM_LIGHT_TABLES,
+};
+typedef struct {
+    unsigned char r, g, b;
+    /* the LightCache generation this color was worked out in, it's
+       not valid for any other */
+    unsigned int generation;
+} LightColor;
+struct _LightCache {
+    /* the primitive and section the tables are for, and a counter that's
+       bumped whenever those change, to throw away all that's in them */
+    void *owner;
+    int chunkx, chunky, chunkz;
+    unsigned int generation;
+    LightColor tables[NUM_LIGHT_TABLES][LIGHT_TABLE_SIZE * LIGHT_TABLE_SIZE * LIGHT_TABLE_SIZE];
+};
+
 /* exposed so that smooth-lighting can use them */
 extern RenderPrimitiveInterface primitive_lighting;
+LightColor *get_light_table_slot(void *owner, RenderState *state, int table, int x, int y, int z);
 int lighting_is_face_occluded(RenderState *state, int skip_sides, int x, int y, int z);
 void get_lighting_color(RenderPrimitiveLighting *self, RenderState *state,
                         int x, int y, int z,
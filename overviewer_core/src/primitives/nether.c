@@ -19,10 +19,11 @@
 #include "nether.h"
 
 static void
-walk_chunk(RenderState *state, RenderPrimitiveNether *data) {
+walk_chunk(RenderState *state, NetherCache *data) {
     int x, y, z;
     int id;
 
+    memset(data->remove_block, 0, sizeof(data->remove_block));
     for (x = -1; x < WIDTH + 1; x++) {
         for (z = -1; z < DEPTH + 1; z++) {
             id = get_data(state, BLOCKS, x, NETHER_ROOF - (state->chunky * 16), z);
@@ -43,24 +44,31 @@ walk_chunk(RenderState *state, RenderPrimitiveNether *data) {
         }
     }
     data->walked_chunk = 1;
+    data->chunkx = state->chunkx;
+    data->chunkz = state->chunkz;
 }
 
 static int
 nether_hidden(void *data, RenderState *state, int x, int y, int z) {
-    RenderPrimitiveNether* self;
+    NetherCache *cache = state->nethercache;
     int real_y;
 
-    self = (RenderPrimitiveNether *)data;
-
-    if (!(self->walked_chunk))
-        walk_chunk(state, self);
+    if (cache == NULL) {
+        cache = calloc(1, sizeof(NetherCache));
+        if (cache == NULL)
+            return 0;
+        state->nethercache = cache;
+    }
+    if (!(cache->walked_chunk) || cache->chunkx != state->chunkx ||
+        cache->chunkz != state->chunkz)
+        walk_chunk(state, cache);
 
     real_y = y + (state->chunky * 16);
-    return self->remove_block[x+1][real_y][z+1];
+    return cache->remove_block[x+1][real_y][z+1];
 }
 
 RenderPrimitiveInterface primitive_nether = {
-    "nether", sizeof(RenderPrimitiveNether),
+    "nether", 0,
     NULL,
     NULL,
     NULL,
@@ -22,11 +22,18 @@
 #define DEPTH 16
 #define HEIGHT 256
 
-// add two to these because the primative functions should expect to
-// deal with x and z values of -1 and 16
-typedef struct {
+/* the blocks of the nether roof of a chunk column, to be hidden. Worked
+ * out the first time a section of the column is drawn.
+ *
+ * This lives in RenderState.nethercache rather than the primitive, as a
+ * compiled rendermode's primitives are shared by every section and
+ * thread drawing with it. */
+struct _NetherCache {
+    /* whether the table is filled in, and the chunk column it's for */
     int walked_chunk;
+    int chunkx, chunkz;
 
+    // add two to these because the primative functions should expect to
+    // deal with x and z values of -1 and 16
     int remove_block[WIDTH+2][HEIGHT][DEPTH+2];
-    
-} RenderPrimitiveNether;
+};
@@ -27,7 +27,7 @@ netherold_hidden(void *data, RenderState *state, int x, int y, int z) {
     unsigned char missing_section = 0;
     while (y < (SECTIONS_PER_CHUNK - state->chunky) * 16)
     {
-        if (state->chunks[1][1].sections[state->chunky + (y / 16)].blocks == NULL) {
+        if (state->chunks[1][1].sections[state->chunky + (y / 16)].section == NULL) {
             missing_section = 1;
             y += 16;
             continue;
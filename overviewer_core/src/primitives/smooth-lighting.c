@@ -128,19 +128,28 @@ enum
     FACE_RIGHT = 2,
 };
 
+/* the light tables the corners of each face are kept in, the corners of
+   faces pointing the same way are shared by the blocks around them */
+static const int corner_tables[] = {
+    LIGHT_TABLE_CORNERS_Y,
+    LIGHT_TABLE_CORNERS_X,
+    LIGHT_TABLE_CORNERS_Z,
+};
+
 static void
-do_shading_with_rule(RenderPrimitiveSmoothLighting *self, RenderState *state, struct SmoothLightingFace face) {
+do_shading_with_rule(RenderPrimitiveSmoothLighting *self, RenderState *state, int faceidx) {
     int i;
     RenderPrimitiveLighting *lighting = (RenderPrimitiveLighting *)self;
+    struct SmoothLightingFace *face = &(lighting_rules[faceidx]);
     int x = state->imgx, y = state->imgy;
-    struct SmoothLightingCorner *pts = face.corners;
+    struct SmoothLightingCorner *pts = face->corners;
     float comp_shade_strength = 1.0 - lighting->strength;
     unsigned char pts_r[4] = {0, 0, 0, 0};
     unsigned char pts_g[4] = {0, 0, 0, 0};
     unsigned char pts_b[4] = {0, 0, 0, 0};
-    int cx = state->x + face.dx;
-    int cy = state->y + face.dy;
-    int cz = state->z + face.dz;
+    int cx = state->x + face->dx;
+    int cy = state->y + face->dy;
+    int cz = state->z + face->dz;
     
     /* first, check for occlusion if the block is in the local chunk */
     if (lighting_is_face_occluded(state, 0, cx, cy, cz))
@@ -151,6 +160,17 @@ do_shading_with_rule(RenderPrimitiveSmoothLighting *self, RenderState *state, st
     {
         unsigned char r, g, b;
         unsigned int rgather = 0, ggather = 0, bgather = 0;
+        LightColor *slot = get_light_table_slot(self, state, corner_tables[faceidx],
+                                                cx + MIN(pts[i].dx1, 0) + MIN(pts[i].dx2, 0),
+                                                cy + MIN(pts[i].dy1, 0) + MIN(pts[i].dy2, 0),
+                                                cz + MIN(pts[i].dz1, 0) + MIN(pts[i].dz2, 0));
+        
+        if (slot && slot->generation == state->lightcache->generation) {
+            pts_r[i] = slot->r;
+            pts_g[i] = slot->g;
+            pts_b[i] = slot->b;
+            continue;
+        }
         
         get_lighting_color(lighting, state, cx, cy, cz,
                            &r, &g, &b);
@@ -179,6 +199,13 @@ do_shading_with_rule(RenderPrimitiveSmoothLighting *self, RenderState *state, st
         pts_r[i] = rgather / 4;
         pts_g[i] = ggather / 4;
         pts_b[i] = bgather / 4;
+        
+        if (slot) {
+            slot->r = pts_r[i];
+            slot->g = pts_g[i];
+            slot->b = pts_b[i];
+            slot->generation = state->lightcache->generation;
+        }
     }
     
     /* draw the face */
@@ -186,7 +213,7 @@ do_shading_with_rule(RenderPrimitiveSmoothLighting *self, RenderState *state, st
                   x+pts[0].imgx, y+pts[0].imgy, pts_r[0], pts_g[0], pts_b[0],
                   x+pts[1].imgx, y+pts[1].imgy, pts_r[1], pts_g[1], pts_b[1],
                   x+pts[2].imgx, y+pts[2].imgy, pts_r[2], pts_g[2], pts_b[2],
-                  x, y, face.touch_up_points, face.num_touch_up_points);
+                  x, y, face->touch_up_points, face->num_touch_up_points);
     draw_triangle(state->img, 0,
                   x+pts[0].imgx, y+pts[0].imgy, pts_r[0], pts_g[0], pts_b[0],
                   x+pts[2].imgx, y+pts[2].imgy, pts_r[2], pts_g[2], pts_b[2],
@@ -239,11 +266,11 @@ smooth_lighting_draw(void *data, RenderState *state, PyObject *src, PyObject *ma
     }
     
     if (light_top)
-        do_shading_with_rule(self, state, lighting_rules[FACE_TOP]);
+        do_shading_with_rule(self, state, FACE_TOP);
     if (light_left)
-        do_shading_with_rule(self, state, lighting_rules[FACE_LEFT]);
+        do_shading_with_rule(self, state, FACE_LEFT);
     if (light_right)
-        do_shading_with_rule(self, state, lighting_rules[FACE_RIGHT]);
+        do_shading_with_rule(self, state, FACE_RIGHT);
 }
 
 RenderPrimitiveInterface primitive_smooth_lighting = {
@@ -105,12 +105,26 @@ RenderMode *render_mode_create(PyObject *mode, RenderState *state) {
         ret->primitives[i] = prim;
     }
     
+    for (i = 0; i < ret->num_primitives; i++) {
+        if (ret->primitives[i]->iface == &primitive_base)
+            ret->occlusion_culling = 1;
+    }
+    for (i = 0; i < ret->num_primitives; i++) {
+        if (ret->primitives[i]->iface->hidden)
+            ret->occlusion_culling = 0;
+    }
+    
+    Py_DECREF(mode_fast);
     return ret;
 }
 
 void render_mode_destroy(RenderMode *self) {
     unsigned int i;
     
+    /* copies of a compiled rendermode belong to the compiled one */
+    if (self->shared)
+        return;
+    
     for (i = 0; i < self->num_primitives; i++) {
         RenderPrimitive *prim = self->primitives[i];
         /* we may be destroying a half-constructed mode, so we need this
@@ -129,6 +143,79 @@ void render_mode_destroy(RenderMode *self) {
     free(self);
 }
 
+/* compiled rendermodes
+ *
+ * Creating a rendermode parses all the options of its primitives, and
+ * starts each of them, which is a fair amount of python work to do for
+ * every chunk section. None of it depends on the section, so
+ * compile_rendermode() does it once, and chunk_render uses the result for
+ * any number of sections. The primitives only read their data once
+ * they're started, so one compiled rendermode can be used by several
+ * threads at once. */
+
+#define COMPILED_RENDERMODE_NAME "c_overviewer.rendermode"
+
+typedef struct {
+    RenderMode *mode;
+    /* the state the primitives were started with, holding references to
+       the world, regionset and textures */
+    RenderState state;
+} CompiledRenderMode;
+
+static void free_compiled_render_mode(CompiledRenderMode *compiled) {
+    render_mode_destroy(compiled->mode);
+    Py_DECREF(compiled->state.world);
+    Py_DECREF(compiled->state.regionset);
+    Py_DECREF(compiled->state.textures);
+    free(compiled);
+}
+
+static void compiled_render_mode_destructor(PyObject *capsule) {
+    free_compiled_render_mode(PyCapsule_GetPointer(capsule, COMPILED_RENDERMODE_NAME));
+}
+
+PyObject *render_mode_compile(PyObject *self, PyObject *args) {
+    PyObject *mode, *capsule;
+    CompiledRenderMode *compiled;
+    
+    compiled = calloc(1, sizeof(CompiledRenderMode));
+    if (compiled == NULL)
+        return PyErr_NoMemory();
+    
+    if (!PyArg_ParseTuple(args, "OOOO", &mode, &(compiled->state.world), &(compiled->state.regionset), &(compiled->state.textures))) {
+        free(compiled);
+        return NULL;
+    }
+    
+    compiled->mode = render_mode_create(mode, &(compiled->state));
+    if (compiled->mode == NULL) {
+        free(compiled);
+        return NULL;
+    }
+    compiled->state.rendermode = compiled->mode;
+    Py_INCREF(compiled->state.world);
+    Py_INCREF(compiled->state.regionset);
+    Py_INCREF(compiled->state.textures);
+    
+    capsule = PyCapsule_New(compiled, COMPILED_RENDERMODE_NAME, compiled_render_mode_destructor);
+    if (capsule == NULL)
+        free_compiled_render_mode(compiled);
+    return capsule;
+}
+
+int render_mode_use_compiled(PyObject *mode, RenderMode *copy, RenderState *state) {
+    CompiledRenderMode *compiled;
+    
+    if (!PyCapsule_IsValid(mode, COMPILED_RENDERMODE_NAME))
+        return 0;
+    
+    compiled = PyCapsule_GetPointer(mode, COMPILED_RENDERMODE_NAME);
+    *copy = *(compiled->mode);
+    copy->state = state;
+    copy->shared = 1;
+    return 1;
+}
+
 int render_mode_occluded(RenderMode *self, int x, int y, int z) {
     unsigned int i;
     int occluded = 0;
@@ -163,8 +250,12 @@ void render_mode_draw(RenderMode *self, PyObject *img, PyObject *mask, PyObject
     unsigned int i;
     for (i = 0; i < self->num_primitives; i++) {
         RenderPrimitive *prim = self->primitives[i];
-        if (prim->iface->draw) {
+        if (prim->iface->draw && prim->iface->draw_nogil) {
+            prim->iface->draw(prim->primitive, self->state, img, mask, mask_light);
+        } else if (prim->iface->draw) {
+            PyGILState_STATE gil = PyGILState_Ensure();
             prim->iface->draw(prim->primitive, self->state, img, mask, mask_light);
+            PyGILState_Release(gil);
         }
     }
 }
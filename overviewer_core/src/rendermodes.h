@@ -61,8 +61,21 @@ typedef struct {
     int (*hidden)(void *, RenderState *, int, int, int);
     /* last two arguments are img and mask, from texture lookup */
     void (*draw)(void *, RenderState *, PyObject *, PyObject *, PyObject *);
+    /* non-zero if draw can be called without the GIL, taking it itself
+     * for whatever it does with python. Otherwise render_mode_draw takes
+     * it for the whole call. occluded and hidden are always called
+     * without it, and start and finish always with it. */
+    int draw_nogil;
 } RenderPrimitiveInterface;
 
+/* A primitive's data is only written by start and finish. A compiled
+ * rendermode (see rendermodes.c) is started once and then shared by every
+ * chunk section it draws, by several threads at once, so occluded, hidden
+ * and draw must treat their data as read-only. Anything they need to
+ * remember between blocks or sections goes in the RenderState, like
+ * lightcache and nethercache, which belong to a single render.
+ */
+
 /* A quick note about the difference between occluded and hidden:
  *
  * Occluded should be used to tell the renderer that a block will not be
@@ -89,6 +102,12 @@ struct _RenderMode {
     unsigned int num_primitives;
     RenderPrimitive **primitives;
     RenderState *state;
+    /* non-zero for the copies chunk_render makes of compiled rendermodes */
+    int shared;
+    /* non-zero if blocks hidden behind non-transparent blocks are never
+       drawn, so chunk_render can leave them out by the section. That's
+       the case when the base primitive is used and nothing is hidden */
+    int occlusion_culling;
 };
 
 /* functions for creating / using rendermodes */
@@ -98,6 +117,12 @@ int render_mode_occluded(RenderMode *self, int x, int y, int z);
 int render_mode_hidden(RenderMode *self, int x, int y, int z);
 void render_mode_draw(RenderMode *self, PyObject *img, PyObject *mask, PyObject *mask_light);
 
+/* compile_rendermode(mode, world, regionset, textures) from python, and
+   for chunk_render: if mode is a compiled rendermode, sets up copy as a
+   rendermode for state that shares its primitives and returns true */
+PyObject *render_mode_compile(PyObject *self, PyObject *args);
+int render_mode_use_compiled(PyObject *mode, RenderMode *copy, RenderState *state);
+
 /* helper function for reading in rendermode options
    works like PyArg_ParseTuple on a support object */
 int render_mode_parse_option(PyObject *support, const char *name, const char *format, ...);
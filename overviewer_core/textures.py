@@ -25,8 +25,15 @@ import numpy
 from PIL import Image, ImageEnhance, ImageOps, ImageDraw
 import logging
 import functools
+import hashlib
+import mmap
+import struct
+import tempfile
+import time
+import multiprocessing
 
 import util
+import c_overviewer
 from c_overviewer import alpha_over
 
 class TextureException(Exception):
@@ -45,7 +52,7 @@ class Textures(object):
     rendering. It accepts a background color, north direction, and
     local textures path.
     """
-    def __init__(self, texturepath=None, bgcolor=(26, 26, 26, 0), northdirection=0):
+    def __init__(self, texturepath=None, bgcolor=(26, 26, 26, 0), northdirection=0, cachedir=None):
         self.bgcolor = bgcolor
         self.rotation = northdirection
         self.find_file_local_path = texturepath
@@ -56,13 +63,23 @@ class Textures(object):
         
         # this is set in in generate()
         self.generated = False
+        
+        # the directory generate() keeps the blockmap in between runs, if
+        # any, and the cache file the blockmap was loaded from
+        self.cachedir = cachedir
+        self.cachefile = None
+        # while generate() runs, maps each file load_image() looked for to
+        # the SHA1 of its contents, or None if it wasn't found
+        self.texture_sources = None
 
         # see load_image_texture()
         self.texture_cache = {}
 
-        # once we find a jarfile that contains a texture, we cache the ZipFile object here
-        self.jar = None
-        self.jarpath = ""
+        # see find_file(): the places it searches, which of those each file
+        # was found in, and the directory listings it has looked at
+        self.find_file_locations = None
+        self.find_file_index = {}
+        self.find_file_dirs = {}
     
     ##
     ## pickle support
@@ -71,7 +88,7 @@ class Textures(object):
     def __getstate__(self):
         # we must get rid of the huge image lists, and other images
         attributes = self.__dict__.copy()
-        for attr in ['blockmap', 'biome_grass_texture', 'watertexture', 'lavatexture', 'firetexture', 'portaltexture', 'lightcolor', 'grasscolor', 'foliagecolor', 'watercolor', 'texture_cache']:
+        for attr in ['blockmap', 'blockatlas', 'biome_grass_texture', 'watertexture', 'lavatexture', 'firetexture', 'portaltexture', 'lightcolor', 'grasscolor', 'foliagecolor', 'watercolor', 'texture_cache', 'find_file_locations', 'find_file_index', 'find_file_dirs']:
             try:
                 del attributes[attr]
             except KeyError:
@@ -82,14 +99,28 @@ class Textures(object):
         for attr, val in attrs.iteritems():
             setattr(self, attr, val)
         self.texture_cache = {}
+        self.find_file_locations = None
+        self.find_file_index = {}
+        self.find_file_dirs = {}
         if self.generated:
-            self.generate()
+            # the cache file was already checked, so map it straight away
+            if self.cachefile is None or not self.load_blockmap_file(self.cachefile):
+                self.generate()
     
     ##
     ## The big one: generate()
     ##
     
-    def generate(self):
+    def generate(self, processes=1):
+        """Generates the blockmap, or loads it from the cache. With more
+        than one process, the block generators are split up between a
+        pool of that many worker processes."""
+        if self.cachedir is not None:
+            if self.load_blockmap_cache():
+                self.generated = True
+                return
+            self.texture_cache = {}
+            self.texture_sources = {}
         
         # generate biome grass mask
         self.biome_grass_texture = self.build_block(self.load_image_texture("assets/minecraft/textures/blocks/grass_top.png"), self.load_image_texture("assets/minecraft/textures/blocks/grass_side_overlay.png"))
@@ -99,23 +130,220 @@ class Textures(object):
         global known_blocks, used_datas
         self.blockmap = [None] * max_blockid * max_data
         
-        for (blockid, data), texgen in blockmap_generators.iteritems():
-            tex = texgen(self, blockid, data)
-            self.blockmap[blockid * max_data + data] = self.generate_texture_tuple(tex)
+        start = time.time()
+        keys = sorted(blockmap_generators.iterkeys())
+        times = {}
+        if processes > 1 and len(keys) > 1:
+            # blocks next to each other mostly use the same textures, so
+            # each job gets a run of them to keep the worker's texture
+            # cache useful
+            chunksize = max(1, len(keys) // (processes * 4))
+            jobs = [keys[i:i + chunksize] for i in xrange(0, len(keys), chunksize)]
+            # the grass mask isn't pickled with the object, so it's sent
+            # along as raw data
+            grass = self.biome_grass_texture
+            pool = multiprocessing.Pool(processes, _init_generate_worker,
+                    (self, (grass.mode, grass.size, grass.tobytes())))
+            try:
+                for results, sources, jobtimes in pool.imap_unordered(_generate_blocks, jobs):
+                    for index, mode, size, imgdata, maskdata in results:
+                        img = Image.frombytes(mode, size, imgdata)
+                        mask = Image.frombytes("L", size, maskdata)
+                        self.blockmap[index] = (img, mask)
+                    if self.texture_sources is not None:
+                        self.texture_sources.update(sources)
+                    for name, (count, seconds) in jobtimes.iteritems():
+                        total = times.get(name, (0, 0))
+                        times[name] = (total[0] + count, total[1] + seconds)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for blockid, data in keys:
+                texgen = blockmap_generators[(blockid, data)]
+                texstart = time.time()
+                tex = texgen(self, blockid, data)
+                self.blockmap[blockid * max_data + data] = self.generate_texture_tuple(tex)
+                total = times.get(texgen.__name__, (0, 0))
+                times[texgen.__name__] = (total[0] + 1, total[1] + time.time() - texstart)
+        
+        logging.debug("Generated %d block images in %.2fs", len(keys), time.time() - start)
+        logging.debug("Time spent in each block generator, slowest first:")
+        for name, (count, seconds) in sorted(times.iteritems(), key=lambda x: -x[1][1]):
+            logging.debug("\t%s: %.3fs for %d images", name, seconds, count)
         
         if self.texture_size != 24:
             # rescale biome grass
             self.biome_grass_texture = self.biome_grass_texture.resize(self.texture_dimensions, Image.ANTIALIAS)
             
             # rescale the rest
-            for i, tex in enumerate(blockmap):
+            for i, tex in enumerate(self.blockmap):
                 if tex is None:
                     continue
                 block = tex[0]
                 scaled_block = block.resize(self.texture_dimensions, Image.ANTIALIAS)
-                blockmap[i] = self.generate_texture_tuple(scaled_block)
+                self.blockmap[i] = self.generate_texture_tuple(scaled_block)
         
         self.generated = True
+        
+        if self.texture_sources is not None:
+            try:
+                self.save_blockmap_cache()
+            except EnvironmentError, e:
+                logging.warning("Could not save the generated textures in %s: %s", self.cachedir, e)
+            self.texture_sources = None
+    
+    ##
+    ## The blockmap cache
+    ##
+    ## generate() saves the blockmap in cachedir, as the raw RGBA data and
+    ## opaque mask of each block image. The file is named by a hash of the
+    ## contents of every texture file generate() looked for, along with
+    ## everything else the images depend on, so it's only loaded again if
+    ## none of that changed. A list file, named by the settings alone,
+    ## records which texture files those were and the cache file's name.
+    ##
+    ## Loading maps the file, and the images use the mapped data directly,
+    ## so the worker processes all share the same pages.
+    ##
+    
+    _blockmap_header = struct.Struct("<8sI")
+    _blockmap_entry = struct.Struct("<iHH")
+    _blockmap_magic = "OVBLKMP1"
+    
+    def _get_settings_key(self):
+        # everything the blockmap depends on besides the texture files
+        return hashlib.sha1(repr((_get_generator_version(), self.bgcolor,
+                self.rotation, self.texture_size, max_blockid, max_data))).hexdigest()
+    
+    def _get_list_path(self):
+        key = hashlib.sha1(repr((self._get_settings_key(), self.find_file_local_path))).hexdigest()
+        return os.path.join(self.cachedir, "blockmap-%s.txt" % key)
+    
+    def _get_cache_path(self, sources):
+        key = hashlib.sha1(repr((self._get_settings_key(), sorted(sources.items())))).hexdigest()
+        return os.path.join(self.cachedir, "blockmap-%s.dat" % key)
+    
+    def load_blockmap_cache(self):
+        """Loads the blockmap from the cache in cachedir, if the
+        texture files it was generated from haven't changed. Returns
+        True on success."""
+        try:
+            with open(self._get_list_path(), "r") as f:
+                lines = f.read().splitlines()
+        except IOError:
+            return False
+        
+        sources = {}
+        for line in lines[1:]:
+            filename, digest = line.rsplit("\t", 1)
+            try:
+                sources[filename] = hashlib.sha1(self.find_file(filename).read()).hexdigest()
+            except TextureException:
+                sources[filename] = None
+            if sources[filename] != (digest if digest != "-" else None):
+                logging.debug("%s changed, generating textures again", filename)
+                return False
+        
+        return self.load_blockmap_file(self._get_cache_path(sources))
+    
+    def load_blockmap_file(self, path):
+        """Maps the given blockmap cache file, and sets up blockmap and
+        biome_grass_texture from it. Returns True on success."""
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return False
+        
+        try:
+            magic, count = self._blockmap_header.unpack_from(data, 0)
+            if magic != self._blockmap_magic:
+                return False
+            offset = self._blockmap_header.size
+            entries = []
+            for i in xrange(count):
+                entries.append(self._blockmap_entry.unpack_from(data, offset))
+                offset += self._blockmap_entry.size
+        except struct.error:
+            return False
+        if offset + sum(w * h * 5 for index, w, h in entries) != len(data):
+            return False
+        
+        blockmap = [None] * max_blockid * max_data
+        for index, w, h in entries:
+            img = Image.frombuffer("RGBA", (w, h), buffer(data, offset, w * h * 4), "raw", "RGBA", 0, 1)
+            offset += w * h * 4
+            mask = Image.frombuffer("L", (w, h), buffer(data, offset, w * h), "raw", "L", 0, 1)
+            offset += w * h
+            if index < 0:
+                self.biome_grass_texture = img
+            else:
+                blockmap[index] = (img, mask)
+        
+        self.blockmap = blockmap
+        self.cachefile = path
+        return True
+    
+    def save_blockmap_cache(self):
+        """Saves the generated blockmap in cachedir, along with the
+        list of texture files it was generated from, and removes the
+        cache files no list refers to any more."""
+        sources = self.texture_sources
+        entries = [(-1, self.biome_grass_texture, self.generate_opaque_mask(self.biome_grass_texture))]
+        for index, tex in enumerate(self.blockmap):
+            if tex is not None:
+                entries.append((index,) + tex)
+        for index, img, mask in entries:
+            if img.mode != "RGBA" or mask.mode != "L" or img.size != mask.size:
+                logging.debug("Not caching the textures, as block %d isn't an RGBA image", index)
+                return
+        
+        if not os.path.isdir(self.cachedir):
+            os.makedirs(self.cachedir)
+        path = self._get_cache_path(sources)
+        
+        fd, tmppath = tempfile.mkstemp(prefix="blockmap-", suffix=".tmp", dir=self.cachedir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self._blockmap_header.pack(self._blockmap_magic, len(entries)))
+            for index, img, mask in entries:
+                f.write(self._blockmap_entry.pack(index, img.size[0], img.size[1]))
+            for index, img, mask in entries:
+                f.write(img.tobytes())
+                f.write(mask.tobytes())
+        try:
+            os.rename(tmppath, path)
+        except OSError:
+            # on Windows, someone else saved the same file first
+            os.remove(tmppath)
+        
+        fd, tmppath = tempfile.mkstemp(prefix="blockmap-", suffix=".tmp", dir=self.cachedir)
+        with os.fdopen(fd, "w") as f:
+            f.write(os.path.basename(path) + "\n")
+            for filename, digest in sorted(sources.items()):
+                f.write("%s\t%s\n" % (filename, digest or "-"))
+        listpath = self._get_list_path()
+        if os.path.exists(listpath):
+            os.remove(listpath)
+        os.rename(tmppath, listpath)
+        
+        # a cache file is in use as long as a list file names it
+        used = set()
+        names = os.listdir(self.cachedir)
+        for name in names:
+            if name.startswith("blockmap-") and name.endswith(".txt"):
+                try:
+                    with open(os.path.join(self.cachedir, name), "r") as f:
+                        used.add(f.readline().strip())
+                except IOError:
+                    pass
+        for name in names:
+            if name.startswith("blockmap-") and name.endswith(".dat") and name not in used:
+                try:
+                    os.remove(os.path.join(self.cachedir, name))
+                except OSError:
+                    # probably still mapped on Windows
+                    pass
     
     ##
     ## Helpers for opening textures
@@ -144,91 +372,128 @@ class Textures(object):
         In all of these, files are searched for in '.', 'anim', 'misc/', and
         'environment/'.
         
+        The locations are worked out, and the resource pack and jar
+        opened, the first time this is called. Where each file was found
+        (or that it wasn't) is remembered, so every file is only
+        searched for once.
         """
         if verbose: logging.info("Starting search for {0}".format(filename))
 
+        try:
+            found = self.find_file_index[filename]
+        except KeyError:
+            found = self._search_file(filename, verbose)
+            self.find_file_index[filename] = found
+
+        if found is None:
+            raise TextureException("Could not find the textures while searching for '{0}'. Try specifying the 'texturepath' option in your config file.\nSet it to the path to a Minecraft Resource pack.\nAlternately, install the Minecraft client (which includes textures)\nAlso see <http://docs.overviewer.org/en/latest/running/#installing-the-textures>\n(Remember, this version of Overviewer requires a 1.7-compatible resource pack)\n(Also note that I won't automatically use snapshots; you'll have to use the texturepath option to use a snapshot jar)".format(filename))
+
+        archive, path = found
+        if archive is not None:
+            return archive.open(path)
+        return open(path, mode)
+
+    def _search_file(self, filename, verbose=False):
+        # Looks for filename in each of the locations find_file() searches,
+        # returning (ZipFile, member name) or (None, file path) for the first
+        # place it's found in, or None
+        
         # a list of subdirectories to search for a given file,
         # after the obvious '.'
         search_dirs = ['anim', 'misc', 'environment', 'item', 'item/chests', 'entity', 'entity/chest']
         search_zip_paths = [filename,] + [d + '/' + filename for d in search_dirs]
-        def search_dir(base):
-            """Search the given base dir for filename, in search_dirs."""
-            for path in [os.path.join(base, d, filename) for d in ['',] + search_dirs]:
-                if verbose: logging.info('filename: ' + filename + ' ; path: ' + path)
-                if os.path.isfile(path):
-                    return path
-
-            return None
         if verbose: logging.info('search_zip_paths: ' +  ', '.join(search_zip_paths))
 
-        # we've sucessfully loaded something from here before, so let's quickly try
-        # this before searching again
-        if self.jar is not None:
-            for jarfilename in search_zip_paths:
-                try:
-                    self.jar.getinfo(jarfilename)
-                    if verbose: logging.info("Found (cached) %s in '%s'", jarfilename, self.jarpath)
-                    return self.jar.open(jarfilename)
-                except (KeyError, IOError), e:
-                    pass
+        for kind, location, archive, names in self._get_texture_locations():
+            if kind == "dir":
+                for path in [os.path.join(location, d, filename) for d in ['',] + search_dirs]:
+                    if verbose: logging.info('filename: ' + filename + ' ; path: ' + path)
+                    if self._is_file(path):
+                        if verbose: logging.info("Found %s in '%s'", filename, path)
+                        return None, path
+            else:
+                if kind == "pack":
+                    # resource packs may leave out the path to the textures
+                    paths = []
+                    for packfilename in search_zip_paths:
+                        paths += [packfilename, 'assets/minecraft/textures/' + packfilename]
+                else:
+                    paths = search_zip_paths
+                for path in paths:
+                    if path in names:
+                        if verbose: logging.info("Found %s in '%s'", path, location)
+                        return archive, path
+            if verbose: logging.info("Did not find the file in '%s'", location)
+
+        return None
+
+    def _is_file(self, path):
+        # os.path.isfile, but each directory is only listed once
+        dirname, basename = os.path.split(path)
+        try:
+            entries = self.find_file_dirs[dirname]
+        except KeyError:
+            try:
+                entries = set(os.listdir(dirname))
+            except OSError:
+                entries = set()
+            self.find_file_dirs[dirname] = entries
+        return basename in entries and os.path.isfile(path)
+
+    def _get_texture_locations(self):
+        # Returns the list of places find_file() searches, in order, as
+        # (kind, path, ZipFile, set of member names) tuples. kind is "dir",
+        # "pack" or "jar", and the last two are None for directories.
+        if self.find_file_locations is not None:
+            return self.find_file_locations
+        locations = []
 
         # A texture path was given on the command line. Search this location
         # for the file first.
         if self.find_file_local_path:
             if os.path.isdir(self.find_file_local_path):
-                path = search_dir(self.find_file_local_path)
-                if path:
-                    if verbose: logging.info("Found %s in '%s'", filename, path)
-                    return open(path, mode)
+                locations.append(("dir", self.find_file_local_path, None, None))
             elif os.path.isfile(self.find_file_local_path):
-                # Must be a resource pack. Look for the requested file within
-                # it.
+                # Must be a resource pack
                 try:
                     pack = zipfile.ZipFile(self.find_file_local_path)
-                    for packfilename in search_zip_paths:
-                        try:
-                            # pack.getinfo() will raise KeyError if the file is
-                            # not found.
-                            pack.getinfo(packfilename)
-                            if verbose: logging.info("Found %s in '%s'", packfilename, self.find_file_local_path)
-                            return pack.open(packfilename)
-                        except (KeyError, IOError):
-                            pass
-                        
-                        try:
-                            # 2nd try with completed path.
-                            packfilename = 'assets/minecraft/textures/' + packfilename
-                            pack.getinfo(packfilename)
-                            if verbose: logging.info("Found %s in '%s'", packfilename, self.find_file_local_path)
-                            return pack.open(packfilename)
-                        except (KeyError, IOError):
-                            pass
+                    locations.append(("pack", self.find_file_local_path, pack, set(pack.namelist())))
                 except (zipfile.BadZipfile, IOError):
                     pass
 
-        # If we haven't returned at this point, then the requested file was NOT
-        # found in the user-specified texture path or resource pack.
-        if verbose: logging.info("Did not find the file in specified texture path")
-
-
-        # Look in the location of the overviewer executable for the given path
+        # Look in the location of the overviewer executable
         programdir = util.get_program_path()
-        path = search_dir(programdir)
-        if path:
-            if verbose: logging.info("Found %s in '%s'", filename, path)
-            return open(path, mode)
+        locations.append(("dir", programdir, None, None))
 
         if sys.platform.startswith("darwin"):
-            path = search_dir("/Applications/Minecraft")
-            if path:
-                if verbose: logging.info("Found %s in '%s'", filename, path)
-                return open(path, mode)
+            locations.append(("dir", "/Applications/Minecraft", None, None))
 
-        if verbose: logging.info("Did not find the file in overviewer executable directory")
-        if verbose: logging.info("Looking for installed minecraft jar files...")
+        # Find an installed minecraft client jar
+        jarpath = self._find_client_jar()
+        if jarpath:
+            try:
+                jar = zipfile.ZipFile(jarpath)
+                locations.append(("jar", jarpath, jar, set(jar.namelist())))
+            except (zipfile.BadZipfile, IOError):
+                pass
 
-        # Find an installed minecraft client jar and look in it for the texture
-        # file we need.
+        # Last ditch effort: look for the file is stored in with the overviewer
+        # installation. We include a few files that aren't included with Minecraft
+        # textures. This used to be for things such as water and lava, since
+        # they were generated by the game and not stored as images. Nowdays I
+        # believe that's not true, but we still have a few files distributed
+        # with overviewer.
+        locations.append(("dir", os.path.join(programdir, "overviewer_core", "data", "textures"), None, None))
+        if hasattr(sys, "frozen") or imp.is_frozen("__main__"):
+            # windows special case, when the package dir doesn't exist
+            locations.append(("dir", os.path.join(programdir, "textures"), None, None))
+
+        self.find_file_locations = locations
+        return locations
+
+    def _find_client_jar(self):
+        # Returns the path to the latest installed non-snapshot client jar
+        # (at least 1.7), or None
         versiondir = ""
         if "APPDATA" in os.environ and sys.platform.startswith("win"):
             versiondir = os.path.join(os.environ['APPDATA'], ".minecraft", "versions")
@@ -241,13 +506,9 @@ class Textures(object):
                     "Application Support", "minecraft", "versions")
 
         try:
-            if verbose: logging.info("Looking in the following directory: \"%s\"" % versiondir)
             versions = os.listdir(versiondir)
-            if verbose: logging.info("Found these versions: {0}".format(versions))
         except OSError:
-            # Directory doesn't exist? Ignore it. It will find no versions and
-            # fall through the checks below to the error at the bottom of the
-            # method.
+            # Directory doesn't exist? Ignore it. It will find no versions.
             versions = []
 
         most_recent_version = [0,0,0]
@@ -271,46 +532,15 @@ class Textures(object):
             if versionparts > most_recent_version:
                 most_recent_version = versionparts
 
-        if most_recent_version != [0,0,0]:
-            if verbose: logging.info("Most recent version >=1.7.0: {0}. Searching it for the file...".format(most_recent_version))
-
-            jarname = ".".join(str(x) for x in most_recent_version)
-            jarpath = os.path.join(versiondir, jarname, jarname + ".jar")
-
-            if os.path.isfile(jarpath):
-                jar = zipfile.ZipFile(jarpath)
-                for jarfilename in search_zip_paths:
-                    try:
-                        jar.getinfo(jarfilename)
-                        if verbose: logging.info("Found %s in '%s'", jarfilename, jarpath)
-                        self.jar, self.jarpath = jar, jarpath
-                        return jar.open(jarfilename)
-                    except (KeyError, IOError), e:
-                        pass
-
-            if verbose: logging.info("Did not find file {0} in jar {1}".format(filename, jarpath))
-        else:
-            if verbose: logging.info("Did not find any non-snapshot minecraft jars >=1.7.0")
-            
-        # Last ditch effort: look for the file is stored in with the overviewer
-        # installation. We include a few files that aren't included with Minecraft
-        # textures. This used to be for things such as water and lava, since
-        # they were generated by the game and not stored as images. Nowdays I
-        # believe that's not true, but we still have a few files distributed
-        # with overviewer.
-        if verbose: logging.info("Looking for texture in overviewer_core/data/textures")
-        path = search_dir(os.path.join(programdir, "overviewer_core", "data", "textures"))
-        if path:
-            if verbose: logging.info("Found %s in '%s'", filename, path)
-            return open(path, mode)
-        elif hasattr(sys, "frozen") or imp.is_frozen("__main__"):
-            # windows special case, when the package dir doesn't exist
-            path = search_dir(os.path.join(programdir, "textures"))
-            if path:
-                if verbose: logging.info("Found %s in '%s'", filename, path)
-                return open(path, mode)
+        if most_recent_version == [0,0,0]:
+            logging.debug("Did not find any non-snapshot minecraft jars >=1.7.0 in '%s'", versiondir)
+            return None
 
-        raise TextureException("Could not find the textures while searching for '{0}'. Try specifying the 'texturepath' option in your config file.\nSet it to the path to a Minecraft Resource pack.\nAlternately, install the Minecraft client (which includes textures)\nAlso see <http://docs.overviewer.org/en/latest/running/#installing-the-textures>\n(Remember, this version of Overviewer requires a 1.7-compatible resource pack)\n(Also note that I won't automatically use snapshots; you'll have to use the texturepath option to use a snapshot jar)".format(filename))
+        jarname = ".".join(str(x) for x in most_recent_version)
+        jarpath = os.path.join(versiondir, jarname, jarname + ".jar")
+        if not os.path.isfile(jarpath):
+            return None
+        return jarpath
 
     def load_image_texture(self, filename):
         # Textures may be animated or in a different resolution than 16x16.  
@@ -333,8 +563,16 @@ class Textures(object):
         if filename in self.texture_cache:
             return self.texture_cache[filename]
         
-        fileobj = self.find_file(filename)
-        buffer = StringIO(fileobj.read())
+        try:
+            fileobj = self.find_file(filename)
+        except TextureException:
+            if self.texture_sources is not None:
+                self.texture_sources[filename] = None
+            raise
+        data = fileobj.read()
+        if self.texture_sources is not None:
+            self.texture_sources[filename] = hashlib.sha1(data).hexdigest()
+        buffer = StringIO(data)
         img = Image.open(buffer).convert("RGBA")
         self.texture_cache[filename] = img
         return img
@@ -751,6 +989,47 @@ class Textures(object):
             return None
         return (img, self.generate_opaque_mask(img))
 
+# The worker side of generate() with more than one process. Each worker gets
+# its own copy of the Textures object, and sends the images back as raw data.
+_generate_textures = None
+
+def _init_generate_worker(textures, grass):
+    global _generate_textures
+    mode, size, data = grass
+    textures.biome_grass_texture = Image.frombytes(mode, size, data)
+    _generate_textures = textures
+
+def _generate_blocks(keys):
+    """Generates the blocks with the given (blockid, data) keys. Returns a
+    list of (blockmap index, mode, size, image data, mask data) tuples, the
+    texture files that were loaded for them (see Textures.texture_sources),
+    and a dict of generator name -> (images, seconds)."""
+    self = _generate_textures
+    if self.texture_sources is not None:
+        self.texture_sources = {}
+    results = []
+    times = {}
+    for blockid, data in keys:
+        texgen = blockmap_generators[(blockid, data)]
+        start = time.time()
+        tex = self.generate_texture_tuple(texgen(self, blockid, data))
+        total = times.get(texgen.__name__, (0, 0))
+        times[texgen.__name__] = (total[0] + 1, total[1] + time.time() - start)
+        if tex is None:
+            continue
+        img, mask = tex
+        results.append((blockid * max_data + data, img.mode, img.size, img.tobytes(), mask.tobytes()))
+    return results, self.texture_sources or {}, times
+
+def _get_generator_version():
+    # the code that generates the blockmap is this module, and alpha_over
+    try:
+        with open(os.path.splitext(__file__)[0] + ".py", "rb") as f:
+            version = hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        version = util.findGitHash()
+    return (version, c_overviewer.extension_version())
+
 ##
 ## The other big one: @material and associated framework
 ##
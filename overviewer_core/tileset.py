@@ -19,15 +19,16 @@ import os
 import os.path
 import sys
 import shutil
-import random
 import functools
 import time
 import errno
 import stat
-import platform
-from collections import namedtuple
+import cPickle
+import zlib
+from collections import namedtuple, defaultdict
 from itertools import product, izip, chain
 
+import numpy
 from PIL import Image
 
 from .util import roundrobin
@@ -86,6 +87,15 @@ do_work(workobj)
     return anything, so the results of its work should be reflected on the
     filesystem or by sending signals.
 
+get_work_item_locality(workobj)
+    Optional. Returns a hashable key for a work item. Work items with the same
+    key read mostly the same data, so a dispatcher with several workers tries
+    to give them all to the same one.
+
+get_caches()
+    Optional. Returns a list of the cache objects the worker reads through.
+    Their hits and misses are reported by the dispatcher.
+
 
 """
 
@@ -98,6 +108,28 @@ def iterate_base4(d):
 # world
 Bounds = namedtuple("Bounds", ("mincol", "maxcol", "minrow", "maxrow"))
 
+# A work item for the batched render mode (see the renderbatch option). It
+# holds the paths of a group of neighboring render-tiles that are rendered
+# together, and of the composite-tiles above them up to the tile at the top
+# of the group, in post-traversal order. Those are made from the rendered
+# images in memory, see TileSet._render_rendertile_batch().
+RenderBatch = namedtuple("RenderBatch", ("tilepaths", "composites"))
+
+# What the chunk scan found in one region file, as kept in the chunk scan
+# index (see TileSet._get_chunk_index()). key is the region's key from
+# iterate_regions(), bounds is a Bounds of its chunks or None if it has no
+# chunks, and cols, rows and mtimes are parallel numpy arrays of the
+# render-tiles its chunks touch and the newest chunk mtime in each.
+RegionScan = namedtuple("RegionScan", ("key", "bounds", "max_mtime", "cols", "rows", "mtimes"))
+
+# Render-tiles under the same tile this many levels up share a locality key
+# (see TileSet.get_work_item_locality()), so groups of up to 4**3 neighboring
+# render-tiles are kept on one worker
+LOCALITY_LEVELS = 3
+
+# Bump this whenever the format of the chunk scan index changes
+CHUNK_INDEX_VERSION = 2
+
 # A note about the implementation of the different rendercheck modes:
 #
 # For reference, here's what the rendercheck modes are:
@@ -283,6 +315,15 @@ class TileSet(object):
             changelist output: each tile written will get outputted to the
             specified fd.
 
+        renderbatch
+            Optional: An integer, 0 (the default) to render each render-tile
+            on its own. Otherwise, render-tiles are grouped by their
+            ancestor this many levels up the quadtree (so 1 groups 2x2
+            tiles, 2 groups 4x4 tiles, and so on) and each group is
+            rendered as one work item. Every chunk section in a group is
+            drawn just once, onto one large canvas, and the tiles are cut
+            out of that.
+
         Other options that must be specified but aren't really documented
         (oops. consider it a TODO):
         * worldname_orig
@@ -389,6 +430,14 @@ class TileSet(object):
         else:
             raise ValueError("imgformat must be one of: 'png' or 'jpg'")
 
+        # The chunk scan index, loaded by _get_chunk_index()
+        self._chunk_index = None
+        self._chunk_index_changed = False
+
+        # The rendermode, compiled by _get_compiled_rendermode() the first
+        # time it's used
+        self._compiled_rendermode = None
+
         # This sets self.treedepth, self.xradius, and self.yradius
         self._set_map_size()
 
@@ -441,13 +490,28 @@ class TileSet(object):
         # Yeah functional programming!
         # and by functional we mean a bastardized python switch statement
         return {
-                0: lambda: self.dirtytree.count_all(),
+                0: lambda: self._count_dirty_work_items(),
                 #there is no good way to guess this so just give total count
                 1: lambda: (4**(self.treedepth+1)-1)/3,
-                2: lambda: self.dirtytree.count_all(),
+                2: lambda: self._count_dirty_work_items(),
                 3: lambda: 0,
                 }[self.options['renderchecks']]()
 
+    def _count_dirty_work_items(self):
+        """Returns the number of work items iterate_work_items() will yield
+        for the dirty tree, which is fewer than the number of tiles when
+        render-tiles are rendered in batches."""
+        if self.options.get('renderbatch', 0) <= 0:
+            return self.dirtytree.count_all()
+        level = self.treedepth - self.options['renderbatch']
+        if level <= 0:
+            # the whole tree is one batch
+            return 1 if self.dirtytree.count() else 0
+        # Each tile at the batch level is replaced by a batch, which also
+        # takes in all the tiles beneath it
+        beneath = sum(sum(1 for _ in self.dirtytree.iterate(l)) for l in xrange(level + 1, self.treedepth))
+        return self.dirtytree.count_all() - self.dirtytree.count() - beneath
+
     def iterate_work_items(self, phase):
         """Iterates over the dirty tiles in the tree and return them in the
         appropriate order with the appropriate dependencies.
@@ -483,37 +547,103 @@ class TileSet(object):
                 os.write(fd, imgpath + "\n")
 
 
-        # See note at the top of this file about the rendercheck modes for an
-        # explanation of what this method does in different situations.
-        #
-        # For modes 0 and 2, self.dirtytree holds exactly the tiles we need to
-        # render. Iterate over the tiles in using the posttraversal() method.
-        # Yield each item. Easy.
-        if self.options['renderchecks'] in (0,2):
-            for tilepath in self.dirtytree.posttraversal(robin=True):
-                dependencies = []
-                # These tiles may or may not exist, but the dispatcher won't
-                # care according to the worker interface protocol It will only
-                # wait for the items that do exist and are in the queue.
-                for i in range(4):
-                    dependencies.append( tilepath + (i,) )
-                if fd:
-                    write_out(tilepath)
-                yield tilepath, dependencies
-
-        else:
-            # For mode 1, self.dirtytree holds every tile that should exist,
-            # but invoke _iterate_and_check_tiles() to determine which tiles
-            # need rendering.
-            for tilepath, mtime, needs_rendering in self._iterate_and_check_tiles(()):
-                if needs_rendering:
+        def iterate_tiles():
+            # See note at the top of this file about the rendercheck modes for
+            # an explanation of what this does in different situations.
+            #
+            # For modes 0 and 2, self.dirtytree holds exactly the tiles we need
+            # to render. Iterate over the tiles in using the posttraversal()
+            # method. Yield each item. Easy.
+            if self.options['renderchecks'] in (0,2):
+                for tilepath in self.dirtytree.posttraversal(robin=True):
                     dependencies = []
+                    # These tiles may or may not exist, but the dispatcher
+                    # won't care according to the worker interface protocol It
+                    # will only wait for the items that do exist and are in the
+                    # queue.
                     for i in range(4):
                         dependencies.append( tilepath + (i,) )
                     if fd:
                         write_out(tilepath)
                     yield tilepath, dependencies
 
+            else:
+                # For mode 1, self.dirtytree holds every tile that should
+                # exist, but invoke _iterate_and_check_tiles() to determine
+                # which tiles need rendering.
+                for tilepath, mtime, needs_rendering in self._iterate_and_check_tiles(()):
+                    if needs_rendering:
+                        dependencies = []
+                        for i in range(4):
+                            dependencies.append( tilepath + (i,) )
+                        if fd:
+                            write_out(tilepath)
+                        yield tilepath, dependencies
+
+        if self.options.get('renderbatch', 0) > 0:
+            for item in self._batch_work_items(iterate_tiles()):
+                yield item
+        else:
+            for item in iterate_tiles():
+                yield item
+
+    def _batch_work_items(self, workitems):
+        """Takes an iterator over (tilepath, dependencies) in post-traversal
+        order, as iterate_work_items() produces, and groups the tiles into
+        RenderBatch work items according to the renderbatch option.
+
+        A group is one tile at the batch level and everything beneath it.
+        Since the traversal is post-order, the group's tiles have all been
+        seen once the tile at its top comes up (the traversal may be
+        round-robin, so other groups can be interleaved). The RenderBatch is
+        then yielded in its place, and the composite-tiles further up depend
+        on it instead of on that tile.
+
+        """
+        level = max(0, self.treedepth - self.options['renderbatch'])
+
+        batchtiles = defaultdict(list)
+        composites = defaultdict(list)
+        # the batches that have replaced the tiles at the batch level
+        batches = {}
+
+        def make_batch(prefix):
+            return RenderBatch(tuple(batchtiles.pop(prefix, ())), tuple(composites.pop(prefix, ())))
+
+        for tilepath, deps in workitems:
+            if len(tilepath) == self.treedepth:
+                batchtiles[tilepath[:level]].append(tilepath)
+            elif len(tilepath) > level:
+                composites[tilepath[:level]].append(tilepath)
+            elif len(tilepath) == level:
+                # The top of a group. This is a post-traversal, so
+                # everything under it has been seen.
+                composites[tilepath].append(tilepath)
+                batch = make_batch(tilepath)
+                batches[tilepath] = batch
+                yield batch, []
+            else:
+                yield tilepath, [batches.pop(dep, dep) for dep in deps]
+
+        # Groups whose top tile didn't need rendering
+        for prefix in set(batchtiles) | set(composites):
+            yield make_batch(prefix), []
+
+    def get_work_item_locality(self, workitem):
+        """Returns the path of the tile LOCALITY_LEVELS levels above the
+        render-tiles that the given work item is part of. Neighboring
+        render-tiles share most of their chunks, so the chunk caches work
+        best if they're rendered by the same worker. Composite-tiles higher
+        up than that are their own key.
+
+        """
+        if isinstance(workitem, RenderBatch):
+            workitem = (workitem.tilepaths or workitem.composites)[0]
+        return workitem[:max(0, self.treedepth - LOCALITY_LEVELS)]
+
+    def get_caches(self):
+        return self.regionset.get_caches()
+
     def do_work(self, tilepath):
         """Renders the given tile.
 
@@ -521,20 +651,25 @@ class TileSet(object):
         integers representing the path of the tile to render.
 
         """
-        if len(tilepath) == self.treedepth:
+        if isinstance(tilepath, RenderBatch):
+            # A group of render-tiles and the composite-tiles above them
+            self._render_rendertile_batch([RenderTile.from_path(p) for p in tilepath.tilepaths],
+                    tilepath.composites)
+        elif len(tilepath) == self.treedepth:
             # A render-tile
             self._render_rendertile(RenderTile.from_path(tilepath))
         else:
             # A composite-tile
-            if len(tilepath) == 0:
-                # The base tile
-                dest = self.outputdir
-                name = "base"
-            else:
-                # All others
-                dest = os.path.join(self.outputdir, *(str(x) for x in tilepath[:-1]))
-                name = str(tilepath[-1])
-            self._render_compositetile(dest, name)
+            self._render_compositetile(*self._get_compositetile_dest(tilepath))
+
+    def _get_compositetile_dest(self, tilepath):
+        """Returns the (dest, name) arguments to _render_compositetile() for
+        the composite-tile with the given path"""
+        if len(tilepath) == 0:
+            # The base tile
+            return self.outputdir, "base"
+        # All others
+        return os.path.join(self.outputdir, *(str(x) for x in tilepath[:-1])), str(tilepath[-1])
 
     def get_initial_data(self):
         """This is called similarly to get_persistent_data, but is called after
@@ -609,16 +744,106 @@ class TileSet(object):
         """
         minrow = mincol = maxrow = maxcol = 0
 
-        for c_x, c_z, _ in self.regionset.iterate_chunks():
-            # Convert these coordinates to row/col
-            col, row = convert_coords(c_x, c_z)
-
-            minrow = min(minrow, row)
-            maxrow = max(maxrow, row)
-            mincol = min(mincol, col)
-            maxcol = max(maxcol, col)
+        for regionscan in self._get_chunk_index().itervalues():
+            if regionscan.bounds is None:
+                continue
+            minrow = min(minrow, regionscan.bounds.minrow)
+            maxrow = max(maxrow, regionscan.bounds.maxrow)
+            mincol = min(mincol, regionscan.bounds.mincol)
+            maxcol = max(maxcol, regionscan.bounds.maxcol)
         return Bounds(mincol, maxcol, minrow, maxrow)
 
+    def _get_chunk_index(self):
+        """Returns the chunk scan index, a dict mapping each region file of
+        the regionset to a RegionScan.
+
+        The index is kept on disk in the output directory between runs, so
+        only the region files whose key changed since the last run (or are
+        new) are scanned again. Regions that went away are dropped.
+
+        """
+        if self._chunk_index is not None:
+            return self._chunk_index
+
+        indexpath = os.path.join(self.outputdir, "chunkscan.dat")
+        regionsetkey = repr(self.regionset)
+        oldindex = {}
+        try:
+            with open(indexpath, "rb") as f:
+                version, key, index = cPickle.load(f)
+            if version == CHUNK_INDEX_VERSION and key == regionsetkey:
+                oldindex = index
+            else:
+                logging.debug("Chunk scan index for %s is out of date", self.options['name'])
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logging.warning("Could not read the chunk scan index for %s: %s", self.options['name'], e)
+        except Exception, e:
+            logging.warning("The chunk scan index for %s is corrupt, all regions will be scanned: %s",
+                    self.options['name'], e)
+
+        stime = time.time()
+        index = {}
+        rescanned = 0
+        for regionfile, key in self.regionset.iterate_regions():
+            regionscan = oldindex.get(regionfile)
+            if regionscan is None or regionscan.key != key:
+                regionscan = self._scan_region(regionfile, key)
+                rescanned += 1
+            index[regionfile] = regionscan
+
+        t = int(time.time()-stime)
+        logging.debug("Finished region scan for %s. %s of %s regions rescanned in %s second%s",
+                self.options['name'], rescanned, len(index), t,
+                "s" if t != 1 else "")
+
+        self._chunk_index = index
+        self._chunk_index_changed = rescanned > 0 or len(index) != len(oldindex)
+        return index
+
+    def _save_chunk_index(self):
+        """Writes the chunk scan index out to disk, if it changed"""
+        if not self._chunk_index_changed:
+            return
+        indexpath = os.path.join(self.outputdir, "chunkscan.dat")
+        with FileReplacer(indexpath, capabilities=self.fs_caps) as tmppath:
+            with open(tmppath, "wb") as f:
+                cPickle.dump((CHUNK_INDEX_VERSION, repr(self.regionset), self._chunk_index), f,
+                        cPickle.HIGHEST_PROTOCOL)
+        self._chunk_index_changed = False
+
+    def _scan_region(self, regionfile, key):
+        """Scans the chunks of one region file and returns a RegionScan for
+        it. The render-tiles aren't checked against the bounds of the map
+        here, since those may change without this region changing.
+
+        """
+        chunkx, chunkz, chunkmtimes = self.regionset.get_region_chunk_arrays(regionfile)
+        if len(chunkx) == 0:
+            empty = numpy.zeros(0, dtype=numpy.int32)
+            return RegionScan(key, None, 0, empty, empty, empty)
+
+        # Convert to diagonal coordinates
+        chunkcols, chunkrows = convert_coords(chunkx, chunkz)
+        bounds = Bounds(int(chunkcols.min()), int(chunkcols.max()),
+                int(chunkrows.min()), int(chunkrows.max()))
+
+        cols, rows, chunkindices = get_tiles_by_chunks(chunkcols, chunkrows)
+        mtimes = chunkmtimes[chunkindices]
+
+        # Keep each tile once, with the newest mtime of its chunks: sort by
+        # tile and then mtime, and take the last of each tile
+        order = numpy.lexsort((mtimes, rows, cols))
+        cols = cols[order]
+        rows = rows[order]
+        mtimes = mtimes[order]
+        last = numpy.ones(len(order), dtype=bool)
+        last[:-1] = (cols[1:] != cols[:-1]) | (rows[1:] != rows[:-1])
+
+        return RegionScan(key, bounds, max(0, int(chunkmtimes.max())),
+                cols[last].astype(numpy.int32), rows[last].astype(numpy.int32),
+                mtimes[last].astype(numpy.int32))
+
     def _set_map_size(self):
         """Finds and sets the depth of the map's quadtree, as well as the
         xradius and yradius of the resulting tiles.
@@ -752,7 +977,7 @@ class TileSet(object):
 
     def _chunk_scan(self):
         """Scans the chunks of this TileSet's world to determine which
-        render-tiles need rendering. Returns a RendertileSet object.
+        render-tiles need rendering. Returns an ArrayRendertileSet object.
 
         For rendercheck mode 0: only compares chunk mtimes against last render
         time of the map, and marks tiles as dirty if any chunk has a greater
@@ -764,6 +989,9 @@ class TileSet(object):
         As a side-effect, the scan sets self.max_chunk_mtime to the max of all
         the chunks' mtimes
 
+        The chunks themselves are only looked at for the regions that changed
+        since the last run, see _get_chunk_index().
+
         """
         # See note at the top of this file about the rendercheck modes for an
         # explanation of what this method does in different situations.
@@ -773,9 +1001,9 @@ class TileSet(object):
         xradius = self.xradius
         yradius = self.yradius
 
-        dirty = RendertileSet(depth)
+        dirty = ArrayRendertileSet(depth)
 
-        chunkcount = 0
+        tilecount = 0
         stime = time.time()
 
         rendercheck = self.options['renderchecks']
@@ -787,83 +1015,79 @@ class TileSet(object):
 
         max_chunk_mtime = 0
 
+        # The chunk scan index holds, for each region, the render-tiles its
+        # chunks touch and the newest chunk mtime in each. Only regions that
+        # changed since the last run were actually scanned again.
+        index = self._get_chunk_index()
+
+        # For each region, take the tiles its chunks touch that are in the
+        # boundary we're rendering, and that are older than their chunks.
+        # This is all done on whole arrays of tiles at once.
+        dirtycols = []
+        dirtyrows = []
+        for regionscan in index.itervalues():
+            if regionscan.max_mtime > max_chunk_mtime:
+                max_chunk_mtime = regionscan.max_mtime
+
+            # Nothing in this region changed since the last render
+            if not markall and not rerender_prob and regionscan.max_mtime <= last_rendertime:
+                continue
 
-        # For each chunk, do this:
-        #   For each tile that the chunk touches, do this:
-        #       Compare the last modified time of the chunk and tile. If the
-        #       tile is older, mark it in a RendertileSet object as dirty.
-
-
-        for chunkx, chunkz, chunkmtime in self.regionset.iterate_chunks() if (markall or platform.system() == 'Windows') else self.regionset.iterate_newer_chunks(last_rendertime): 
-            chunkcount += 1
-
-            if chunkmtime > max_chunk_mtime:
-                max_chunk_mtime = chunkmtime
-
-            # Convert to diagonal coordinates
-            chunkcol, chunkrow = convert_coords(chunkx, chunkz)
-
-            for c, r in get_tiles_by_chunk(chunkcol, chunkrow):
-
-                # Make sure the tile is in the boundary we're rendering.
-                # This can happen when rendering at lower treedepth than
-                # can contain the entire map, but shouldn't happen if the
-                # treedepth is correctly calculated.
-                if (
-                        c < -xradius or
-                        c >= xradius or
-                        r < -yradius or
-                        r >= yradius
-                        ):
-                    continue
-
-                # Computes the path in the quadtree from the col,row coordinates
-                tile = RenderTile.compute_path(c, r, depth)
-
-                if markall:
-                    # markall mode: Skip all other checks, mark tiles
-                    # as dirty unconditionally
-                    dirty.add(tile.path)
-                    continue
-
-                # Check if this tile has already been marked dirty. If so,
-                # no need to do any of the below.
-                if dirty.query_path(tile.path):
-                    continue
-
-                # Stochastic check. Since we're scanning by chunks and not
-                # by tiles, and the tiles get checked multiple times for
-                # each chunk, this is only an approximation. The given
-                # probability is for a particular tile that needs
-                # rendering, but since a tile gets touched up to 32 times
-                # (once for each chunk in it), divide the probability by
-                # 32.
-                if rerender_prob and rerender_prob/32 > random.random():
-                    dirty.add(tile.path)
-                    continue
-
-                # Check mtimes and conditionally add tile to the set
-                if chunkmtime > last_rendertime:
-                    dirty.add(tile.path)
+            cols = regionscan.cols
+            rows = regionscan.rows
+            tilecount += len(cols)
+
+            # Make sure the tile is in the boundary we're rendering.
+            # This can happen when rendering at lower treedepth than
+            # can contain the entire map, but shouldn't happen if the
+            # treedepth is correctly calculated.
+            mask = (cols >= -xradius) & (cols < xradius) & (rows >= -yradius) & (rows < yradius)
+
+            # markall mode: Skip all other checks, mark tiles as dirty
+            # unconditionally. Otherwise check mtimes, and do the stochastic
+            # check. A tile is only seen once per region here, so the given
+            # probability is used as is.
+            if not markall:
+                changed = regionscan.mtimes > last_rendertime
+                if rerender_prob:
+                    changed |= numpy.random.random(len(cols)) < rerender_prob
+                mask &= changed
+
+            dirtycols.append(cols[mask])
+            dirtyrows.append(rows[mask])
+
+        if dirtycols:
+            # Computes the paths in the quadtree from the col,row coordinates
+            dirty.update_indices(compute_tile_indices(numpy.concatenate(dirtycols),
+                    numpy.concatenate(dirtyrows), depth))
 
         t = int(time.time()-stime)
-        logging.debug("Finished chunk scan for %s. %s chunks scanned in %s second%s",
-                self.options['name'], chunkcount, t,
+        logging.debug("Finished chunk scan for %s. %s tiles from %s regions checked in %s second%s",
+                self.options['name'], tilecount, len(index), t,
                 "s" if t != 1 else "")
 
+        self._save_chunk_index()
+
         self.max_chunk_mtime = max_chunk_mtime
         return dirty
 
     def __str__(self):
         return "<TileSet for %s>" % os.path.basename(self.outputdir)
 
-    def _render_compositetile(self, dest, name):
+    def _render_compositetile(self, dest, name, children=None):
         """
         Renders a tile at os.path.join(dest, name)+".ext" by taking tiles from
         os.path.join(dest, name, "{0,1,2,3}.png")
 
         If name is "base" then render tile at os.path.join(dest, "base.png") by
         taking tiles from os.path.join(dest, "{0,1,2,3}.png")
+
+        children, if given, is a list of 4 (image, mtime) tuples or Nones, one
+        for each child tile. Children that are given are used as they are
+        instead of being read from disk.
+
+        Returns the (image, mtime) of the new tile, or None if it has no
+        children.
         """
         imgformat = self.imgextension
         imgpath = os.path.join(dest, name) + "." + imgformat
@@ -889,16 +1113,21 @@ class TileSet(object):
         # infomation. Also keep track of the max mtime of all children
         max_mtime = 0
         quadPath_filtered = []
-        for path in quadPath:
-            try:
-                quad_mtime = os.stat(path[1])[stat.ST_MTIME]
-            except OSError:
-                # This tile doesn't exist or some other error with the stat
-                # call. Move on.
-                continue
+        for i, path in enumerate(quadPath):
+            if children and children[i] is not None:
+                # This one was just rendered, no need to read it back
+                quad_img, quad_mtime = children[i]
+            else:
+                quad_img = None
+                try:
+                    quad_mtime = os.stat(path[1])[stat.ST_MTIME]
+                except OSError:
+                    # This tile doesn't exist or some other error with the stat
+                    # call. Move on.
+                    continue
             # The tile exists, so we need to use it in our rendering of this
             # composite tile
-            quadPath_filtered.append(path)
+            quadPath_filtered.append(path + (quad_img,))
             if quad_mtime > max_mtime:
                 max_mtime = quad_mtime
 
@@ -924,8 +1153,10 @@ class TileSet(object):
         for path in quadPath_filtered:
             try:
                 #quad = Image.open(path[1]).resize((192,192), Image.ANTIALIAS)
-                src = Image.open(path[1])
-                src.load()
+                src = path[2]
+                if src is None:
+                    src = Image.open(path[1])
+                    src.load()
                 quad = Image.new("RGBA", (192, 192), self.options['bgcolor'])
                 resize_half(quad, src)
                 img.paste(quad, path[0])
@@ -949,6 +1180,8 @@ class TileSet(object):
 
             os.utime(tmppath, (max_mtime, max_mtime))
 
+        return img, max_mtime
+
     def _render_rendertile(self, tile):
         """Renders the given render-tile.
 
@@ -962,42 +1195,46 @@ class TileSet(object):
         configured to save images.
 
         """
+        tileimg = Image.new("RGBA", (384, 384), self.options['bgcolor'])
+        try:
+            # draws every chunk section of the tile in one go, in the same
+            # order as _draw_rendertile()
+            max_chunk_mtime, culled = c_overviewer.render_tile(self.world,
+                    self.regionset, tile.col, tile.row, tileimg,
+                    self._get_compiled_rendermode(), self.textures)
+            if culled:
+                logging.debug("%s: left out %d empty or hidden chunk sections",
+                        tile, culled)
+        except nbt.CorruptionError:
+            # Start over section by section, which skips just the sections
+            # of the corrupt chunk
+            tileimg = Image.new("RGBA", (384, 384), self.options['bgcolor'])
+            max_chunk_mtime = self._draw_rendertile(tile, tileimg)
+        except Exception, e:
+            logging.error("Could not render %s for some reason. This is likely a render primitive option error.", tile)
+            logging.error("Full error was:", exc_info=1)
+            sys.exit(1)
+
+        if max_chunk_mtime is None:
+            # No chunks were found in this tile
+            self._remove_empty_rendertile(tile)
+            return
 
-        imgpath = tile.get_filepath(self.outputdir, self.imgextension)
+        self._save_rendertile(tile, tileimg, max_chunk_mtime)
 
+    def _draw_rendertile(self, tile, tileimg):
+        """Draws the chunk sections of the given render-tile onto tileimg one
+        at a time, and returns the highest mtime of their chunks, or None if
+        there aren't any. This is what c_overviewer.render_tile() does, in
+        python.
+
+        """
         # Calculate which chunks are relevant to this tile
         # This is a list of (col, row, chunkx, chunkz, chunk_mtime)
         chunks = list(get_chunks_by_tile(tile, self.regionset))
 
         if not chunks:
-            # No chunks were found in this tile
-            logging.warning("%s was requested for render, but no chunks found! This may be a bug", tile)
-            try:
-                os.unlink(imgpath)
-            except OSError, e:
-                # ignore only if the error was "file not found"
-                if e.errno != errno.ENOENT:
-                    raise
-            else:
-                logging.debug("%s deleted", tile)
-            return
-
-        # Create the directory if not exists
-        dirdest = os.path.dirname(imgpath)
-        if not os.path.exists(dirdest):
-            try:
-                os.makedirs(dirdest)
-            except OSError, e:
-                # Ignore errno EEXIST: file exists. Due to a race condition,
-                # two processes could conceivably try and create the same
-                # directory at the same time
-                if e.errno != errno.EEXIST:
-                    raise
-
-        #logging.debug("writing out worldtile {0}".format(imgpath))
-
-        # Compile this image
-        tileimg = Image.new("RGBA", (384, 384), self.options['bgcolor'])
+            return None
 
         colstart = tile.col
         rowstart = tile.row
@@ -1012,18 +1249,7 @@ class TileSet(object):
                 max_chunk_mtime = chunk_mtime
 
             # draw the chunk!
-            try:
-                c_overviewer.render_loop(self.world, self.regionset, chunkx, chunky,
-                        chunkz, tileimg, xpos, ypos,
-                        self.options['rendermode'], self.textures)
-            except nbt.CorruptionError:
-                # A warning and traceback was already printed by world.py's
-                # get_chunk()
-                logging.debug("Skipping the render of corrupt chunk at %s,%s and moving on.", chunkx, chunkz)
-            except Exception, e:
-                logging.error("Could not render chunk %s,%s for some reason. This is likely a render primitive option error.", chunkx, chunkz)
-                logging.error("Full error was:", exc_info=1)
-                sys.exit(1)
+            self._render_chunk_section(tileimg, xpos, ypos, chunkx, chunky, chunkz)
 
             ## Semi-handy routine for debugging the drawing routine
             ## Draw the outline of the top of the chunk
@@ -1041,6 +1267,136 @@ class TileSet(object):
             #draw.text((96,48), "C: %s,%s" % (chunkx, chunkz), fill='red')
             #draw.text((96,96), "c,r: %s,%s" % (col, row), fill='red')
 
+        return max_chunk_mtime
+
+    def _render_rendertile_batch(self, tiles, composites=()):
+        """Renders the given list of render-tiles together, which are
+        expected to be close to each other (see the renderbatch option).
+
+        Instead of drawing each tile's chunk sections onto its own image,
+        which draws a section once for every tile it overlaps, every
+        section needed by any of the tiles is drawn once onto a canvas
+        covering all of them, and the tiles are cropped out of it.
+
+        Then the composite-tiles with the given paths, which should be in
+        post-traversal order, are rendered from the images of their children
+        that were rendered here. Only the children that weren't are read
+        from disk.
+
+        """
+        # maps tile paths to the (image, mtime) of the tiles rendered here
+        # whose parents haven't been rendered yet
+        images = self._render_rendertiles(tiles)
+        for path in composites:
+            children = [images.pop(path + (i,), None) for i in xrange(4)]
+            result = self._render_compositetile(*self._get_compositetile_dest(path), children=children)
+            if result is not None:
+                images[path] = result
+
+    def _render_rendertiles(self, tiles):
+        """Does the work of _render_rendertile_batch() for the render-tiles.
+        Returns a dict mapping the tile paths to the (image, mtime) of each
+        rendered tile."""
+        images = {}
+        tilechunks = []
+        sections = set()
+        for tile in tiles:
+            chunks = list(get_chunks_by_tile(tile, self.regionset))
+            if not chunks:
+                self._remove_empty_rendertile(tile)
+                continue
+            tilechunks.append((tile, chunks))
+            sections.update(chunks)
+
+        if not tilechunks:
+            return images
+
+        colstart = min(tile.col for tile, _ in tilechunks)
+        rowstart = min(tile.row for tile, _ in tilechunks)
+        colend = max(tile.col for tile, _ in tilechunks)
+        rowend = max(tile.row for tile, _ in tilechunks)
+
+        # tiles are 2 columns wide and 4 rows tall
+        canvas = Image.new("RGBA", ((colend - colstart) // 2 * 384 + 384,
+                                    (rowend - rowstart) // 4 * 384 + 384),
+                           self.options['bgcolor'])
+
+        # get_chunks_by_tile() yields sections back to front, which is
+        # bottom to top, then back (low row) to front. Sections in the
+        # same row and level don't overlap, so this sort gives the same
+        # order across all the tiles.
+        for col, row, chunkx, chunky, chunkz, chunk_mtime in sorted(sections,
+                key=lambda section: (section[3], section[1], section[0])):
+            xpos = -192 + (col-colstart)*192
+            ypos = -96 + (row-rowstart)*96 + (16-1 - chunky)*192
+            self._render_chunk_section(canvas, xpos, ypos, chunkx, chunky, chunkz)
+
+        for tile, chunks in tilechunks:
+            x = (tile.col - colstart) // 2 * 384
+            y = (tile.row - rowstart) // 4 * 384
+            tileimg = canvas.crop((x, y, x + 384, y + 384))
+            max_chunk_mtime = max(chunk[5] for chunk in chunks)
+            self._save_rendertile(tile, tileimg, max_chunk_mtime)
+            images[tile.path] = (tileimg, max_chunk_mtime)
+        return images
+
+    def _get_compiled_rendermode(self):
+        """Returns the rendermode compiled by c_overviewer, compiling it the
+        first time this is called."""
+        if self._compiled_rendermode is None:
+            self._compiled_rendermode = c_overviewer.compile_rendermode(
+                    self.options['rendermode'], self.world, self.regionset,
+                    self.textures)
+        return self._compiled_rendermode
+
+    def _render_chunk_section(self, img, xpos, ypos, chunkx, chunky, chunkz):
+        """Draws the given chunk section onto img, at the given position."""
+        try:
+            c_overviewer.render_loop(self.world, self.regionset, chunkx, chunky,
+                    chunkz, img, xpos, ypos,
+                    self._get_compiled_rendermode(), self.textures)
+        except nbt.CorruptionError:
+            # A warning and traceback was already printed by world.py's
+            # get_chunk()
+            logging.debug("Skipping the render of corrupt chunk at %s,%s and moving on.", chunkx, chunkz)
+        except Exception, e:
+            logging.error("Could not render chunk %s,%s for some reason. This is likely a render primitive option error.", chunkx, chunkz)
+            logging.error("Full error was:", exc_info=1)
+            sys.exit(1)
+
+    def _remove_empty_rendertile(self, tile):
+        """Deletes the image of a render-tile that turned out to have no
+        chunks in it, if there is one."""
+        imgpath = tile.get_filepath(self.outputdir, self.imgextension)
+        logging.warning("%s was requested for render, but no chunks found! This may be a bug", tile)
+        try:
+            os.unlink(imgpath)
+        except OSError, e:
+            # ignore only if the error was "file not found"
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            logging.debug("%s deleted", tile)
+
+    def _save_rendertile(self, tile, tileimg, max_chunk_mtime):
+        """Saves a rendered render-tile image to disk, with its mtime set
+        to that of its newest chunk."""
+        imgpath = tile.get_filepath(self.outputdir, self.imgextension)
+
+        # Create the directory if not exists
+        dirdest = os.path.dirname(imgpath)
+        if not os.path.exists(dirdest):
+            try:
+                os.makedirs(dirdest)
+            except OSError, e:
+                # Ignore errno EEXIST: file exists. Due to a race condition,
+                # two processes could conceivably try and create the same
+                # directory at the same time
+                if e.errno != errno.EEXIST:
+                    raise
+
+        #logging.debug("writing out worldtile {0}".format(imgpath))
+
         # Save them
         with FileReplacer(imgpath, capabilities=self.fs_caps) as tmppath:
             if self.imgextension == 'jpg':
@@ -1264,6 +1620,58 @@ def get_tiles_by_chunk(chunkcol, chunkrow):
 
     return product(colrange, rowrange)
 
+def get_tiles_by_chunks(chunkcols, chunkrows):
+    """A vectorized get_tiles_by_chunk() for numpy arrays of chunk columns
+    and rows. Returns three arrays (tilecols, tilerows, chunkindices) with an
+    item for each render-tile that each chunk touches, where chunkindices is
+    the index of the chunk in the given arrays.
+
+    """
+    # Every chunk touches at most 2 columns and 10 rows of tiles (see above).
+    # The first column is only for chunks in even columns, and the first row
+    # only for chunks in rows divisible by 4.
+    coloffsets = numpy.array([-2, 0])
+    rowoffsets = numpy.arange(-4, 32+1, 4)
+
+    tilecols = (chunkcols - chunkcols % 2)[:, None] + coloffsets
+    tilerows = (chunkrows - chunkrows % 4)[:, None] + rowoffsets
+    touched = (((chunkcols % 2 == 0)[:, None] | (coloffsets == 0))[:, :, None] &
+            ((chunkrows % 4 == 0)[:, None] | (rowoffsets >= 0))[:, None, :])
+
+    chunkindices, colindices, rowindices = numpy.nonzero(touched)
+    return (tilecols[chunkindices, colindices], tilerows[chunkindices, rowindices],
+            chunkindices)
+
+def compute_paths(cols, rows, depth):
+    """A vectorized RenderTile.compute_path() for numpy arrays of render-tile
+    columns and rows. Returns the paths as an array with one row of depth
+    integers for each tile.
+
+    """
+    # Shift the tiles into the positive quadrant and number them 0 through
+    # 2**depth-1 in each direction. The path is then the bits of those
+    # numbers, highest first, with the column in the low bit of each level.
+    x = (numpy.asarray(cols, dtype=numpy.int64) + 2**depth) // 2
+    y = (numpy.asarray(rows, dtype=numpy.int64) + 2*2**depth) // 4
+    shifts = numpy.arange(depth-1, -1, -1)
+    return ((x[:, None] >> shifts) & 1) | (((y[:, None] >> shifts) & 1) << 1)
+
+def compute_tile_indices(cols, rows, depth):
+    """Like compute_paths(), but returns each path as a single unsigned
+    integer, the path's digits read as a base 4 number. These sort in the
+    same order as the paths do. See ArrayRendertileSet.
+
+    """
+    x = ((numpy.asarray(cols, dtype=numpy.int64) + 2**depth) // 2).astype(numpy.uint64)
+    y = ((numpy.asarray(rows, dtype=numpy.int64) + 2*2**depth) // 4).astype(numpy.uint64)
+    # Interleave the bits of x and y, x in the low bit of each digit
+    indices = numpy.zeros(len(x), dtype=numpy.uint64)
+    one = numpy.uint64(1)
+    for bit in xrange(depth):
+        indices |= ((x >> numpy.uint64(bit)) & one) << numpy.uint64(2*bit)
+        indices |= ((y >> numpy.uint64(bit)) & one) << numpy.uint64(2*bit + 1)
+    return indices
+
 def get_chunks_by_tile(tile, regionset):
     """Get chunk sections that are relevant to the given render-tile. Only
     returns chunk sections that are in chunks that actually exist according to
@@ -1367,6 +1775,17 @@ class RendertileSet(object):
         self.num_tiles     = 0
         self.num_tiles_all = 0
 
+    def update(self, paths):
+        """Marks every leaf node in the given iterable of paths as in this
+        set. paths may also be a numpy array with a path in each row, as
+        returned by compute_paths().
+
+        """
+        if isinstance(paths, numpy.ndarray):
+            paths = paths.tolist()
+        for path in paths:
+            self.add(path)
+
     def add(self, path):
         """Marks the requested leaf node as in this set
 
@@ -1545,6 +1964,214 @@ class RendertileSet(object):
             logging.error("Please report this to the developers: RendertileSet num_tiles_all=%r, count_all=%r, children=%r", self.num_tiles, num, self.children)
         return num
 
+class ArrayRendertileSet(object):
+    """Holds a set of render-tiles just like RendertileSet does, with the
+    same interface, but keeps them as a sorted numpy array of tile indices
+    instead of a tree of lists.
+
+    A tile's index is its path read as a base 4 number (see
+    compute_tile_indices()), so sorting the indices sorts the tiles in
+    quadtree order, and every subtree is one contiguous range of the array.
+    This takes 8 bytes per tile no matter how deep the tree is, pickles
+    compactly, and lets whole arrays of tiles be added at once.
+
+    Added tiles are collected and only merged into the array when the set is
+    next looked at.
+
+    """
+    __slots__ = ("depth", "_tiles", "_pending")
+    def __init__(self, depth):
+        self.depth = depth
+        self._tiles = numpy.zeros(0, dtype=numpy.uint64)
+        # arrays of tile indices not merged into self._tiles yet
+        self._pending = []
+
+    # Pickle the differences between consecutive indices, compressed. Those
+    # are mostly small, and often all 1 in the middle of a map.
+    def __getstate__(self):
+        tiles = self._get_tiles()
+        diffs = numpy.diff(numpy.concatenate((numpy.zeros(1, dtype=numpy.uint64), tiles)))
+        return self.depth, zlib.compress(diffs.tostring())
+    def __setstate__(self, state):
+        self.depth, data = state
+        self._tiles = numpy.cumsum(numpy.frombuffer(zlib.decompress(data), dtype=numpy.uint64),
+                dtype=numpy.uint64)
+        self._pending = []
+
+    def _get_tiles(self):
+        """Returns the sorted array of tile indices, after merging in any
+        pending ones"""
+        if self._pending:
+            self._pending.append(self._tiles)
+            self._tiles = numpy.unique(numpy.concatenate(self._pending))
+            self._pending = []
+        return self._tiles
+
+    def _range(self, tiles, path):
+        """Returns the (start, end) range of the given array of tile indices
+        that holds the tiles in the subtree with the given path"""
+        index = 0
+        for digit in path:
+            index = index * 4 + digit
+        shift = 2 * (self.depth - len(path))
+        start = numpy.searchsorted(tiles, numpy.uint64(index << shift))
+        end = (index + 1) << shift
+        if end >= 4**self.depth:
+            # the last subtree of its level, which may not fit a uint64
+            return start, len(tiles)
+        return start, numpy.searchsorted(tiles, numpy.uint64(end))
+
+    def update_indices(self, indices):
+        """Marks the tiles with the given tile indices, as returned by
+        compute_tile_indices(), as in this set."""
+        self._pending.append(numpy.asarray(indices, dtype=numpy.uint64))
+
+    def update(self, paths):
+        """Marks every leaf node in the given iterable of paths as in this
+        set. paths may also be a numpy array with a path in each row, as
+        returned by compute_paths().
+
+        """
+        paths = numpy.asarray(list(paths) if not isinstance(paths, numpy.ndarray) else paths,
+                dtype=numpy.uint64).reshape(-1, self.depth)
+        indices = numpy.zeros(len(paths), dtype=numpy.uint64)
+        for level in xrange(self.depth):
+            indices = (indices << numpy.uint64(2)) | paths[:, level]
+        self.update_indices(indices)
+
+    def add(self, path):
+        """Marks the requested leaf node as in this set
+
+        Path is an iterable of integers representing the path to the leaf node
+        that is to be added to the set
+
+        """
+        path = list(path)
+        assert len(path) == self.depth
+        self.update([path])
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, level=None, robin=False, offset=(0,0)):
+        """Returns an iterator over every tile in this set, just like
+        RendertileSet.iterate()
+
+        """
+        if level is None:
+            level = self.depth
+        elif not (level > 0 and level <= self.depth):
+            raise ValueError("Level parameter must be between 1 and %s" % self.depth)
+        return self._traverse(level, False, robin, offset)
+
+    def posttraversal(self, robin=False, offset=(0,0)):
+        """Returns an iterator over tile paths for every tile in the set and
+        their ancestors, in post-traversal order, just like
+        RendertileSet.posttraversal()
+
+        """
+        return self._traverse(self.depth, True, robin, offset)
+
+    def _traverse(self, level, post, robin, offset):
+        """Yields the paths of the tiles in this set at the given level, and
+        of their ancestors if post is True"""
+        tiles = self._get_tiles()
+        if len(tiles) == 0:
+            return
+
+        if not robin:
+            for path in self._walk(tiles, (), 0, 0, len(tiles), offset, level, post):
+                yield path
+            return
+
+        # Recurse to the four top-level subtrees simultaneously
+        gens = []
+        for (childnum, (start, end)), childoffset in distance_sort(
+                enumerate(self._children(tiles, 0, 0, 0, len(tiles))), offset):
+            if start < end:
+                gens.append(self._walk(tiles, (childnum,), childnum, start, end,
+                        childoffset, level, post))
+        for path in roundrobin(gens):
+            yield path
+        if post:
+            yield ()
+
+    def _children(self, tiles, depth, index, start, end):
+        """Splits the range (start, end) of tiles, holding the subtree at the
+        given depth with the given index, into the ranges of its four
+        children"""
+        shift = numpy.uint64(2 * (self.depth - depth - 1))
+        bounds = numpy.array([index * 4 + 1, index * 4 + 2, index * 4 + 3], dtype=numpy.uint64)
+        splits = numpy.searchsorted(tiles[start:end], bounds << shift) + start
+        return ((start, splits[0]), (splits[0], splits[1]), (splits[1], splits[2]), (splits[2], end))
+
+    def _walk(self, tiles, path, index, start, end, offset, level, post):
+        """Walks the subtree with the given path (and index) down to the
+        given level, in the same order as RendertileSet._iterate_helper().
+        This uses an explicit stack instead of recursive generators, so each
+        yielded path doesn't have to pass through a generator for every
+        level."""
+        leafparent = self.depth - 1
+        stack = [(path, index, start, end, offset, False)]
+        while stack:
+            path, index, start, end, offset, done = stack.pop()
+            if done or len(path) == level:
+                yield path
+                continue
+            if len(path) == leafparent:
+                # The children are render-tiles, and their digits are the
+                # low digits of the tile indices in this range
+                present = set((tiles[start:end] & numpy.uint64(3)).tolist())
+                for (childnum, _), _ in distance_sort(enumerate(xrange(4)), offset):
+                    if childnum in present:
+                        yield path + (childnum,)
+                if post:
+                    yield path
+                continue
+            if post:
+                stack.append((path, index, start, end, offset, True))
+            children = self._children(tiles, len(path), index, start, end)
+            for (childnum, (childstart, childend)), childoffset in reversed(
+                    distance_sort(enumerate(children), offset)):
+                if childstart < childend:
+                    stack.append((path + (childnum,), index * 4 + childnum,
+                            childstart, childend, childoffset, False))
+
+    def query_path(self, path):
+        """Queries for the state of the given tile in the tree.
+
+        Returns True for items in the set, False otherwise. Works for
+        rendertiles as well as upper tiles (which are True if they have a
+        descendent that is in the set)
+
+        """
+        start, end = self._range(self._get_tiles(), path)
+        return start < end
+
+    def __nonzero__(self):
+        return len(self._get_tiles()) > 0
+
+    def count(self):
+        """Returns the total number of render-tiles in this set.
+
+        """
+        return len(self._get_tiles())
+
+    def count_all(self):
+        """Returns the total number of render-tiles plus implicitly marked
+        upper-tiles in this set
+
+        """
+        tiles = self._get_tiles()
+        if len(tiles) == 0:
+            return 0
+        num = 0
+        for level in xrange(self.depth + 1):
+            # The number of distinct path prefixes at this level
+            prefixes = tiles >> numpy.uint64(2 * (self.depth - level))
+            num += 1 + numpy.count_nonzero(prefixes[1:] != prefixes[:-1])
+        return int(num)
+
 def distance_sort(children, (off_x, off_y)):
     order = []
     for child, (dx, dy) in izip(children, [(-1,-1), (1,-1), (-1,1), (1,1)]):
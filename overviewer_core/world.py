@@ -22,6 +22,7 @@ import time
 import random
 import re
 import locale
+import threading
 
 import numpy
 
@@ -54,6 +55,105 @@ def log_other_exceptions(func):
             raise
     return newfunc
 
+def _expand_blocks(blocks, add=None):
+    """Turns a packed Blocks byte string into a 16x16x16 numpy array of
+    shorts, adding in the packed Add array if given."""
+    # Cast up to uint16, blocks can have up to 12 bits of data
+    blocks = numpy.frombuffer(blocks, dtype=numpy.uint8)
+    blocks = blocks.astype(numpy.uint16).reshape((16,16,16))
+    if add is not None:
+        # Add is a packed array with 4 bits per slot, so it needs expanding
+        additional = numpy.frombuffer(add, dtype=numpy.uint8)
+        additional = additional.astype(numpy.uint16).reshape((16,16,8))
+        blocks[:,:,::2] += (additional & 0x0F) << 8
+        blocks[:,:,1::2] += (additional & 0xF0) << 4
+    return blocks
+
+def _expand_nibbles(packed):
+    """Turns a byte string packed 2 elements per byte (like SkyLight,
+    BlockLight and Data) into a 16x16x16 numpy array."""
+    packed = numpy.frombuffer(packed, dtype=numpy.uint8).reshape((16,16,8))
+    expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
+    expanded[:,:,::2] = packed & 0x0F
+    expanded[:,:,1::2] = (packed & 0xF0) >> 4
+    return expanded
+
+class ChunkSection(dict):
+    """One entry of a chunk's Sections list, as returned by get_chunk().
+
+    The block and light arrays of a section are only needed if something
+    actually draws it, so they're expanded lazily: loaders maps key names
+    to functions that produce the value for that key, and each is called
+    (and the result stored) the first time the key is looked up, either
+    from python or through PyObject_GetItem in the C code. Until then the
+    key holds whatever placeholder the given items had.
+
+    Pickling (say, for the shared chunk cache) keeps the sections lazy:
+    the arrays still waiting to be expanded from their packed form are
+    pickled packed, along with their loaders. Other loaders (like the
+    rotations of RotatedRegionSet) can't be pickled, so those arrays are
+    expanded first.
+
+    Sections can be shared between threads, so a loader is only dropped
+    once its value is stored; until then, other threads run it too rather
+    than see the placeholder.
+    """
+    def __init__(self, items, loaders):
+        super(ChunkSection, self).__init__(items)
+        self._loaders = dict(loaders)
+
+    def __getitem__(self, key):
+        loader = self._loaders.get(key)
+        if loader is None:
+            return dict.__getitem__(self, key)
+        value = loader()
+        dict.__setitem__(self, key, value)
+        self._loaders.pop(key, None)
+        return value
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._loaders.pop(key, None)
+
+    def _load_all(self):
+        for key in self._loaders.keys():
+            self[key]
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+    def iteritems(self):
+        self._load_all()
+        return dict.iteritems(self)
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+    def itervalues(self):
+        self._load_all()
+        return dict.itervalues(self)
+    def copy(self):
+        self._load_all()
+        return dict(self)
+
+    def __reduce__(self):
+        # the loaders are copied first, so a value another thread stores
+        # meanwhile at worst gets expanded again after unpickling
+        loaders = dict(self._loaders)
+        for key, loader in loaders.items():
+            if not (isinstance(loader, functools.partial) and loader.func in _packed_loaders):
+                self[key]
+                del loaders[key]
+        return (ChunkSection, (dict.items(self), loaders))
+
+# the loaders of ChunkSection that only expand packed arrays, and so can be
+# pickled as they are
+_packed_loaders = (_expand_blocks, _expand_nibbles)
+
 
 class World(object):
     """Encapsulates the concept of a Minecraft "world". A Minecraft world is a
@@ -235,6 +335,20 @@ class RegionSet(object):
 
     """
 
+    # expected sizes of the packed arrays in each chunk section
+    _section_array_sizes = [('Blocks', 4096), ('Add', 2048), ('SkyLight', 2048),
+                            ('BlockLight', 2048), ('Data', 2048)]
+
+    # the loading profiles of get_chunk(), and the tags each one leaves out
+    # of the chunk without decoding them. Rendering only looks at the
+    # sections and biomes, and genPOI only at the entities, so there's no
+    # need to build all of the rest.
+    _chunk_profiles = {
+        None: frozenset(),
+        "render": frozenset(['Entities', 'TileEntities', 'TileTicks', 'LiquidTicks', 'HeightMap']),
+        "poi": frozenset(['Sections', 'Biomes', 'TileTicks', 'LiquidTicks', 'HeightMap']),
+    }
+
     def __init__(self, regiondir, rel):
         """Initialize a new RegionSet to access the region files in the given
         directory.
@@ -268,8 +382,9 @@ class RegionSet(object):
         # This is populated below. It is a mapping from (x,y) region coords to filename
         self.regionfiles = {}
 
-        # This holds a cache of open regionfile objects
-        self.regioncache = cache.LRUCache(size=16, destructor=lambda regionobj: regionobj.close())
+        # This holds a cache of open regionfile objects for each thread (see
+        # the regioncache property)
+        self._local = threading.local()
         
         for x, y, regionfile in self._iterate_regionfiles():
             # regionfile is a pathname
@@ -287,6 +402,17 @@ class RegionSet(object):
     def __repr__(self):
         return "<RegionSet regiondir=%r>" % self.regiondir
 
+    @property
+    def regioncache(self):
+        # Every thread opens the region files itself, so that a region
+        # evicted by one thread is never closed while another reads from it
+        try:
+            return self._local.regioncache
+        except AttributeError:
+            regioncache = cache.LRUCache(size=16, destructor=lambda regionobj: regionobj.close())
+            self._local.regioncache = regioncache
+            return regioncache
+
     def get_type(self):
         """Attempts to return a string describing the dimension
         represented by this regionset.  Usually this is the relative
@@ -303,17 +429,22 @@ class RegionSet(object):
         try:
             return self.regioncache[regionfilename]
         except KeyError:
-            region = nbt.load_region(regionfilename)
+            region = nbt.load_region(regionfilename, use_mmap=True)
             self.regioncache[regionfilename] = region
             return region
     
     #@log_other_exceptions
-    def get_chunk(self, x, z):
+    def get_chunk(self, x, z, profile=None):
         """Returns a dictionary object representing the "Level" NBT Compound
         structure for a chunk given its x, z coordinates. The coordinates given
         are chunk coordinates. Raises ChunkDoesntExist exception if the given
         chunk does not exist.
 
+        profile picks which parts of the chunk are loaded: None loads all of
+        it, "render" leaves out the entities and the other tags that aren't
+        needed for rendering, and "poi" leaves out the sections and biomes,
+        keeping the Entities and TileEntities lists.
+
         The returned dictionary corresponds to the "Level" structure in the
         chunk file, with a few changes:
 
@@ -330,10 +461,18 @@ class RegionSet(object):
             array
           * The "Data" byte string is transformed into a 16x16x128 numpy array
 
+          Each section is a ChunkSection, which does these transformations
+          the first time the array is looked up rather than up front.
+
         Warning: the returned data may be cached and thus should not be
         modified, lest it affect the return values of future calls for the same
         chunk.
         """
+        try:
+            skip = self._chunk_profiles[profile]
+        except KeyError:
+            raise ValueError("unknown chunk loading profile %r" % (profile,))
+
         regionfile = self._get_region_path(x, z)
         if regionfile is None:
             raise ChunkDoesntExist("Chunk %s,%s doesn't exist (and neither does its region)" % (x,z))
@@ -344,7 +483,7 @@ class RegionSet(object):
         while True:
             try:
                 region = self._get_regionobj(regionfile)
-                data = region.load_chunk(x, z)
+                data = region.load_chunk(x, z, skip=skip)
             except nbt.CorruptionError, e:
                 tries -= 1
                 if tries > 0:
@@ -381,6 +520,10 @@ class RegionSet(object):
         level = data[1]['Level']
         chunk_data = level
 
+        if 'Sections' in skip:
+            # nothing else to do for a chunk without its sections
+            return chunk_data
+
         # Turn the Biomes array into a 16x16 numpy array
         try:
             biomes = numpy.frombuffer(chunk_data['Biomes'], dtype=numpy.uint8)
@@ -390,64 +533,24 @@ class RegionSet(object):
             biomes = numpy.zeros((16, 16), dtype=numpy.uint8)
         chunk_data['Biomes'] = biomes
 
+        # The section arrays are only expanded when they're first used (see
+        # ChunkSection), but check their sizes now so a corrupt chunk is
+        # caught here instead of halfway through a render.
+        sections = []
         for section in chunk_data['Sections']:
-
-            # Turn the Blocks array into a 16x16x16 numpy matrix of shorts,
-            # adding in the additional block array if included.
-            blocks = numpy.frombuffer(section['Blocks'], dtype=numpy.uint8)
-            # Cast up to uint16, blocks can have up to 12 bits of data
-            blocks = blocks.astype(numpy.uint16)
-            blocks = blocks.reshape((16,16,16))
-            if "Add" in section:
-                # This section has additional bits to tack on to the blocks
-                # array. Add is a packed array with 4 bits per slot, so
-                # it needs expanding
-                additional = numpy.frombuffer(section['Add'], dtype=numpy.uint8)
-                additional = additional.astype(numpy.uint16).reshape((16,16,8))
-                additional_expanded = numpy.empty((16,16,16), dtype=numpy.uint16)
-                additional_expanded[:,:,::2] = (additional & 0x0F) << 8
-                additional_expanded[:,:,1::2] = (additional & 0xF0) << 4
-                blocks += additional_expanded
-                del additional
-                del additional_expanded
-                del section['Add'] # Save some memory
-            section['Blocks'] = blocks
-
-            # Turn the skylight array into a 16x16x16 matrix. The array comes
-            # packed 2 elements per byte, so we need to expand it.
-            try:
-                skylight = numpy.frombuffer(section['SkyLight'], dtype=numpy.uint8)
-                skylight = skylight.reshape((16,16,8))
-                skylight_expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
-                skylight_expanded[:,:,::2] = skylight & 0x0F
-                skylight_expanded[:,:,1::2] = (skylight & 0xF0) >> 4
-                del skylight
-                section['SkyLight'] = skylight_expanded
-
-                # Turn the BlockLight array into a 16x16x16 matrix, same as SkyLight
-                blocklight = numpy.frombuffer(section['BlockLight'], dtype=numpy.uint8)
-                blocklight = blocklight.reshape((16,16,8))
-                blocklight_expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
-                blocklight_expanded[:,:,::2] = blocklight & 0x0F
-                blocklight_expanded[:,:,1::2] = (blocklight & 0xF0) >> 4
-                del blocklight
-                section['BlockLight'] = blocklight_expanded
-
-                # Turn the Data array into a 16x16x16 matrix, same as SkyLight
-                data = numpy.frombuffer(section['Data'], dtype=numpy.uint8)
-                data = data.reshape((16,16,8))
-                data_expanded = numpy.empty((16,16,16), dtype=numpy.uint8)
-                data_expanded[:,:,::2] = data & 0x0F
-                data_expanded[:,:,1::2] = (data & 0xF0) >> 4
-                del data
-                section['Data'] = data_expanded
-            except ValueError:
-                # iv'e seen at least 1 case where numpy raises a value error during the reshapes.  i'm not
-                # sure what's going on here, but let's treat this as a corrupt chunk error
-                logging.warning("There was a problem reading chunk %d,%d.  It might be corrupt.  I am giving up and will not render this particular chunk.", x, z)
-
-                logging.debug("Full traceback:", exc_info=1)
-                raise nbt.CorruptChunkError()
+            for arrayname, size in self._section_array_sizes:
+                if arrayname in section and len(section[arrayname]) != size:
+                    logging.warning("There was a problem reading chunk %d,%d.  It might be corrupt.  I am giving up and will not render this particular chunk.", x, z)
+                    raise nbt.CorruptChunkError("%s array of chunk %d,%d has the wrong size" % (arrayname, x, z))
+
+            loaders = {}
+            # the Add array is merged into Blocks, don't keep it around
+            loaders['Blocks'] = functools.partial(_expand_blocks, section['Blocks'], section.pop('Add', None))
+            for arrayname in ('SkyLight', 'BlockLight', 'Data'):
+                if arrayname in section:
+                    loaders[arrayname] = functools.partial(_expand_nibbles, section[arrayname])
+            sections.append(ChunkSection(section, loaders))
+        chunk_data['Sections'] = sections
         
         return chunk_data      
     
@@ -489,6 +592,95 @@ class RegionSet(object):
             for chunkx, chunky in mcr.get_chunks():
                 yield chunkx+32*regionx, chunky+32*regiony, mcr.get_chunk_timestamp(chunkx, chunky)
 
+    def iterate_regions(self):
+        """Returns an iterator over (regionfile, key) for every region file in
+        this regionset. key is a value that changes whenever the chunks or
+        chunk timestamps of the region may have changed: it is made from the
+        file's mtime and size, and a digest of its header.
+
+        The header is read every time instead of trusting the mtime alone,
+        since mtimes aren't updated reliably on all platforms while the
+        server holds the file open.
+
+        """
+        for regionfile, filemtime in self.regionfiles.itervalues():
+            try:
+                with open(regionfile, "rb") as f:
+                    header = f.read(8192)
+                size = os.path.getsize(regionfile)
+            except EnvironmentError, e:
+                logging.warning("Could not read region file %s: %s. Skipping it.", regionfile, e)
+                continue
+            yield regionfile, (filemtime, size, hashlib.md5(header).hexdigest())
+
+    def get_region_chunk_arrays(self, regionfile):
+        """Returns the chunk metadata of one region file, as returned by
+        iterate_regions(), all at once. Returns three numpy arrays (x, z,
+        mtime) with an item for each chunk, like iterate_chunks() yields.
+
+        """
+        p = os.path.basename(regionfile).split(".")
+        regionx = int(p[1])
+        regiony = int(p[2])
+        try:
+            mcr = self._get_regionobj(regionfile)
+        except nbt.CorruptRegionError:
+            logging.warning("Found a corrupt region file at %s,%s. Skipping it.", regionx, regiony)
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return empty, empty, empty
+        locations, timestamps = mcr.get_chunk_table()
+        indices = numpy.flatnonzero(numpy.array(locations, dtype=numpy.uint32) >> 8)
+        return (indices % 32 + 32*regionx, indices // 32 + 32*regiony,
+                numpy.array(timestamps, dtype=numpy.int64)[indices])
+
+    def get_region_pois(self, regionfile, known=None):
+        """Reads the entities of every chunk in one region file, as returned
+        by iterate_regions(). Returns a list with an (x, z, mtime,
+        tileentities, entities) tuple for each chunk, where the last two are
+        the chunk's TileEntities and Entities lists.
+
+        This is the fast path for genPOI: the region file is opened just
+        once, and nothing but the entities is decoded (see the "poi" profile
+        of get_chunk()). Corrupt chunks are skipped with a warning.
+
+        known, if given, maps the (x, z) of chunks read on an earlier call to
+        the mtime they had then. Chunks whose mtime is still the same are not
+        decoded again, and have None for both entity lists.
+
+        """
+        p = os.path.basename(regionfile).split(".")
+        regionx = int(p[1])
+        regiony = int(p[2])
+        skip = self._chunk_profiles["poi"]
+        try:
+            mcr = nbt.load_region(regionfile, use_mmap=True)
+        except (nbt.CorruptRegionError, EnvironmentError):
+            logging.warning("Found a corrupt region file at %s,%s. Skipping it.", regionx, regiony)
+            return []
+
+        pois = []
+        try:
+            for chunkx, chunky in mcr.get_chunks():
+                x = chunkx + 32*regionx
+                z = chunky + 32*regiony
+                mtime = mcr.get_chunk_timestamp(chunkx, chunky)
+                if known and known.get((x, z)) == mtime:
+                    pois.append((x, z, mtime, None, None))
+                    continue
+                try:
+                    data = mcr.load_chunk(chunkx, chunky, skip=skip)
+                except nbt.CorruptionError:
+                    logging.warning("Ignoring POIs in corrupt chunk %d,%d", x, z)
+                    continue
+                if data is None:
+                    continue
+                level = data[1].get('Level', {})
+                pois.append((x, z, mtime,
+                             level.get('TileEntities', []), level.get('Entities', [])))
+        finally:
+            mcr.close()
+        return pois
+
     def get_chunk_mtime(self, x, z):
         """Returns a chunk's mtime, or False if the chunk does not exist.  This
         is therefore a dual purpose method. It corrects for the given north
@@ -509,6 +701,11 @@ class RegionSet(object):
             return data.get_chunk_timestamp(x,z)
         return None
 
+    def get_caches(self):
+        """Returns the list of cache objects chunks from this regionset are
+        read through. A plain RegionSet has none, see CachedRegionSet."""
+        return []
+
     def _get_region_path(self, chunkX, chunkY):
         """Returns the path to the region that contains chunk (chunkX, chunkY)
         Coords can be either be global chunk coords, or local to a region
@@ -550,18 +747,29 @@ class RegionSetWrapper(object):
     def __init__(self, rsetobj):
         self._r = rsetobj
 
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self._r)
+
     def get_type(self):
         return self._r.get_type()
     def get_biome_data(self, x, z):
         return self._r.get_biome_data(x,z)
-    def get_chunk(self, x, z):
-        return self._r.get_chunk(x,z)
+    def get_chunk(self, x, z, profile=None):
+        return self._r.get_chunk(x,z, profile)
     def iterate_chunks(self):
         return self._r.iterate_chunks()
     def iterate_newer_chunks(self,filemtime):
         return self._r.iterate_newer_chunks(filemtime)
+    def iterate_regions(self):
+        return self._r.iterate_regions()
+    def get_region_chunk_arrays(self, regionfile):
+        return self._r.get_region_chunk_arrays(regionfile)
+    def get_region_pois(self, regionfile, known=None):
+        return self._r.get_region_pois(regionfile, known)
     def get_chunk_mtime(self, x, z):
         return self._r.get_chunk_mtime(x,z)
+    def get_caches(self):
+        return self._r.get_caches()
     
 # see RegionSet.rotate.  These values are chosen so that they can be
 # passed directly to rot90; this means that they're the number of
@@ -612,23 +820,35 @@ class RotatedRegionSet(RegionSetWrapper):
         return (self._r, self.north_dir)
     def __setstate__(self, args):
         self.__init__(args[0], args[1])
+
+    def __repr__(self):
+        return "<RotatedRegionSet north_dir=%r %r>" % (self.north_dir, self._r)
     
-    def get_chunk(self, x, z):
+    def _rotate_array(self, section, arrayname):
+        array = section[arrayname]
+        # Since the anvil change, arrays are arranged with axes Y,Z,X
+        # numpy.rot90 always rotates the first two axes, so for it to
+        # work, we need to temporarily move the X axis to the 0th axis.
+        array = numpy.swapaxes(array, 0,2)
+        array = numpy.rot90(array, self.north_dir)
+        array = numpy.swapaxes(array, 0,2)
+        return array
+
+    def get_chunk(self, x, z, profile=None):
         x,z = self.unrotate(x,z)
-        chunk_data = dict(super(RotatedRegionSet, self).get_chunk(x,z))
+        chunk_data = dict(super(RotatedRegionSet, self).get_chunk(x,z, profile))
+        if 'Sections' not in chunk_data:
+            # a profile without the sections, so nothing to rotate
+            return chunk_data
         newsections = []
         for section in chunk_data['Sections']:
-            section = dict(section)
-            newsections.append(section)
+            # rotate each array only once it's needed; dict.items gives the
+            # unexpanded placeholders, which the loaders replace
+            loaders = {}
             for arrayname in ['Blocks', 'Data', 'SkyLight', 'BlockLight']:
-                array = section[arrayname]
-                # Since the anvil change, arrays are arranged with axes Y,Z,X
-                # numpy.rot90 always rotates the first two axes, so for it to
-                # work, we need to temporarily move the X axis to the 0th axis.
-                array = numpy.swapaxes(array, 0,2)
-                array = numpy.rot90(array, self.north_dir)
-                array = numpy.swapaxes(array, 0,2)
-                section[arrayname] = array
+                if arrayname in section:
+                    loaders[arrayname] = functools.partial(self._rotate_array, section, arrayname)
+            newsections.append(ChunkSection(dict.items(section), loaders))
         chunk_data['Sections'] = newsections
         
         # same as above, for biomes (Z/X indexed)
@@ -651,6 +871,22 @@ class RotatedRegionSet(RegionSetWrapper):
             x,z = self.rotate(x,z)
             yield x,z,mtime
 
+    def get_region_chunk_arrays(self, regionfile):
+        # the rotation functions work just as well on whole arrays
+        x,z,mtime = super(RotatedRegionSet, self).get_region_chunk_arrays(regionfile)
+        x,z = self.rotate(x,z)
+        return x,z,mtime
+
+    def get_region_pois(self, regionfile, known=None):
+        # entity positions are left alone, like get_chunk() does
+        if known:
+            known = dict((self.unrotate(x,z), mtime) for (x,z), mtime in known.iteritems())
+        pois = []
+        for x,z,mtime,tileentities,entities in super(RotatedRegionSet, self).get_region_pois(regionfile, known):
+            x,z = self.rotate(x,z)
+            pois.append((x,z,mtime,tileentities,entities))
+        return pois
+
 class CroppedRegionSet(RegionSetWrapper):
     def __init__(self, rsetobj, xmin, zmin, xmax, zmax):
         super(CroppedRegionSet, self).__init__(rsetobj)
@@ -659,12 +895,15 @@ class CroppedRegionSet(RegionSetWrapper):
         self.zmin = zmin//16
         self.zmax = zmax//16
 
-    def get_chunk(self,x,z):
+    def __repr__(self):
+        return "<CroppedRegionSet bounds=%r %r>" % ((self.xmin, self.zmin, self.xmax, self.zmax), self._r)
+
+    def get_chunk(self,x,z, profile=None):
         if (
                 self.xmin <= x <= self.xmax and
                 self.zmin <= z <= self.zmax
                 ):
-            return super(CroppedRegionSet, self).get_chunk(x,z)
+            return super(CroppedRegionSet, self).get_chunk(x,z, profile)
         else:
             raise ChunkDoesntExist("This chunk is out of the requested bounds")
 
@@ -682,6 +921,19 @@ class CroppedRegionSet(RegionSetWrapper):
                     self.zmin <= z <= self.zmax
                 )
 
+    def get_region_chunk_arrays(self, regionfile):
+        x,z,mtime = super(CroppedRegionSet,self).get_region_chunk_arrays(regionfile)
+        inbounds = ((self.xmin <= x) & (x <= self.xmax) &
+                    (self.zmin <= z) & (z <= self.zmax))
+        return x[inbounds], z[inbounds], mtime[inbounds]
+
+    def get_region_pois(self, regionfile, known=None):
+        return [poi for poi in super(CroppedRegionSet,self).get_region_pois(regionfile, known)
+                if
+                    self.xmin <= poi[0] <= self.xmax and
+                    self.zmin <= poi[1] <= self.zmax
+                ]
+
     def get_chunk_mtime(self,x,z):
         if (
                 self.xmin <= x <= self.xmax and
@@ -725,8 +977,8 @@ class CachedRegionSet(RegionSetWrapper):
 
         self.key = s
 
-    def get_chunk(self, x, z):
-        key = hashlib.md5(repr((self.key, x, z))).hexdigest()
+    def get_chunk(self, x, z, profile=None):
+        key = hashlib.md5(repr((self.key, x, z, profile))).hexdigest()
         for i, cache in enumerate(self.caches):
             try:
                 retval = cache[key]
@@ -737,7 +989,7 @@ class CachedRegionSet(RegionSetWrapper):
             except KeyError:
                 pass
         else:
-            retval = super(CachedRegionSet, self).get_chunk(x,z)
+            retval = super(CachedRegionSet, self).get_chunk(x,z, profile)
 
         # Now add retval to all the caches that didn't have it, all the caches
         # up to and including index i
@@ -745,6 +997,9 @@ class CachedRegionSet(RegionSetWrapper):
             cache[key] = retval
 
         return retval
+
+    def get_caches(self):
+        return self.caches + self._r.get_caches()
         
 
 def get_save_dir():
@@ -8,10 +8,15 @@ sys.path.insert(0, os.path.join(os.getcwd(), os.pardir))
 
 # Import unit test cases or suites here
 from test_tileobj import TileTest
-from test_rendertileset import RendertileSetTest
+from test_rendertileset import RendertileSetTest, ArrayRendertileSetTest
 from test_settings import SettingsTest
-from test_tileset import TilesetTest
-from test_cache import TestLRU
+from test_tileset import TilesetTest, RenderTileTest
+from test_cache import TestLRU, TestSharedChunkCache
+from test_nbt import NBTTest, RegionTest
+from test_world import ChunkSectionTest, RegionPOITest
+from test_dispatcher import DispatcherTest
+from test_textures import BlockmapCacheTest, GenerateTest, FindFileTest
+from test_genpoi import POICacheTest
 
 # DISABLE THIS BLOCK TO GET LOG OUTPUT FROM TILESET FOR DEBUGGING
 if 0:
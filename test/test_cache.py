@@ -1,6 +1,10 @@
 import unittest
+import os
+import cPickle
+import multiprocessing
+import functools
 
-from overviewer_core import cache
+from overviewer_core import cache, world
 
 class TestLRU(unittest.TestCase):
 
@@ -54,3 +58,88 @@ class TestLRU(unittest.TestCase):
         self.assertEquals(self.lru[4], 'asdf')
         self.assertEquals(self.lru[5], 'asdf')
         self.assertEquals(self.lru[6], 'asdf')
+
+def _set_item(c, key, value):
+    c[key] = value
+
+class TestSharedChunkCache(unittest.TestCase):
+
+    def setUp(self):
+        # a single set of 4 ways, so the LRU order is easy to follow
+        self.cache = cache.SharedChunkCache(size=1, slotsize=256*1024, ways=4)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_insert(self):
+        self.cache["a"] = {'Sections': [{'Y': 1}]}
+        self.cache["b"] = 'asdf'
+        self.assertEquals(self.cache["a"], {'Sections': [{'Y': 1}]})
+        self.assertEquals(self.cache["b"], 'asdf')
+        self.assertRaises(KeyError, self.cache.__getitem__, "c")
+        self.assertEquals((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_replace(self):
+        self.cache["a"] = 'asdf'
+        self.cache["a"] = 'qwer'
+        self.assertEquals(self.cache["a"], 'qwer')
+
+    def test_lru(self):
+        for key in "abcd":
+            self.cache[key] = key
+        self.assertEquals(self.cache["a"], "a")
+        # b is the least recently used now
+        self.cache["e"] = "e"
+        self.assertRaises(KeyError, self.cache.__getitem__, "b")
+        for key in "acde":
+            self.assertEquals(self.cache[key], key)
+
+    def test_too_big(self):
+        self.cache["a"] = 'x' * (512*1024)
+        self.assertRaises(KeyError, self.cache.__getitem__, "a")
+
+    def test_shared(self):
+        other = cPickle.loads(cPickle.dumps(self.cache))
+        other["a"] = 'asdf'
+        self.assertEquals(self.cache["a"], 'asdf')
+
+        # a worker process on the same machine
+        p = multiprocessing.Process(target=_set_item, args=(other, "b", 'qwer'))
+        p.start()
+        p.join()
+        self.assertEquals(self.cache["b"], 'qwer')
+
+    def test_small_shm(self):
+        free_space = cache._free_space
+        cache._free_space = lambda path: 1024 * 1024
+        try:
+            c = cache.SharedChunkCache(size=2, slotsize=256*1024, ways=4)
+        finally:
+            cache._free_space = free_space
+        try:
+            self.assertFalse(c.path.startswith("/dev/shm/"))
+            c["a"] = 'asdf'
+            self.assertEquals(c["a"], 'asdf')
+        finally:
+            c.close()
+
+    def test_lazy_sections(self):
+        blocks = "\x01" * 4096
+        section = world.ChunkSection({'Y': 0, 'Blocks': blocks},
+                {'Blocks': functools.partial(world._expand_blocks, blocks)})
+        self.cache["a"] = {'Sections': [section]}
+        # neither the cached copy nor the original are expanded
+        copy = self.cache["a"]['Sections'][0]
+        self.assertEquals(section._loaders.keys(), ['Blocks'])
+        self.assertEquals(copy._loaders.keys(), ['Blocks'])
+        self.assertEquals(copy['Blocks'][15,15,15], 1)
+
+    def test_close(self):
+        path = self.cache.path
+        self.assertTrue(os.path.exists(path))
+        self.cache.close()
+        self.assertFalse(os.path.exists(path))
+        # the arena is gone, so this can't attach to it any more
+        other = cPickle.loads(cPickle.dumps(self.cache))
+        other["a"] = 'asdf'
+        self.assertRaises(KeyError, other.__getitem__, "a")
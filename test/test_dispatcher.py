@@ -0,0 +1,172 @@
+import unittest
+import os
+import tempfile
+from collections import deque
+
+from overviewer_core import dispatcher, cache
+
+class FakeWorker(object):
+    """Yields a post-traversal of a quadtree of the given depth, with each
+    composite depending on its children, and records the order of do_work
+    calls. If a log file is given, they're recorded in it, so they can be
+    followed in worker processes too."""
+    def __init__(self, depth, logpath=None):
+        self.depth = depth
+        self.logpath = logpath
+        self.done = []
+
+    def get_num_phases(self):
+        return 1
+
+    def get_phase_length(self, phase):
+        return None
+
+    def iterate_work_items(self, phase):
+        def helper(path):
+            if len(path) < self.depth:
+                for i in xrange(4):
+                    for item in helper(path + (i,)):
+                        yield item
+            yield path, [path + (i,) for i in xrange(4)]
+        return helper(())
+
+    def do_work(self, workitem):
+        if self.logpath is None:
+            self.done.append(workitem)
+        else:
+            with open(self.logpath, "a") as f:
+                f.write(",".join(str(i) for i in workitem) + "\n")
+
+    def get_done(self):
+        if self.logpath is None:
+            return self.done
+        with open(self.logpath) as f:
+            return [tuple(int(i) for i in line.split(",") if i) for line in f.read().splitlines()]
+
+class LaggingDispatcher(dispatcher.Dispatcher):
+    """Jobs finish a few dispatches after they're started"""
+    def __init__(self):
+        super(LaggingDispatcher, self).__init__()
+        self.running = deque()
+        self.finished = set()
+
+    def dispatch(self, tileset, workitem):
+        if tileset is not None:
+            for i in xrange(4):
+                assert (tileset, workitem + (i,)) not in self.running
+            self.running.append((tileset, workitem))
+            if len(self.running) < 10:
+                return []
+        if not self.running:
+            return []
+        tileset, workitem = self.running.popleft()
+        tileset.do_work(workitem)
+        return [(tileset, workitem)]
+
+class FakeObserver(object):
+    def start(self, max_value):
+        self.count = 0
+    def add(self, amount):
+        self.count += amount
+    def finish(self):
+        pass
+
+class FailingWorker(FakeWorker):
+    def do_work(self, workitem):
+        if workitem == (1, 2):
+            raise ValueError(workitem)
+        super(FailingWorker, self).do_work(workitem)
+
+class FakeTileSet(object):
+    def __init__(self, caches):
+        self.caches = caches
+    def get_caches(self):
+        return self.caches
+
+class FakeTileSetProxy(object):
+    def __init__(self, tilesets):
+        self.tilesets = tilesets
+    def _getvalue(self):
+        return self.tilesets, 1
+
+class FakeManager(object):
+    def __init__(self, tilesets):
+        self.tilesets = tilesets
+    def get_tileset_data(self):
+        return FakeTileSetProxy(self.tilesets)
+
+class UncountedCache(object):
+    """A cache without hits and misses counters"""
+    def __getitem__(self, key):
+        raise KeyError(key)
+
+class DyingWorker(FakeWorker):
+    def do_work(self, workitem):
+        if workitem == (1, 2):
+            os._exit(3)
+        super(DyingWorker, self).do_work(workitem)
+
+class DispatcherTest(unittest.TestCase):
+    def test_dependencies(self):
+        self.check_dependencies(LaggingDispatcher())
+
+    def test_threaded_dependencies(self):
+        d = dispatcher.ThreadedDispatcher(4)
+        try:
+            self.check_dependencies(d)
+        finally:
+            d.close()
+
+    def test_threaded_exception(self):
+        d = dispatcher.ThreadedDispatcher(2)
+        try:
+            self.assertRaises(ValueError, d.render_all, [FailingWorker(2)], FakeObserver())
+        finally:
+            d.close()
+
+    def test_multiprocessing_dependencies(self):
+        d = dispatcher.MultiprocessingDispatcher(local_procs=2)
+        try:
+            self.check_dependencies(d)
+        finally:
+            d.close()
+
+    def test_multiprocessing_dead_worker(self):
+        d = dispatcher.MultiprocessingDispatcher(local_procs=2)
+        try:
+            self.assertRaises(RuntimeError, d.render_all, [DyingWorker(2)], FakeObserver())
+        finally:
+            d.close()
+
+    def test_cache_stats(self):
+        counted = cache.LRUCache()
+        counted.hits, counted.misses = 3, 2
+        uncounted = UncountedCache()
+        manager = FakeManager([FakeTileSet([counted, uncounted]), FakeTileSet([uncounted])])
+        p = dispatcher.MultiprocessingDispatcherProcess(manager, 0, job_conn=object())
+        p.update_tilesets()
+        self.assertEqual(p.get_cache_stats(),
+                [("LRUCache", 3, 2), ("UncountedCache", 0, 0)])
+
+    def check_dependencies(self, d):
+        fd, logpath = tempfile.mkstemp(prefix="overviewer-test-")
+        os.close(fd)
+        try:
+            worker = FakeWorker(3, logpath)
+            observer = FakeObserver()
+            d.render_all([worker], observer)
+            workitems = worker.get_done()
+        finally:
+            os.remove(logpath)
+
+        self.assertEqual(observer.count, (4**4 - 1) // 3)
+        self.assertEqual(len(workitems), observer.count)
+        done = set()
+        for workitem in workitems:
+            if len(workitem) < worker.depth:
+                for i in xrange(4):
+                    self.assertTrue(workitem + (i,) in done)
+            done.add(workitem)
+
+if __name__ == "__main__":
+    unittest.main()
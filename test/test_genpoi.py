@@ -0,0 +1,109 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+from overviewer_core import world
+from overviewer_core.aux_files import genPOI
+from test_nbt import make_region
+from test_world import make_poi_chunk
+
+def signFilter(poi):
+    if poi['id'] == 'Sign':
+        return poi['Text1']
+
+class POICacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="overviewer-test-")
+        self.regiondir = os.path.join(self.tmpdir, "world", "region")
+        os.makedirs(self.regiondir)
+        self.outputdir = os.path.join(self.tmpdir, "output")
+        os.mkdir(self.outputdir)
+        self.config = {'outputdir': self.outputdir, 'processes': 1}
+        self.render = {'worldname_orig': 'w'}
+        self.cachedir = os.path.join(self.outputdir, "poicache", "w_overworld")
+
+        self.write_region("r.0.0.mca",
+                (make_poi_chunk(tileentities=[(u"Sign", 16, 64, 32, u"a")]), 1, 2, 100),
+                (make_poi_chunk(entities=[(u"Pig", 50.5, 64.0, 70.5)]), 3, 4, 200))
+        self.write_region("r.1.0.mca",
+                (make_poi_chunk(tileentities=[(u"Sign", 520, 64, 3, u"b")]), 0, 0, 300))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_region(self, name, *chunks):
+        with open(os.path.join(self.regiondir, name), "wb") as f:
+            f.write(make_region(*(chunks[0] + chunks[1:])))
+
+    def get_rset(self):
+        # a fresh one, so it sees the region files as they are now
+        return world.RegionSet(self.regiondir, "region")
+
+    def read_all(self):
+        result = {}
+        for regionfile, chunks in genPOI.iterateRegionPOIs(self.get_rset(), self.render, self.config):
+            result[os.path.basename(regionfile)] = sorted(chunks)
+        return result
+
+    def sign_texts(self, chunks):
+        return [te['Text1'] for chunk in chunks for te in chunk[3]]
+
+    def test_cache(self):
+        first = self.read_all()
+        self.assertEqual(sorted(first), ["r.0.0.mca", "r.1.0.mca"])
+        self.assertEqual(self.sign_texts(first["r.0.0.mca"]), [u"a"])
+        self.assertEqual(sorted(os.listdir(self.cachedir)), ["index.dat", "r.0.0.dat", "r.1.0.dat"])
+
+        # nothing changed, so it all comes from the cache
+        self.assertEqual(self.read_all(), first)
+
+        # The sign changes without its chunk's timestamp changing, so the
+        # cached one is still used. The other chunk is read again.
+        self.write_region("r.0.0.mca",
+                (make_poi_chunk(tileentities=[(u"Sign", 16, 64, 32, u"changed")]), 1, 2, 100),
+                (make_poi_chunk(tileentities=[(u"Sign", 50, 64, 70, u"new")]), 3, 4, 201))
+        os.utime(os.path.join(self.regiondir, "r.0.0.mca"), (1000, 1000))
+        second = self.read_all()
+        self.assertEqual(self.sign_texts(second["r.0.0.mca"]), [u"a", u"new"])
+        self.assertEqual([chunk[2] for chunk in second["r.0.0.mca"]], [100, 201])
+        self.assertEqual(second["r.1.0.mca"], first["r.1.0.mca"])
+
+    def test_removed_region(self):
+        self.read_all()
+        os.remove(os.path.join(self.regiondir, "r.1.0.mca"))
+        self.assertEqual(sorted(self.read_all()), ["r.0.0.mca"])
+        self.assertEqual(sorted(os.listdir(self.cachedir)), ["index.dat", "r.0.0.dat"])
+        self.assertEqual(genPOI.loadPOICacheIndex(self.cachedir, self.get_rset()).keys(),
+                [os.path.join(self.regiondir, "r.0.0.mca")])
+
+    def test_corrupt_cache(self):
+        self.read_all()
+        with open(os.path.join(self.cachedir, "r.0.0.dat"), "wb") as f:
+            f.write("not a pickle")
+        with open(os.path.join(self.cachedir, "index.dat"), "wb") as f:
+            f.write("not a pickle")
+        self.assertEqual(self.sign_texts(self.read_all()["r.0.0.mca"]), [u"a"])
+
+    def test_shards(self):
+        groups = [("signs", signFilter)]
+        sharddir = os.path.join(self.outputdir, "markers", "w_overworld")
+        name, index = genPOI.writeMarkerShards(self.get_rset(), self.render, self.outputdir, self.config, groups)
+        self.assertEqual(name, "w_overworld")
+        self.assertEqual(index, {"0.0": 1, "1.0": 1})
+        with open(os.path.join(sharddir, "r.0.0.json")) as f:
+            shard = json.load(f)
+        self.assertEqual(shard, {"signs": [dict(x=16, y=64, z=32, text="a", hovertext="a")]})
+
+        # one region loses its sign, and the other one goes away
+        self.write_region("r.0.0.mca",
+                (make_poi_chunk(), 1, 2, 150),
+                (make_poi_chunk(entities=[(u"Pig", 50.5, 64.0, 70.5)]), 3, 4, 200))
+        os.remove(os.path.join(self.regiondir, "r.1.0.mca"))
+        name, index = genPOI.writeMarkerShards(self.get_rset(), self.render, self.outputdir, self.config, groups)
+        self.assertEqual(index, {})
+        self.assertEqual(os.listdir(sharddir), [])
+
+if __name__ == "__main__":
+    unittest.main()
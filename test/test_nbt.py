@@ -0,0 +1,160 @@
+import unittest
+import struct
+import zlib
+import gzip
+import StringIO
+import tempfile
+import shutil
+import os
+
+from overviewer_core import nbt
+
+def _tag_string(s):
+    s = s.encode("UTF-8")
+    return struct.pack(">h", len(s)) + s
+
+def _named(tagtype, name, payload):
+    return chr(tagtype) + _tag_string(name) + payload
+
+def make_chunk_nbt():
+    """Builds an uncompressed NBT blob that uses every tag type."""
+    section = (
+        _named(1, u"Y", struct.pack("b", -3)) +
+        _named(7, u"Blocks", struct.pack(">i", 8) + "\x01\x02\x03\x04\xfe\xff\x00\x07") +
+        chr(0))
+    level = (
+        _named(2, u"Short", struct.pack(">h", -1234)) +
+        _named(3, u"xPos", struct.pack(">i", -70000)) +
+        _named(4, u"LastUpdate", struct.pack(">q", 1 << 40)) +
+        _named(5, u"Float", struct.pack(">f", 0.5)) +
+        _named(6, u"Double", struct.pack(">d", -2.25)) +
+        _named(8, u"Name", _tag_string(u"caf\xe9")) +
+        _named(11, u"HeightMap", struct.pack(">i", 3) + struct.pack(">3i", 1, -2, 3)) +
+        _named(9, u"Sections", chr(10) + struct.pack(">i", 2) + section + section) +
+        _named(9, u"Entities", chr(0) + struct.pack(">i", 0)) +
+        chr(0))
+    return _named(10, u"", _named(10, u"Level", level) + chr(0))
+
+class NBTTest(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = make_chunk_nbt()
+
+    def python_load(self, raw):
+        return nbt.NBTFileReader(StringIO.StringIO(zlib.compress(raw)), is_gzip=False).read_all()
+
+    def test_python_reader(self):
+        name, data = self.python_load(self.raw)
+        self.assertEquals(name, u"")
+        level = data[u"Level"]
+        self.assertEquals(level[u"xPos"], -70000)
+        self.assertEquals(level[u"LastUpdate"], 1 << 40)
+        self.assertEquals(level[u"Name"], u"caf\xe9")
+        self.assertEquals(level[u"HeightMap"], (1, -2, 3))
+        self.assertEquals(level[u"Sections"][1][u"Y"], -3)
+        self.assertEquals(level[u"Entities"], [])
+
+    def test_native_matches_python(self):
+        if nbt._c_nbt_load is None:
+            return
+        self.assertEquals(nbt._c_nbt_load(self.raw), self.python_load(self.raw))
+
+    def test_load_compressed(self):
+        expected = self.python_load(self.raw)
+        self.assertEquals(nbt._load_compressed(zlib.compress(self.raw), is_gzip=False), expected)
+
+    def test_truncated(self):
+        data = zlib.compress(self.raw[:len(self.raw) // 2])
+        self.assertRaises(nbt.CorruptNBTError, nbt._load_compressed, data, False)
+
+    def test_skip(self):
+        skip = frozenset(["Sections", "HeightMap", "Name", "Blocks"])
+        name, data = nbt.NBTFileReader(StringIO.StringIO(zlib.compress(self.raw)),
+                is_gzip=False, skip=skip).read_all()
+        expected = self.python_load(self.raw)[1]
+        for tag in ("Sections", "HeightMap", "Name"):
+            del expected[u"Level"][tag]
+        self.assertEquals(data, expected)
+        self.assertEquals(nbt._load_compressed(zlib.compress(self.raw), False, skip), (name, data))
+
+    def test_skip_nested(self):
+        # the Blocks of each section are skipped, the rest is kept
+        skip = frozenset(["Blocks"])
+        name, data = nbt._load_compressed(zlib.compress(self.raw), False, skip)
+        self.assertEquals(data[u"Level"][u"Sections"], [{u"Y": -3}, {u"Y": -3}])
+        if nbt._c_nbt_load is not None:
+            self.assertEquals(nbt._c_nbt_load(self.raw, skip), (name, data))
+
+    def test_skip_truncated(self):
+        # a skipped tag still has to be all there
+        raw = self.raw[:self.raw.index("Entities") - 10]
+        self.assertRaises(nbt.CorruptNBTError, nbt._load_compressed,
+                zlib.compress(raw), False, frozenset(["Sections"]))
+
+def make_region(raw, x, z, timestamp, *chunks):
+    """Builds a region file holding one chunk at (x, z). More chunks can
+    be given as further (raw, x, z, timestamp) tuples."""
+    locations = [0] * 1024
+    timestamps = [0] * 1024
+    data = []
+    sector = 2
+    for raw, x, z, timestamp in ((raw, x, z, timestamp),) + chunks:
+        payload = zlib.compress(raw)
+        chunk = struct.pack(">IB", len(payload) + 1, 2) + payload
+        sectors = (len(chunk) + 4095) // 4096
+        locations[x + z * 32] = (sector << 8) | sectors
+        timestamps[x + z * 32] = timestamp
+        data.append(chunk + "\x00" * (sectors * 4096 - len(chunk)))
+        sector += sectors
+    return struct.pack(">1024I", *locations) + struct.pack(">1024i", *timestamps) + "".join(data)
+
+class RegionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.raw = make_chunk_nbt()
+        self.tmpdir = tempfile.mkdtemp(prefix="OVTEST")
+        self.path = os.path.join(self.tmpdir, "r.0.0.mca")
+        with open(self.path, "wb") as f:
+            f.write(make_region(self.raw, 1, 2, 1234))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_region(self, use_mmap):
+        region = nbt.load_region(self.path, use_mmap=use_mmap)
+        try:
+            self.assertEquals(list(region.get_chunks()), [(1, 2)])
+            self.assertEquals(region.get_chunk_timestamp(1, 2), 1234)
+            self.assertEquals(region.load_chunk(1, 2), nbt.load(StringIO.StringIO(self.gzipped())))
+            self.assertEquals(region.load_chunk(0, 0), None)
+        finally:
+            region.close()
+
+    def gzipped(self):
+        out = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=out, mode="wb")
+        f.write(self.raw)
+        f.close()
+        return out.getvalue()
+
+    def test_region_file(self):
+        self.check_region(False)
+
+    def test_region_mmap(self):
+        self.check_region(True)
+
+    def test_region_mmap_truncated(self):
+        with open(self.path, "r+b") as f:
+            f.truncate(8192 + 100)
+        region = nbt.load_region(self.path, use_mmap=True)
+        try:
+            self.assertRaises(nbt.CorruptRegionError, region.load_chunk, 1, 2)
+        finally:
+            region.close()
+
+    def test_region_mmap_empty(self):
+        open(self.path, "wb").close()
+        self.assertRaises(nbt.CorruptRegionError, nbt.load_region, self.path, use_mmap=True)
+
+if __name__ == "__main__":
+    unittest.main()
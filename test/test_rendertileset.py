@@ -1,11 +1,15 @@
 import unittest
+import random
+import cPickle
 
 from itertools import chain, izip
 
-from overviewer_core.tileset import iterate_base4, RendertileSet
+from overviewer_core.tileset import iterate_base4, RendertileSet, ArrayRendertileSet
 from overviewer_core.util import roundrobin
 
 class RendertileSetTest(unittest.TestCase):
+    tree_class = RendertileSet
+
     # If you change this definition, you must also change the hard-coded
     # results list in test_posttraverse()
     tile_paths = frozenset([
@@ -94,7 +98,7 @@ class RendertileSetTest(unittest.TestCase):
     tile_paths_posttraversal_robin = list(roundrobin(tile_paths_posttraversal_lists)) + [()]
 
     def setUp(self):
-        self.tree = RendertileSet(3)
+        self.tree = self.tree_class(3)
         for t in self.tile_paths:
             self.tree.add(t)
 
@@ -139,7 +143,7 @@ class RendertileSetTest(unittest.TestCase):
         self.assertRaises(AssertionError, self.test_iterate)
 
         # If something was supposed to be returned but wasn't
-        tree = RendertileSet(3)
+        tree = self.tree_class(3)
         c = len(self.tile_paths) // 2
         for t in self.tile_paths:
             tree.add(t)
@@ -155,7 +159,7 @@ class RendertileSetTest(unittest.TestCase):
     def test_bool(self):
         "Tests the boolean status of a node"
         self.assertTrue(self.tree)
-        t = RendertileSet(3)
+        t = self.tree_class(3)
         self.assertFalse(t)
         t.add((0,0,0))
         self.assertTrue(t)
@@ -223,5 +227,31 @@ class RendertileSetTest(unittest.TestCase):
         c = self.tree.count_all()
         self.assertEqual(c, 35)
 
+class ArrayRendertileSetTest(RendertileSetTest):
+    tree_class = ArrayRendertileSet
+
+    def test_pickle(self):
+        tree = cPickle.loads(cPickle.dumps(self.tree, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(list(tree.posttraversal()), self.tile_paths_posttraversal)
+
+    def test_matches_tree(self):
+        """Compares a larger random set against RendertileSet"""
+        r = random.Random(1)
+        paths = set(tuple(r.randint(0, 3) for _ in xrange(6)) for _ in xrange(2000))
+        tree = RendertileSet(6)
+        for path in paths:
+            tree.add(path)
+        arraytree = ArrayRendertileSet(6)
+        arraytree.update(paths)
+
+        self.assertEqual(arraytree.count(), tree.count())
+        self.assertEqual(arraytree.count_all(), tree.count_all())
+        for robin in (False, True):
+            for offset in ((0,0), (3,-2)):
+                self.assertEqual(list(arraytree.posttraversal(robin=robin, offset=offset)),
+                        list(tree.posttraversal(robin=robin, offset=offset)))
+                self.assertEqual(list(arraytree.iterate(4, robin=robin, offset=offset)),
+                        list(tree.iterate(4, robin=robin, offset=offset)))
+
 if __name__ == "__main__":
     unittest.main()
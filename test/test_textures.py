@@ -0,0 +1,254 @@
+import unittest
+import os
+import shutil
+import tempfile
+import hashlib
+import pickle
+import zipfile
+from cStringIO import StringIO
+
+from PIL import Image
+
+from overviewer_core import textures
+
+def write_block_textures(texturepath, names, transparent=()):
+    """Writes a texture for each of the given blocks into texturepath, each
+    its own color. The ones also in transparent get a transparent diagonal,
+    so their masks show up."""
+    blocksdir = os.path.join(texturepath, "assets", "minecraft", "textures", "blocks")
+    os.makedirs(blocksdir)
+    for i, name in enumerate(names):
+        img = Image.new("RGBA", (16, 16), (i * 30 % 256, 255 - i * 30 % 256, i * 10 % 256, 255))
+        if name in transparent:
+            for x in xrange(16):
+                img.putpixel((x, x), (255, 255, 255, 0))
+        img.save(os.path.join(blocksdir, name + ".png"))
+
+class BlockmapCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp(prefix="overviewer-test-")
+        # the texture files the blockmap was "generated" from
+        self.files = {"blocks/stone.png": "stone data", "blocks/dirt.png": "dirt data"}
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def make_textures(self):
+        tex = textures.Textures(cachedir=self.cachedir)
+        def find_file(filename, mode="rb", verbose=False):
+            if filename not in self.files:
+                raise textures.TextureException(filename)
+            return StringIO(self.files[filename])
+        tex.find_file = find_file
+        return tex
+
+    def save(self):
+        tex = self.make_textures()
+        tex.blockmap = [None] * textures.max_blockid * textures.max_data
+        tex.blockmap[1 * textures.max_data] = (Image.new("RGBA", (24, 24), (1, 2, 3, 255)),
+                                               Image.new("L", (24, 24), 255))
+        tex.blockmap[3 * textures.max_data + 2] = (Image.new("RGBA", (24, 12), (4, 5, 6, 128)),
+                                                   Image.new("L", (24, 12), 7))
+        tex.biome_grass_texture = Image.new("RGBA", (24, 24), (8, 9, 10, 255))
+        tex.texture_sources = dict((filename, hashlib.sha1(data).hexdigest())
+                                   for filename, data in self.files.iteritems())
+        tex.texture_sources["blocks/missing.png"] = None
+        tex.save_blockmap_cache()
+        return tex
+
+    def test_round_trip(self):
+        saved = self.save()
+        tex = self.make_textures()
+        self.assertTrue(tex.load_blockmap_cache())
+        self.assertEqual(len(tex.blockmap), len(saved.blockmap))
+        for index, entry in enumerate(saved.blockmap):
+            if entry is None:
+                self.assertEqual(tex.blockmap[index], None)
+                continue
+            img, mask = tex.blockmap[index]
+            self.assertEqual((img.mode, img.size), ("RGBA", entry[0].size))
+            self.assertEqual(img.tobytes(), entry[0].tobytes())
+            self.assertEqual((mask.mode, mask.size), ("L", entry[1].size))
+            self.assertEqual(mask.tobytes(), entry[1].tobytes())
+        self.assertEqual(tex.biome_grass_texture.tobytes(), saved.biome_grass_texture.tobytes())
+
+    def test_source_changed(self):
+        self.save()
+        self.files["blocks/dirt.png"] = "other dirt data"
+        self.assertFalse(self.make_textures().load_blockmap_cache())
+
+    def test_missing_source_appeared(self):
+        self.save()
+        self.files["blocks/missing.png"] = "found it"
+        self.assertFalse(self.make_textures().load_blockmap_cache())
+
+    def test_truncated(self):
+        self.save()
+        with open(self.find_cache_file(), "rb") as f:
+            data = f.read()
+        path = os.path.join(self.cachedir, "truncated.dat")
+        with open(path, "wb") as f:
+            f.write(data[:-1])
+        self.assertFalse(self.make_textures().load_blockmap_file(path))
+        with open(path, "wb") as f:
+            f.write("XXXXXXXX" + data[8:])
+        self.assertFalse(self.make_textures().load_blockmap_file(path))
+
+    def find_cache_file(self):
+        names = [name for name in os.listdir(self.cachedir) if name.endswith(".dat")]
+        self.assertEqual(len(names), 1)
+        return os.path.join(self.cachedir, names[0])
+
+class GenerateTest(unittest.TestCase):
+    # a few blocks, including grass, which needs the biome grass mask
+    keys = [(1, 0), (2, 0), (2, 1), (2, 0x10), (3, 0), (3, 1), (4, 0)]
+    files = ["stone", "grass_top", "grass_side", "grass_side_overlay",
+             "grass_side_snowed", "dirt", "cobblestone"]
+
+    def setUp(self):
+        self.texturepath = tempfile.mkdtemp(prefix="overviewer-test-")
+        write_block_textures(self.texturepath, self.files, ["grass_side_overlay"])
+        self.generators = textures.blockmap_generators
+        textures.blockmap_generators = dict((key, self.generators[key]) for key in self.keys)
+
+    def tearDown(self):
+        textures.blockmap_generators = self.generators
+        shutil.rmtree(self.texturepath)
+
+    def generate(self, processes):
+        tex = textures.Textures(texturepath=self.texturepath)
+        tex.generate(processes=processes)
+        return tex
+
+    def test_processes(self):
+        serial = self.generate(1)
+        parallel = self.generate(2)
+        for blockid, data in self.keys:
+            index = blockid * textures.max_data + data
+            self.assertTrue(serial.blockmap[index] is not None)
+            for a, b in zip(serial.blockmap[index], parallel.blockmap[index]):
+                self.assertEqual((a.mode, a.size), (b.mode, b.size))
+                self.assertEqual(a.tobytes(), b.tobytes())
+
+    def test_pickled_worker(self):
+        # what a worker gets when the pool has to pickle the object
+        serial = self.generate(1)
+        tex = textures.Textures(texturepath=self.texturepath)
+        tex.biome_grass_texture = serial.biome_grass_texture
+        grass = tex.biome_grass_texture
+        textures._init_generate_worker(pickle.loads(pickle.dumps(tex)),
+                (grass.mode, grass.size, grass.tobytes()))
+        try:
+            results, sources, times = textures._generate_blocks(self.keys)
+        finally:
+            textures._generate_textures = None
+        self.assertEqual(len(results), len(self.keys))
+        for index, mode, size, imgdata, maskdata in results:
+            img, mask = serial.blockmap[index]
+            self.assertEqual(imgdata, img.tobytes())
+            self.assertEqual(maskdata, mask.tobytes())
+
+class FindFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="overviewer-test-")
+        # a client jar where find_file() looks for one
+        self.home = os.environ.get("HOME")
+        os.environ["HOME"] = self.tmpdir
+        versiondir = os.path.join(self.tmpdir, ".minecraft", "versions", "1.8.9")
+        os.makedirs(versiondir)
+        self.write_zip(os.path.join(versiondir, "1.8.9.jar"), {
+                "assets/minecraft/textures/blocks/stone.png": "jar stone",
+                "assets/minecraft/textures/blocks/dirt.png": "jar dirt",
+                "misc/light_normal.png": "jar light"})
+        self.texturedir = os.path.join(self.tmpdir, "textures")
+        os.makedirs(os.path.join(self.texturedir, "assets", "minecraft", "textures", "blocks"))
+        with open(os.path.join(self.texturedir, "assets", "minecraft", "textures", "blocks", "stone.png"), "wb") as f:
+            f.write("dir stone")
+        self.pack = os.path.join(self.tmpdir, "pack.zip")
+        self.write_zip(self.pack, {"assets/minecraft/textures/blocks/stone.png": "pack stone"})
+
+    def tearDown(self):
+        if self.home is None:
+            del os.environ["HOME"]
+        else:
+            os.environ["HOME"] = self.home
+        shutil.rmtree(self.tmpdir)
+
+    def write_zip(self, path, files):
+        with zipfile.ZipFile(path, "w") as z:
+            for name, data in files.iteritems():
+                z.writestr(name, data)
+
+    def read(self, tex, filename):
+        f = tex.find_file(filename)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def check_order(self, texturepath, stone):
+        tex = textures.Textures(texturepath=texturepath)
+        # the jar is opened by the first lookup, and that doesn't put it
+        # ahead of the texturepath for the next ones
+        self.assertEqual(self.read(tex, "assets/minecraft/textures/blocks/dirt.png"), "jar dirt")
+        self.assertEqual(self.read(tex, "assets/minecraft/textures/blocks/stone.png"), stone)
+        # the jar comes before the bundled textures, subdirectories included
+        self.assertEqual(self.read(tex, "light_normal.png"), "jar light")
+        # and these are the last resort
+        with open(os.path.join(textures.util.get_program_path(), "overviewer_core",
+                               "data", "textures", "water.png"), "rb") as f:
+            self.assertEqual(self.read(tex, "water.png"), f.read())
+        self.assertRaises(textures.TextureException, tex.find_file, "blocks/missing.png")
+
+    def test_order_dir(self):
+        self.check_order(self.texturedir, "dir stone")
+
+    def test_order_pack(self):
+        self.check_order(self.pack, "pack stone")
+
+    def test_pack_short_paths(self):
+        tex = textures.Textures(texturepath=self.pack)
+        self.assertEqual(self.read(tex, "blocks/stone.png"), "pack stone")
+
+    def test_no_texturepath(self):
+        tex = textures.Textures()
+        self.assertEqual(self.read(tex, "assets/minecraft/textures/blocks/stone.png"), "jar stone")
+
+    def test_searched_once(self):
+        """Tests that each directory is only listed, and each zip only
+        opened, once, however many files are looked for"""
+        listed = []
+        opened = []
+        listdir = os.listdir
+        ZipFile = zipfile.ZipFile
+        def counting_listdir(path):
+            listed.append(os.path.normpath(path))
+            return listdir(path)
+        class CountingZipFile(ZipFile):
+            def __init__(self, path, *args, **kwargs):
+                opened.append(path)
+                ZipFile.__init__(self, path, *args, **kwargs)
+        os.listdir = counting_listdir
+        zipfile.ZipFile = CountingZipFile
+        try:
+            for texturepath in (self.texturedir, self.pack):
+                del listed[:], opened[:]
+                tex = textures.Textures(texturepath=texturepath)
+                for i in xrange(3):
+                    for filename in ("assets/minecraft/textures/blocks/stone.png",
+                                     "assets/minecraft/textures/blocks/dirt.png",
+                                     "light_normal.png", "water.png", "blocks/missing.png",
+                                     "blocks/missing2.png"):
+                        try:
+                            tex.find_file(filename).close()
+                        except textures.TextureException:
+                            pass
+                self.assertEqual(len(listed), len(set(listed)), listed)
+                self.assertEqual(len(opened), len(set(opened)), opened)
+                self.assertTrue(opened)
+        finally:
+            os.listdir = listdir
+            zipfile.ZipFile = ZipFile
+
+if __name__ == "__main__":
+    unittest.main()
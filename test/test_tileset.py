@@ -5,8 +5,15 @@ from collections import defaultdict
 import os
 import os.path
 import random
+import struct
+import threading
 
-from overviewer_core import tileset
+import numpy
+from PIL import Image
+
+from overviewer_core import tileset, world, textures, rendermodes, c_overviewer
+from test_nbt import _named, make_region
+from test_textures import write_block_textures
 
 # Supporing data
 # chunks list: chunkx, chunkz mapping to chunkmtime
@@ -45,6 +52,7 @@ chunks = {
 class FakeRegionset(object):
     def __init__(self, chunks):
         self.chunks = dict(chunks)
+        self.regions_scanned = 0
 
     def get_chunk(self, x,z):
         return NotImplementedError()
@@ -57,6 +65,15 @@ class FakeRegionset(object):
         for (x,z),mtime in self.chunks.iteritems():
             yield x,z,mtime
 
+    def iterate_regions(self):
+        # All the chunks are in one "region", whose key is its chunks
+        yield "fakeregion", tuple(sorted(self.chunks.iteritems()))
+
+    def get_region_chunk_arrays(self, regionfile):
+        self.regions_scanned += 1
+        x, z, mtime = zip(*self.iterate_chunks())
+        return numpy.array(x), numpy.array(z), numpy.array(mtime)
+
     def get_chunk_mtime(self, x, z):
         try:
             return self.chunks[x,z]
@@ -183,6 +200,69 @@ class TilesetTest(unittest.TestCase):
         self.assertEqual(ts.get_num_phases(), 1)
         self.assertEqual(ts.get_phase_length(0), len(get_tile_set(chunks)))
 
+    def test_renderbatch_iterate(self):
+        """Tests that with the renderbatch option every tile is yielded in
+        exactly one work item, that every composite-tile is yielded after
+        the tiles beneath it, and that the batches replace the tiles at the
+        batch level in the dependencies
+
+        """
+        ts = self.get_tileset({'renderchecks': 2, 'renderbatch': 2}, self.get_outputdir())
+        items = list(ts.iterate_work_items(0))
+        self.assertEqual(ts.get_phase_length(0), len(items))
+
+        level = ts.treedepth - 2
+        expected = set(get_tile_set(chunks))
+        seen = set()
+        def check_composite(tilepath):
+            self.assertTrue(len(tilepath) < ts.treedepth)
+            self.assertFalse(tilepath in seen)
+            for child in expected:
+                if child[:len(tilepath)] == tilepath and child != tilepath:
+                    self.assertTrue(child in seen, "%s was yielded before %s" % (tilepath, child))
+            seen.add(tilepath)
+
+        batches = {}
+        for workitem, deps in items:
+            if isinstance(workitem, tileset.RenderBatch):
+                self.assertEqual(deps, [])
+                prefix = (workitem.tilepaths or workitem.composites)[0][:level]
+                for tilepath in workitem.tilepaths:
+                    self.assertEqual(len(tilepath), ts.treedepth)
+                    # every tile in a batch is under the same ancestor
+                    self.assertEqual(tilepath[:level], prefix)
+                    self.assertFalse(tilepath in seen)
+                    seen.add(tilepath)
+                for tilepath in workitem.composites:
+                    self.assertEqual(tilepath[:level], prefix)
+                    check_composite(tilepath)
+                batches[prefix] = workitem
+            else:
+                self.assertTrue(len(workitem) < level)
+                check_composite(workitem)
+                for dep in deps:
+                    if len(dep) == level and dep in expected:
+                        self.fail("%s depends on %s instead of its batch" % (workitem, dep))
+                for prefix, batch in batches.iteritems():
+                    if prefix[:-1] == workitem:
+                        self.assertTrue(batch in deps)
+
+        self.assertEqual(seen, expected)
+
+    def test_work_item_locality(self):
+        """Tests that render-tiles and batches under the same tile share a
+        locality key, and composite-tiles above that level are their own
+
+        """
+        ts = self.get_tileset({'renderchecks': 2}, self.get_outputdir())
+        level = ts.treedepth - tileset.LOCALITY_LEVELS
+        tilepath = (0,) * ts.treedepth
+        neighbor = (0,) * (ts.treedepth - 1) + (3,)
+        self.assertEqual(ts.get_work_item_locality(tilepath), tilepath[:level])
+        self.assertEqual(ts.get_work_item_locality(tilepath), ts.get_work_item_locality(neighbor))
+        self.assertEqual(ts.get_work_item_locality(tileset.RenderBatch((neighbor, tilepath), ())), tilepath[:level])
+        self.assertEqual(ts.get_work_item_locality((1,)), (1,))
+
     def test_forcerender_iterate(self):
         """Tests that a rendercheck mode 2 iteration returns every render-tile
         and upper-tile
@@ -225,6 +305,52 @@ class TilesetTest(unittest.TestCase):
                 lambda ts: setattr(ts, 'last_rendertime', 5))
         self.compare_iterate_to_expected(ts, updated_chunks)
 
+    def test_get_tiles_by_chunks(self):
+        """Tests that the vectorized chunk to tile mapping and path
+        computation agree with the plain ones"""
+        chunkcols, chunkrows = numpy.mgrid[-9:9, -9:9]
+        chunkcols = chunkcols.ravel()
+        chunkrows = chunkrows.ravel()
+        cols, rows, chunkindices = tileset.get_tiles_by_chunks(chunkcols, chunkrows)
+
+        expected = []
+        for i, (chunkcol, chunkrow) in enumerate(zip(chunkcols, chunkrows)):
+            for c, r in tileset.get_tiles_by_chunk(chunkcol, chunkrow):
+                expected.append((i, c, r))
+        self.assertEqual(sorted(zip(chunkindices, cols, rows)), sorted(expected))
+
+        paths = tileset.compute_paths(cols, rows, 5)
+        for c, r, path in zip(cols, rows, paths):
+            self.assertEqual(tuple(path), tileset.RenderTile.compute_path(c, r, 5).path)
+
+        indices = tileset.compute_tile_indices(cols, rows, 5)
+        for path, index in zip(paths, indices):
+            self.assertEqual(int("".join(str(digit) for digit in path), 4), index)
+
+    def test_chunk_index(self):
+        """Tests that the chunk scan index is reused across runs, and that
+        changed regions are scanned again
+
+        """
+        outputdir = self.get_outputdir()
+        ts = self.get_tileset({'renderchecks': 2}, outputdir)
+        self.assertEqual(self.rs.regions_scanned, 1)
+        self.assertTrue(os.path.exists(os.path.join(outputdir, "chunkscan.dat")))
+
+        # Nothing changed, so the index is used as is
+        ts = self.get_tileset({'renderchecks': 0}, outputdir,
+                lambda ts: setattr(ts, 'last_rendertime', 5))
+        self.assertEqual(self.rs.regions_scanned, 1)
+        self.assertEqual(ts.dirtytree.count(), 0)
+        self.assertEqual(ts.max_chunk_mtime, 5)
+
+        # Changing a chunk changes the region's key
+        self.rs.chunks[(0,0)] = 6
+        ts = self.get_tileset({'renderchecks': 0}, outputdir,
+                lambda ts: setattr(ts, 'last_rendertime', 5))
+        self.assertEqual(self.rs.regions_scanned, 2)
+        self.compare_iterate_to_expected(ts, {(0,0): 6})
+
     def test_rendercheckmode_1(self):
         """Tests that an interrupted render will correctly pick up tiles that
         need rendering
@@ -275,3 +401,200 @@ class TilesetTest(unittest.TestCase):
 
         for tilepath in expected:
             self.assertTrue(tilepath in paths, "%s was expected to be returned but wasn't: %s" % (tilepath, paths))
+
+def make_section_nbt(y, blocks, rnd):
+    """Builds a section compound for the given blocks, with random light"""
+    def nibbles():
+        return "".join(chr(rnd.randint(0, 255)) for i in xrange(2048))
+    return (_named(1, u"Y", struct.pack("b", y)) +
+            _named(7, u"Blocks", struct.pack(">i", 4096) + "".join(chr(b) for b in blocks)) +
+            _named(7, u"Data", struct.pack(">i", 2048) + "\x00" * 2048) +
+            _named(7, u"SkyLight", struct.pack(">i", 2048) + nibbles()) +
+            _named(7, u"BlockLight", struct.pack(">i", 2048) + nibbles()) +
+            chr(0))
+
+def make_render_chunk(chunkx, chunkz, rnd):
+    """Builds a chunk that has two sections of solid stone, so the ones
+    in the middle of the world are hidden, a section of random blocks on
+    top, and a nether roof over the chunks with chunkx == 2, with a random
+    depth of netherrack under it"""
+    sections = [make_section_nbt(y, [1] * 4096, rnd) for y in (0, 1)]
+    sections.append(make_section_nbt(2, [rnd.choice((0, 0, 1, 2, 3, 20))
+                                         for i in xrange(4096)], rnd))
+    if chunkx == 2:
+        depth = rnd.randint(1, 6)
+        # indexed y, z, x
+        blocks = [0] * 4096
+        for y in xrange(16):
+            for i in xrange(256):
+                if y == 15:
+                    blocks[y * 256 + i] = 7
+                elif y >= 15 - depth:
+                    blocks[y * 256 + i] = 87
+                elif y == 0 and rnd.random() < 0.5:
+                    blocks[y * 256 + i] = 87
+        sections.append(make_section_nbt(7, blocks, rnd))
+    level = (_named(3, u"xPos", struct.pack(">i", chunkx)) +
+             _named(3, u"zPos", struct.pack(">i", chunkz)) +
+             _named(9, u"Sections", chr(10) + struct.pack(">i", len(sections)) + "".join(sections)) +
+             chr(0))
+    return _named(10, u"", _named(10, u"Level", level) + chr(0))
+
+class RenderTileTest(unittest.TestCase):
+    """Tests that c_overviewer.render_tile(), which _render_rendertile()
+    draws a whole tile with, draws the same as drawing it section by
+    section with _draw_rendertile()"""
+    blockids = (1, 2, 3, 7, 20, 87)
+    files = ["stone", "grass_top", "grass_side", "grass_side_overlay",
+             "grass_side_snowed", "dirt", "dirt_podzol_side", "dirt_podzol_top",
+             "bedrock", "glass", "netherrack"]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp(prefix="OVTEST")
+        regiondir = os.path.join(cls.tmpdir, "world", "region")
+        os.makedirs(regiondir)
+        rnd = random.Random(1)
+        chunks = [(make_render_chunk(x, z, rnd), x, z, 100 + x * 3 + z)
+                  for x in xrange(3) for z in xrange(3)]
+        with open(os.path.join(regiondir, "r.0.0.mca"), "wb") as f:
+            f.write(make_region(*(chunks[0] + tuple(chunks[1:]))))
+        cls.regionset = world.RegionSet(regiondir, "region")
+
+        texturepath = os.path.join(cls.tmpdir, "textures")
+        write_block_textures(texturepath, cls.files, ["grass_side_overlay", "glass"])
+        generators = textures.blockmap_generators
+        textures.blockmap_generators = dict((key, gen) for key, gen in generators.iteritems()
+                                            if key[0] in cls.blockids)
+        try:
+            cls.textures = {}
+            for northdir in (0, 1):
+                cls.textures[northdir] = textures.Textures(texturepath=texturepath,
+                        northdirection=northdir)
+                cls.textures[northdir].generate()
+        finally:
+            textures.blockmap_generators = generators
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def get_tileset(self, rendermode, northdir, **options):
+        rset = self.regionset
+        if northdir:
+            rset = world.RotatedRegionSet(rset, northdir)
+        options.update({
+                'name': 'world name',
+                'bgcolor': '#000000',
+                'imgformat': 'png',
+                'optimizeimg': 0,
+                'rendermode': rendermode,
+                'renderchecks': 2,
+                'rerenderprob': 0,
+                })
+        outputdir = tempfile.mkdtemp(dir=self.tmpdir)
+        return tileset.TileSet(None, rset, FakeAssetmanager(0), self.textures[northdir], options, outputdir)
+
+    def get_tiles(self, ts):
+        """Returns the tiles that have any of the sections in them"""
+        tiles = set()
+        for chunkx, chunkz, mtime in ts.regionset.iterate_chunks():
+            tiles.update(tileset.get_tiles_by_chunk(*tileset.convert_coords(chunkx, chunkz)))
+        tiles = [tileset.RenderTile.compute_path(col, row, 5) for col, row in sorted(tiles)]
+        return [tile for tile in tiles
+                if any(chunky in (0, 1, 2, 7) for _, _, _, chunky, _, _
+                       in tileset.get_chunks_by_tile(tile, ts.regionset))]
+
+    def draw(self, ts, tile):
+        img = Image.new("RGBA", (384, 384), ts.options['bgcolor'])
+        self.assertTrue(ts._draw_rendertile(tile, img) is not None)
+        return img
+
+    def compare(self, rendermode, threads=1):
+        for northdir in (0, 1):
+            ts = self.get_tileset(rendermode, northdir)
+            tiles = self.get_tiles(ts)
+            # keep the images instead of saving them
+            images = {}
+            ts._save_rendertile = lambda tile, tileimg, mtime: images.__setitem__(tile.path, tileimg)
+            if threads == 1:
+                for tile in tiles:
+                    ts._render_rendertile(tile)
+            else:
+                # the threads all share the tileset's compiled rendermode
+                def render(tiles):
+                    for tile in tiles:
+                        ts._render_rendertile(tile)
+                workers = [threading.Thread(target=render, args=(tiles[i::threads],))
+                           for i in xrange(threads)]
+                for t in workers:
+                    t.start()
+                for t in workers:
+                    t.join()
+            for tile in tiles:
+                self.assertEqual(images[tile.path].tobytes(), self.draw(ts, tile).tobytes(),
+                        "%s differs, north direction %d" % (tile, northdir))
+
+    def test_normal(self):
+        self.compare(rendermodes.normal)
+
+    def test_lighting(self):
+        self.compare(rendermodes.lighting)
+
+    def test_smooth_lighting(self):
+        self.compare(rendermodes.smooth_lighting)
+
+    def test_cave(self):
+        self.compare(rendermodes.cave)
+
+    def test_nether(self):
+        self.compare(rendermodes.nether)
+
+    def test_threads(self):
+        self.compare(rendermodes.nether, threads=4)
+        self.compare(rendermodes.smooth_lighting, threads=4)
+
+    def test_culled(self):
+        """Tests that leaving out the hidden sections whole doesn't change
+        what's drawn. A hide primitive turns that off."""
+        ts = self.get_tileset(rendermodes.normal, 0)
+        unculled = self.get_tileset(rendermodes.normal + [rendermodes.Hide()], 0)
+        total = 0
+        for tile in self.get_tiles(ts):
+            img = Image.new("RGBA", (384, 384), ts.options['bgcolor'])
+            mtime, culled = c_overviewer.render_tile(ts.world, ts.regionset, tile.col, tile.row,
+                    img, ts._get_compiled_rendermode(), ts.textures)
+            total += culled
+            self.assertEqual(img.tobytes(), self.draw(unculled, tile).tobytes(), "%s differs" % tile)
+        self.assertTrue(total > 0)
+
+    def render_all(self, ts):
+        """Renders every tile of the tileset, and returns a dict mapping
+        the path of each image to its contents and mtime"""
+        ts.do_preprocessing()
+        for workitem, deps in ts.iterate_work_items(0):
+            ts.do_work(workitem)
+        images = {}
+        for dirpath, dirnames, filenames in os.walk(ts.outputdir):
+            for filename in filenames:
+                if filename.endswith(".png"):
+                    path = os.path.join(dirpath, filename)
+                    with open(path, "rb") as f:
+                        images[os.path.relpath(path, ts.outputdir)] = (f.read(), os.path.getmtime(path))
+        return images
+
+    def test_renderbatch(self):
+        """Tests that rendering the tiles in batches gives the same
+        render-tiles and composite-tiles, with the same mtimes"""
+        ts = self.get_tileset(rendermodes.normal, 0)
+        expected = self.render_all(ts)
+        # the composite-tiles of the batches, and above them
+        for depth in xrange(ts.treedepth - 2, ts.treedepth):
+            self.assertTrue(any(path.count(os.sep) == depth - 1 for path in expected))
+        self.assertTrue("base.png" in expected)
+
+        images = self.render_all(self.get_tileset(rendermodes.normal, 0, renderbatch=2))
+        self.assertEqual(sorted(images), sorted(expected))
+        for path, (data, mtime) in expected.iteritems():
+            self.assertEqual(images[path][0], data, "%s differs" % path)
+            self.assertEqual(images[path][1], mtime, "%s has a different mtime" % path)
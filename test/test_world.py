@@ -1,8 +1,34 @@
 import unittest
 
 import os
+import pickle
+import functools
+import struct
+import tempfile
+import shutil
+
+import numpy
 
 from overviewer_core import world
+from test_nbt import _named, _tag_string, make_region
+
+def make_poi_chunk(tileentities=(), entities=()):
+    """Builds an uncompressed chunk NBT blob with the given tile entities, as
+    (id, x, y, z, text) tuples, and entities, as (id, x, y, z) tuples."""
+    tes = [_named(8, u"id", _tag_string(id)) +
+           _named(3, u"x", struct.pack(">i", x)) +
+           _named(3, u"y", struct.pack(">i", y)) +
+           _named(3, u"z", struct.pack(">i", z)) +
+           _named(8, u"Text1", _tag_string(text)) + chr(0)
+           for id, x, y, z, text in tileentities]
+    ents = [_named(8, u"id", _tag_string(id)) +
+            _named(9, u"Pos", chr(6) + struct.pack(">i3d", 3, x, y, z)) + chr(0)
+            for id, x, y, z in entities]
+    level = (
+        _named(9, u"TileEntities", chr(10) + struct.pack(">i", len(tes)) + "".join(tes)) +
+        _named(9, u"Entities", chr(10) + struct.pack(">i", len(ents)) + "".join(ents)) +
+        chr(0))
+    return _named(10, u"", _named(10, u"Level", level) + chr(0))
 
 class ExampleWorldTest(unittest.TestCase):
     @classmethod
@@ -34,5 +60,111 @@ class ExampleWorldTest(unittest.TestCase):
         
          
 
+class ChunkSectionTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        blocks = "".join(chr(i % 256) for i in xrange(4096))
+        def load_blocks():
+            self.calls.append("Blocks")
+            return world._expand_blocks(blocks, "\x21" * 2048)
+        self.section = world.ChunkSection({'Y': 3, 'Blocks': blocks}, {'Blocks': load_blocks})
+
+    def test_lazy(self):
+        self.assertEquals(self.section['Y'], 3)
+        self.assertEquals(self.calls, [])
+        blocks = self.section['Blocks']
+        self.assertEquals(blocks.shape, (16,16,16))
+        self.assertEquals(blocks[0,0,1], 0x201)
+        self.assertEquals(blocks[0,0,2], 0x102)
+        # expanded only once
+        self.assertTrue(self.section['Blocks'] is blocks)
+        self.assertEquals(self.calls, ["Blocks"])
+
+    def test_expand_nibbles(self):
+        data = world._expand_nibbles("\x21" * 2048)
+        self.assertEquals(data[5,6,0], 1)
+        self.assertEquals(data[5,6,1], 2)
+
+    def test_pickle(self):
+        # a loader that can't be pickled, so it's expanded first
+        section = pickle.loads(pickle.dumps(self.section, 2))
+        self.assertEquals(self.calls, ["Blocks"])
+        self.assertEquals(type(section), world.ChunkSection)
+        self.assertEquals(section._loaders, {})
+        self.assertEquals(section["Blocks"][0,0,1], 0x201)
+
+    def test_pickle_packed(self):
+        blocks = "".join(chr(i % 256) for i in xrange(4096))
+        section = world.ChunkSection({'Y': 3, 'Blocks': blocks, 'Data': "\x21" * 2048},
+                {'Blocks': functools.partial(world._expand_blocks, blocks, "\x21" * 2048),
+                 'Data': functools.partial(world._expand_nibbles, "\x21" * 2048)})
+        section['Data']
+        copy = pickle.loads(pickle.dumps(section, 2))
+        # pickling didn't expand anything, and unpickling neither
+        self.assertEquals(section._loaders.keys(), ['Blocks'])
+        self.assertEquals(copy._loaders.keys(), ['Blocks'])
+        self.assertEquals(dict.__getitem__(copy, 'Blocks'), blocks)
+        self.assertEquals(copy["Blocks"][0,0,1], 0x201)
+        self.assertEquals(copy["Data"][5,6,1], 2)
+
+class RegionPOITest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="overviewer-test-")
+        regiondir = os.path.join(self.tmpdir, "region")
+        os.mkdir(regiondir)
+        self.path = os.path.join(regiondir, "r.0.0.mca")
+        with open(self.path, "wb") as f:
+            f.write(make_region(
+                make_poi_chunk(tileentities=[(u"Sign", 16, 64, 32, u"a")]), 1, 2, 100,
+                (make_poi_chunk(entities=[(u"Pig", 50.5, 64.0, 70.5)]), 3, 4, 200)))
+        self.otherpath = os.path.join(regiondir, "r.-1.0.mca")
+        with open(self.otherpath, "wb") as f:
+            f.write(make_region(make_poi_chunk(tileentities=[(u"Sign", -5, 70, 3, u"c")]), 31, 0, 300))
+        self.rset = world.RegionSet(regiondir, "region")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_region_pois(self):
+        pois = sorted(self.rset.get_region_pois(self.path))
+        self.assertEquals([poi[:3] for poi in pois], [(1, 2, 100), (3, 4, 200)])
+        self.assertEquals([(te['id'], te['x'], te['Text1']) for te in pois[0][3]], [(u"Sign", 16, u"a")])
+        self.assertEquals(pois[0][4], [])
+        self.assertEquals(pois[1][3], [])
+        self.assertEquals([(e['id'], e['Pos']) for e in pois[1][4]], [(u"Pig", [50.5, 64.0, 70.5])])
+
+        # chunk coordinates are world coordinates, not region ones
+        pois = self.rset.get_region_pois(self.otherpath)
+        self.assertEquals([poi[:3] for poi in pois], [(-1, 0, 300)])
+
+    def test_known(self):
+        pois = sorted(self.rset.get_region_pois(self.path, {(1, 2): 100, (3, 4): 150}))
+        # unchanged, so not decoded again
+        self.assertEquals(pois[0], (1, 2, 100, None, None))
+        self.assertEquals(pois[1][:3], (3, 4, 200))
+        self.assertEquals(len(pois[1][4]), 1)
+
+    def test_rotated(self):
+        rotated = world.RotatedRegionSet(self.rset, world.UPPER_RIGHT)
+        pois = rotated.get_region_pois(self.path)
+        self.assertEquals(sorted(poi[:2] for poi in pois),
+                sorted([rotated.rotate(1, 2), rotated.rotate(3, 4)]))
+        # entity positions are left alone
+        pig = [poi for poi in pois if poi[4]][0][4][0]
+        self.assertEquals(pig['Pos'], [50.5, 64.0, 70.5])
+
+        # known is in rotated coordinates too
+        x, z = rotated.rotate(1, 2)
+        pois = dict((poi[:2], poi) for poi in rotated.get_region_pois(self.path, {(x, z): 100}))
+        self.assertEquals(pois[x, z], (x, z, 100, None, None))
+        self.assertEquals(len(pois[rotated.rotate(3, 4)][4]), 1)
+
+    def test_cropped(self):
+        # only chunk 1,2 is in these bounds
+        cropped = world.CroppedRegionSet(self.rset, 0, 0, 31, 47)
+        pois = cropped.get_region_pois(self.path)
+        self.assertEquals([poi[:3] for poi in pois], [(1, 2, 100)])
+        self.assertEquals(cropped.get_region_pois(self.path, {(1, 2): 100}), [(1, 2, 100, None, None)])
+
 if __name__ == "__main__":
     unittest.main()